@@ -7,7 +7,7 @@ from flask import Flask, request, jsonify, render_template, send_file, Response,
 from flask_cors import CORS
 import google.generativeai as genai
 import pandas as pd
-from thefuzz import process, fuzz
+from thefuzz import fuzz
 from dotenv import load_dotenv
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import func
@@ -16,7 +16,8 @@ from sqlalchemy import func
 import time
 import re as re_mod
 import glob
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, Future as ConcurrentFuture, wait as futures_wait
+import queue
 load_dotenv()
 
 # ═══════════════════════════════════════════════════════════════
@@ -25,11 +26,14 @@ load_dotenv()
 AI_MODEL_PRIMARY = 'gemini-2.5-flash'
 AI_MODEL_FALLBACK = 'gemini-2.0-flash'
 AI_MAX_RETRIES = 3
-AI_BACKOFF_SECONDS = [3, 8, 15]  # Exponential backoff per attempt
 FUZZY_MATCH_THRESHOLD = 95  # Minimum score for class name fuzzy matching
 MAX_UPLOAD_MB = 100
 MAX_CONVERSATION_HISTORY = 20  # Sliding window for chat context
 MAX_STUDENTS_IN_CONTEXT = 20  # Students sent to AI prompt per class
+OCR_CACHE_MAX_MB = 50  # Disk cap for cached OCR responses
+OCR_CACHE_TTL_SECONDS = 14 * 24 * 3600  # Cached OCR results expire after 2 weeks
+OCR_IMAGE_MAX_EDGE = 1600  # Long edge (px) images are downscaled to before OCR
+OCR_IMAGE_JPEG_QUALITY = 85
 
 # ═══════════════════════════════════════════════════════════════
 #  STRUCTURED LOGGING
@@ -46,10 +50,18 @@ WORKING_EXCEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "A
 
 # Configure AI Model — supports multiple API keys (comma-separated) for rotation
 import threading
+import asyncio
+import google.ai.generativelanguage as glm
+from google.api_core import client_options as client_options_lib
 _api_keys_raw = os.getenv("GEMINI_API_KEY", "")
 API_KEYS = [k.strip() for k in _api_keys_raw.split(",") if k.strip() and k.strip() != "your_gemini_api_key_here"]
-_current_key_index = 0
-_key_lock = threading.Lock()
+
+# AI_BACKEND=fake swaps Gemini for the local stand-in in fake_gemini.py (load tests, offline dev)
+AI_BACKEND = os.getenv("AI_BACKEND", "gemini").lower()
+if AI_BACKEND == "fake":
+    logger.warning("AI_BACKEND=fake: Gemini calls are answered by the local stand-in (fake_gemini.py).")
+    if not API_KEYS:
+        API_KEYS = ["fake-key-{}".format(i + 1) for i in range(int(os.getenv("FAKE_GEMINI_KEYS", "3")))]
 
 if not API_KEYS:
     logger.warning("No API keys set in .env file. Set GEMINI_API_KEY (comma-separated for multiple).")
@@ -57,40 +69,1379 @@ else:
     logger.info("Loaded {} API key(s) for rotation.".format(len(API_KEYS)))
 
 def get_current_api_key():
-    """Get the current API key."""
+    """Get the default API key (first in the pool)."""
     if not API_KEYS:
         return None
-    return API_KEYS[_current_key_index % len(API_KEYS)]
-
-def rotate_api_key():
-    """Rotate to the next API key. Thread-safe."""
-    global _current_key_index
-    if len(API_KEYS) <= 1:
-        return get_current_api_key()
-    with _key_lock:
-        _current_key_index = (_current_key_index + 1) % len(API_KEYS)
-        new_key = API_KEYS[_current_key_index]
-        genai.configure(api_key=new_key)
-        logger.info("Rotated to API key #{} of {}".format(_current_key_index + 1, len(API_KEYS)))
-    return new_key
-
-def _call_gemini(model_name, content_parts, max_retries=None):
-    """Centralized Gemini API caller with retry, rotation, and timeout.
-    Returns raw_text on success, raises on total failure."""
-    retries = max_retries or AI_MAX_RETRIES
+    return API_KEYS[0]
+
+# One set of SDK service clients per key, so every call is bound to its own key and
+# concurrent threads never change the key under each other (genai.configure is process-global).
+_KEY_CLIENT_CLASSES = {
+    "generative_async": glm.GenerativeServiceAsyncClient,
+    "cache_async": glm.CacheServiceAsyncClient,
+}
+_key_clients = {}
+_key_clients_lock = threading.Lock()
+
+def _key_client(key_index, service="generative_async"):
+    """SDK service client bound to one API key (created lazily, then reused)."""
+    with _key_clients_lock:
+        client = _key_clients.get((key_index, service))
+        if client is None:
+            client = _KEY_CLIENT_CLASSES[service](
+                client_options=client_options_lib.ClientOptions(api_key=API_KEYS[key_index]))
+            _key_clients[(key_index, service)] = client
+        return client
+
+def _sdk_model_hooks_ok():
+    """GenerativeModel has no public way to take a client or a cache name, so
+    _model_for_key and _use_cached_content set its _async_client / _cached_content.
+    Check this SDK version still reads both (requirements.txt pins the one they were written for)."""
+    try:
+        model = genai.GenerativeModel("sdk-check")
+        if "_async_client" not in vars(model) or \
+                "_async_client" not in genai.GenerativeModel.generate_content_async.__code__.co_names:
+            return False
+        model._cached_content = "cachedContents/sdk-check"
+        request = model._prepare_request(contents="ping", tools=None, tool_config=None)
+        return request.cached_content == "cachedContents/sdk-check"
+    except Exception as e:
+        logger.error("Gemini SDK hook check failed: {}".format(e))
+        return False
+
+SDK_MODEL_HOOKS_OK = AI_BACKEND == "fake" or _sdk_model_hooks_ok()
+if not SDK_MODEL_HOOKS_OK:
+    logger.error("google-generativeai {} no longer reads GenerativeModel._async_client/_cached_content; "
+                 "per-key routing and context caching are off (every call uses the first key). "
+                 "Install the version pinned in requirements.txt.".format(genai.__version__))
+
+def _model_for_key(model_name, key_index, generation_config=None):
+    """GenerativeModel whose requests go out on the given key (default key when None)."""
+    if AI_BACKEND == "fake":
+        import fake_gemini
+        return fake_gemini.FakeGenerativeModel(model_name, key_index, generation_config)
+    if generation_config is not None:
+        model = genai.GenerativeModel(model_name, generation_config=generation_config)
+    else:
+        model = genai.GenerativeModel(model_name)
+    if key_index is not None and SDK_MODEL_HOOKS_OK:
+        # Async clients bind to the running loop, so this must be called on the AI event loop
+        model._async_client = _key_client(key_index, "generative_async")
+    return model
+
+def _use_cached_content(model, cached_name):
+    """Point a model at a provider context cache (from_cached_content would re-fetch it on the default key)."""
+    model._cached_content = cached_name
+
+# ═══════════════════════════════════════════════════════════════
+#  KEY POOL SCHEDULER
+#  Per-key token buckets for requests/minute and tokens/minute. Every call
+#  reserves budget on the least-loaded key before it is sent, and waits in a
+#  queue when every key is saturated — instead of firing, eating a 429, and
+#  sleeping on a fixed backoff. The budgets are opt-in (a paid key's limits are
+#  far above the free tier's); without them only the concurrency cap and the
+#  429 cooldowns apply.
+# ═══════════════════════════════════════════════════════════════
+AI_KEY_RPM = int(os.getenv("GEMINI_KEY_RPM") or 0)  # Requests/minute per key; 0 = no client-side cap (free tier: 10)
+AI_KEY_TPM = int(os.getenv("GEMINI_KEY_TPM") or 0)  # Tokens/minute per key; 0 = no client-side cap (free tier: 250000)
+AI_TOKENS_PER_IMAGE = 1032  # ~4 tiles of 258 tokens for a downscaled phone photo
+AI_EST_OUTPUT_TOKENS = 1000  # Reserved for the response until real usage is known
+AI_SCHEDULER_MAX_WAIT_SECONDS = 60  # Longest a call may queue for budget
+AI_KEY_COOLDOWN_SECONDS = [15, 30, 60, 120]  # Benched after consecutive 429s on the same key
+AI_KEY_AUTH_COOLDOWN_SECONDS = 600  # Benched after an invalid/unauthorized key error
+AI_CONCURRENCY_PER_KEY = int(os.getenv("GEMINI_CONCURRENCY_PER_KEY", "3"))  # Calls in flight per key
+AI_SCHEDULER_POLL_SECONDS = 0.25  # How often a queued call re-checks for a free key
+
+def _estimate_tokens(content_parts):
+    """Rough input+output token estimate used to reserve TPM budget before a call."""
+    tokens = AI_EST_OUTPUT_TOKENS
+    for part in content_parts:
+        if isinstance(part, dict) and "data" in part:
+            tokens += AI_TOKENS_PER_IMAGE
+        else:
+            tokens += len(str(part)) // 4
+    return tokens
+
+class _TokenBucket:
+    """per_minute 0 is an unlimited bucket: always ready, never drawn down."""
+
+    def __init__(self, per_minute):
+        self.unlimited = not per_minute
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.rate = per_minute / 60.0  # Refill per second
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def seconds_until(self, amount):
+        if self.unlimited:
+            return 0.0
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def headroom(self):
+        return 1.0 if self.unlimited else self.level / self.capacity
+
+class GeminiKeyScheduler:
+    """Hands out the least-loaded healthy API key for each call, capping the
+    calls in flight per key. Thread-safe; acquire() is awaited on the AI event loop.
+    Also tracks per-key health: keys that return 429s (or auth errors) are
+    benched for a cooldown so concurrent calls route around them."""
+
+    def __init__(self, num_keys, rpm, tpm, concurrency):
+        self._lock = threading.Lock()
+        self.concurrency = concurrency
+        self._requests = [_TokenBucket(rpm) for _ in range(num_keys)]
+        self._tokens = [_TokenBucket(tpm) for _ in range(num_keys)]
+        self._cooldown_until = [0.0] * num_keys
+        self._consecutive_429s = [0] * num_keys
+        self._in_flight = [0] * num_keys
+        self.calls = [0] * num_keys
+        self.rate_limited = [0] * num_keys
+        self.errors = [0] * num_keys
+        self.queued_calls = 0
+        self.queue_wait_seconds = 0.0
+
+    def _try_reserve(self, est_tokens):
+        """Returns (key_index, 0) on success or (None, seconds_to_wait). Caller holds the lock."""
+        now = time.monotonic()
+        best, best_headroom, min_wait = None, -1.0, None
+        for i in range(len(self._requests)):
+            req, tok = self._requests[i], self._tokens[i]
+            req.refill(now)
+            tok.refill(now)
+            wait = max(req.seconds_until(1), tok.seconds_until(est_tokens), self._cooldown_until[i] - now)
+            if self._in_flight[i] >= self.concurrency:
+                wait = max(wait, AI_SCHEDULER_POLL_SECONDS)
+            if wait > 0:
+                min_wait = wait if min_wait is None else min(min_wait, wait)
+                continue
+            headroom = min(req.headroom(), tok.headroom())
+            if headroom > best_headroom:
+                best, best_headroom = i, headroom
+        if best is None:
+            return (None, min_wait or 1.0)
+        self._requests[best].level -= min(1, self._requests[best].capacity)
+        self._tokens[best].level -= min(est_tokens, self._tokens[best].capacity)
+        self._in_flight[best] += 1
+        self.calls[best] += 1
+        return (best, 0.0)
+
+    async def acquire(self, est_tokens, max_wait=None):
+        """Reserve budget and an in-flight slot for one call. Waits (without
+        blocking the event loop) while every key is saturated.
+        Returns the key index (None when no keys are configured)."""
+        if not self._requests:
+            return None
+        max_wait = AI_SCHEDULER_MAX_WAIT_SECONDS if max_wait is None else max_wait
+        started = time.monotonic()
+        with self._lock:
+            idx, wait = self._try_reserve(est_tokens)
+            if idx is not None:
+                return idx
+            self.queued_calls += 1
+        while idx is None:
+            waited = time.monotonic() - started
+            if waited + min(wait, AI_SCHEDULER_POLL_SECONDS) > max_wait:
+                with self._lock:
+                    self.queue_wait_seconds += waited
+                logger.warning("All {} API key(s) over budget, queue wait exceeded {:.1f}s".format(len(self._requests), max_wait))
+                raise AISchedulerTimeoutError()
+            # Slots free up when other calls finish, so re-check at least every poll interval
+            await asyncio.sleep(min(wait, AI_SCHEDULER_POLL_SECONDS))
+            with self._lock:
+                idx, wait = self._try_reserve(est_tokens)
+        with self._lock:
+            self.queue_wait_seconds += time.monotonic() - started
+        return idx
+
+    def has_capacity(self, est_tokens):
+        """True when some key could take a call of est_tokens right now. Reserves nothing."""
+        with self._lock:
+            now = time.monotonic()
+            for i in range(len(self._requests)):
+                req, tok = self._requests[i], self._tokens[i]
+                req.refill(now)
+                tok.refill(now)
+                if (self._in_flight[i] < self.concurrency and self._cooldown_until[i] <= now
+                        and req.seconds_until(1) <= 0 and tok.seconds_until(est_tokens) <= 0):
+                    return True
+            return not self._requests
+
+    def release(self, idx):
+        """Give back the in-flight slot taken by acquire()."""
+        if idx is None:
+            return
+        with self._lock:
+            self._in_flight[idx] = max(0, self._in_flight[idx] - 1)
+
+    def settle(self, idx, est_tokens, actual_tokens):
+        """Correct a reservation once the real token usage is known."""
+        if idx is None or not actual_tokens:
+            return
+        with self._lock:
+            tok = self._tokens[idx]
+            tok.level = min(tok.capacity, tok.level + est_tokens - actual_tokens)
+
+    def report_success(self, idx):
+        if idx is None:
+            return
+        with self._lock:
+            self._consecutive_429s[idx] = 0
+
+    def report_rate_limited(self, idx):
+        """The provider returned 429 for this key: drain its budget and bench it for a cooldown."""
+        if idx is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._requests[idx].refill(now)
+            self._requests[idx].level = min(self._requests[idx].level, 0.0)
+            self.rate_limited[idx] += 1
+            self._consecutive_429s[idx] += 1
+            step = min(self._consecutive_429s[idx], len(AI_KEY_COOLDOWN_SECONDS)) - 1
+            self._cooldown_until[idx] = now + AI_KEY_COOLDOWN_SECONDS[step]
+        logger.info("API key #{} rate limited — cooling down {}s".format(idx + 1, AI_KEY_COOLDOWN_SECONDS[step]))
+
+    def report_error(self, idx, err):
+        """Non-rate-limit failure. Bad or revoked keys are benched for a long cooldown.
+        Returns True if the key was benched (the call is worth retrying on another key)."""
+        if idx is None:
+            return False
+        err_str = str(err).lower()
+        with self._lock:
+            self.errors[idx] += 1
+            if 'api key' in err_str or 'api_key' in err_str or 'permission' in err_str or '403' in err_str:
+                self._cooldown_until[idx] = time.monotonic() + AI_KEY_AUTH_COOLDOWN_SECONDS
+                logger.warning("API key #{} rejected by provider — benched for {}s".format(idx + 1, AI_KEY_AUTH_COOLDOWN_SECONDS))
+                return True
+        return False
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            keys = []
+            for i in range(len(self._requests)):
+                self._requests[i].refill(now)
+                self._tokens[i].refill(now)
+                keys.append({
+                    "key": i + 1,
+                    "calls": self.calls[i],
+                    "in_flight": self._in_flight[i],
+                    "rate_limited": self.rate_limited[i],
+                    "errors": self.errors[i],
+                    "cooldown_seconds": max(0, round(self._cooldown_until[i] - now, 1)),
+                    "requests_left": None if self._requests[i].unlimited else round(self._requests[i].level, 1),
+                    "tokens_left": None if self._tokens[i].unlimited else int(self._tokens[i].level),
+                })
+            return {
+                "rpm_per_key": AI_KEY_RPM,
+                "tpm_per_key": AI_KEY_TPM,
+                "concurrency_per_key": self.concurrency,
+                "queued_calls": self.queued_calls,
+                "queue_wait_seconds": round(self.queue_wait_seconds, 1),
+                "keys": keys,
+            }
+
+_key_scheduler = GeminiKeyScheduler(len(API_KEYS), AI_KEY_RPM, AI_KEY_TPM, AI_CONCURRENCY_PER_KEY)
+
+# ═══════════════════════════════════════════════════════════════
+#  OCR RESULT CACHE
+#  Content-addressed disk cache in front of every image-bearing Gemini call.
+#  Key = sha256(model name + prompt text + raw image bytes), so re-uploads of the
+#  same photo with the same prompt return instantly and cost no quota.
+# ═══════════════════════════════════════════════════════════════
+import hashlib
+from collections import OrderedDict, deque
+
+def _strip_json_fences(raw_text):
+    """Remove ```json ... ``` wrappers the model sometimes adds around JSON."""
+    raw_text = re_mod.sub(r'^```(?:json)?\s*', '', raw_text.strip())
+    raw_text = re_mod.sub(r'\s*```$', '', raw_text)
+    return raw_text.strip()
+
+def _image_part_bytes(part):
+    """Raw bytes of an image content part (accepts base64 strings or bytes)."""
+    data = part.get("data", b"")
+    if isinstance(data, str):
+        if 'base64,' in data:
+            data = data.split('base64,')[1]
+        try:
+            return base64.b64decode(data)
+        except Exception:
+            return data.encode('utf-8')
+    return bytes(data)
+
+class OCRResultCache:
+    """Disk-backed LRU cache with TTL expiry and a total size cap. Thread-safe."""
+
+    def __init__(self, cache_dir, max_bytes, ttl_seconds):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # {key: size_bytes}, oldest access first
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0  # Image bytes that did not have to be re-sent to Gemini
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            entries = []
+            for f in glob.glob(os.path.join(cache_dir, "*.json")):
+                try:
+                    entries.append((os.path.getmtime(f), os.path.basename(f)[:-5], os.path.getsize(f)))
+                except OSError:
+                    pass
+            for _, key, size in sorted(entries):
+                self._index[key] = size
+                self._total_bytes += size
+        except OSError as e:
+            logger.warning("OCR cache disabled — cannot use '{}': {}".format(cache_dir, e))
+            self.cache_dir = None
+
+    @staticmethod
+    def make_key(model_name, content_parts, generation_config=None, preprocess=None):
+        """Returns (key, image_bytes_total), or (None, 0) if there are no images to key on."""
+        prompt_hash = hashlib.sha256()
+        image_hashes = []
+        image_bytes = 0
+        for part in content_parts:
+            if isinstance(part, dict) and "data" in part:
+                raw = _image_part_bytes(part)
+                image_bytes += len(raw)
+                image_hashes.append(hashlib.sha256(raw).hexdigest())
+            else:
+                prompt_hash.update(str(part).encode('utf-8'))
+        if not image_hashes:
+            return (None, 0)
+        if generation_config is not None:
+            prompt_hash.update(repr(generation_config).encode('utf-8'))
+        if preprocess:
+            prompt_hash.update(json.dumps(preprocess, sort_keys=True).encode('utf-8'))
+        key_src = "{}|{}|{}".format(model_name, prompt_hash.hexdigest(), ','.join(image_hashes))
+        return (hashlib.sha256(key_src.encode('utf-8')).hexdigest(), image_bytes)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key, image_bytes=0):
+        if not self.cache_dir or key is None:
+            return None
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            path = self._path(key)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                self._drop(key)
+                self.misses += 1
+                return None
+            if time.time() - entry.get("created", 0) > self.ttl_seconds:
+                self._drop(key)
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            try:
+                os.utime(path, None)  # Persist LRU order across restarts
+            except OSError:
+                pass
+            self.hits += 1
+            self.bytes_saved += image_bytes
+            return entry.get("text")
+
+    def put(self, key, model_name, text):
+        if not self.cache_dir or key is None or not text:
+            return
+        payload = json.dumps({"model": model_name, "created": time.time(), "text": text})
+        with self._lock:
+            try:
+                with open(self._path(key), 'w', encoding='utf-8') as f:
+                    f.write(payload)
+            except OSError as e:
+                logger.warning("OCR cache write failed: {}".format(e))
+                return
+            if key in self._index:
+                self._total_bytes -= self._index[key]
+            self._index[key] = len(payload)
+            self._index.move_to_end(key)
+            self._total_bytes += len(payload)
+            while self._total_bytes > self.max_bytes and len(self._index) > 1:
+                oldest = next(iter(self._index))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def _drop(self, key):
+        """Remove an entry. Caller must hold the lock."""
+        size = self._index.pop(key, 0)
+        self._total_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "entries": len(self._index),
+                "size_mb": round(self._total_bytes / (1024 * 1024), 2),
+                "evictions": self.evictions,
+                "image_mb_saved": round(self.bytes_saved / (1024 * 1024), 2),
+            }
+
+# Same persistence rule as the database: Render's mounted disk if present, else the app folder.
+_ocr_cache_dir = '/data/ocr_cache' if os.path.exists('/data') else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ocr_cache')
+_ocr_cache = OCRResultCache(_ocr_cache_dir, OCR_CACHE_MAX_MB * 1024 * 1024, OCR_CACHE_TTL_SECONDS)
+
+# ═══════════════════════════════════════════════════════════════
+#  PROMPT PREFIX CACHE
+#  The static part of an OCR prompt (system prompt + class rosters) is built
+#  once per (class set, roster version) and shared by every chunk/request.
+#  Where the provider supports it, the prefix is also uploaded once per key
+#  as cached content, so later calls only send their images.
+# ═══════════════════════════════════════════════════════════════
+from google.generativeai import protos
+from google.protobuf import duration_pb2
+
+PROMPT_PREFIX_CACHE_SIZE = 32
+PROMPT_PREFIX_TTL_SECONDS = 600  # Rebuilt at least this often, even without a roster change
+AI_CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE", "1") == "1"  # Explicit caching needs a paid-tier key
+AI_CONTEXT_CACHE_TTL_SECONDS = 900
+AI_CONTEXT_CACHE_MIN_TOKENS = 1024  # Provider minimum for explicit caching on Flash
+AI_CONTEXT_CACHE_RETRY_SECONDS = 1800  # After a refused create, don't ask that key again for this long
+
+class PromptPrefix:
+    """Static leading text of a prompt. Pass it as the first content part of a
+    Gemini call; it stringifies to its text, so cache keys and token estimates see it."""
+
+    def __init__(self, text):
+        self.text = text
+        self.digest = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+        self.tokens = len(text) // 4
+
+    def __str__(self):
+        return self.text
+
+_prompt_prefixes = OrderedDict()  # {cache_key: (PromptPrefix, payload, built_at)}
+_prompt_prefixes_lock = threading.Lock()
+_prompt_prefix_stats = {"hits": 0, "builds": 0}
+
+def _cached_prompt_prefix(cache_key, builder):
+    """Returns (PromptPrefix, payload) for cache_key, calling builder() -> (text, payload) on a miss.
+    cache_key should include the roster version so roster edits rebuild the prefix."""
+    now = time.time()
+    version = roster_version()
+    with _prompt_prefixes_lock:
+        entry = _prompt_prefixes.get(cache_key)
+        if entry and now - entry[2] < PROMPT_PREFIX_TTL_SECONDS:
+            _prompt_prefixes.move_to_end(cache_key)
+            _prompt_prefix_stats["hits"] += 1
+            return (entry[0], entry[1])
+    text, payload = builder()
+    prefix = PromptPrefix(text)
+    with _prompt_prefixes_lock:
+        # A roster write during the build may not be in it: serve it this once, don't store it
+        if roster_version() != version:
+            return (prefix, payload)
+        _prompt_prefixes[cache_key] = (prefix, payload, now)
+        _prompt_prefixes.move_to_end(cache_key)
+        while len(_prompt_prefixes) > PROMPT_PREFIX_CACHE_SIZE:
+            _prompt_prefixes.popitem(last=False)
+        _prompt_prefix_stats["builds"] += 1
+    return (prefix, payload)
+
+_context_caches = {}  # {(prefix digest, model, key index): (cached content name or None, valid_until)}
+_context_cache_locks = {}  # Same keys -> asyncio.Lock, so concurrent chunks create one cache, not several
+_context_cache_stats = {"created": 0, "reused": 0, "refused": 0}
+
+async def _provider_context_cache(prefix, model_name, key_index):
+    """Name of provider-side cached content holding the prefix for this key, or None
+    (caching disabled, prefix too small, or the key/tier doesn't support it). Runs on the AI event loop."""
+    if not AI_CONTEXT_CACHE_ENABLED or not SDK_MODEL_HOOKS_OK or AI_BACKEND == "fake" or key_index is None or prefix.tokens < AI_CONTEXT_CACHE_MIN_TOKENS:
+        return None
+    cache_id = (prefix.digest, model_name, key_index)
+    lock = _context_cache_locks.setdefault(cache_id, asyncio.Lock())
+    async with lock:
+        name, valid_until = _context_caches.get(cache_id, (None, 0))
+        if time.monotonic() < valid_until:
+            if name:
+                _context_cache_stats["reused"] += 1
+            return name
+        try:
+            request = protos.CreateCachedContentRequest(cached_content=protos.CachedContent(
+                model="models/{}".format(model_name),
+                contents=[protos.Content(role="user", parts=[protos.Part(text=prefix.text)])],
+                ttl=duration_pb2.Duration(seconds=AI_CONTEXT_CACHE_TTL_SECONDS),
+            ))
+            response = await _key_client(key_index, "cache_async").create_cached_content(request)
+            # Stop using it a minute before the provider expires it
+            _context_caches[cache_id] = (response.name, time.monotonic() + AI_CONTEXT_CACHE_TTL_SECONDS - 60)
+            _context_cache_stats["created"] += 1
+            logger.info("Context cache created on key #{} for {} ({} prefix tokens)".format(key_index + 1, model_name, prefix.tokens))
+            return response.name
+        except Exception as e:
+            _context_caches[cache_id] = (None, time.monotonic() + AI_CONTEXT_CACHE_RETRY_SECONDS)
+            _context_cache_stats["refused"] += 1
+            logger.info("Context cache unavailable on key #{} ({}); sending the prefix inline".format(key_index + 1, str(e)[:120]))
+            return None
+
+def _prompt_cache_stats():
+    with _prompt_prefixes_lock:
+        stats = dict(_prompt_prefix_stats, entries=len(_prompt_prefixes))
+    stats["provider"] = dict(_context_cache_stats, enabled=AI_CONTEXT_CACHE_ENABLED)
+    return stats
+
+# ═══════════════════════════════════════════════════════════════
+#  IMAGE PREPROCESSING
+#  Every image is normalized with Pillow before it is sent to Gemini:
+#  EXIF rotation, contrast stretch, optional grayscale / crop to a region,
+#  and a downscale to OCR_IMAGE_MAX_EDGE. Runs only on cache misses.
+# ═══════════════════════════════════════════════════════════════
+import io
+from PIL import Image, ImageOps
+
+# Off-loop pool so Pillow work never stalls the AI event loop (Pillow releases the GIL while decoding/resizing)
+_image_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ocr-preprocess")
+
+def _normalize_crop_box(box):
+    """Validate a crop box given as [left, top, right, bottom] fractions (0-1) of the image. None if invalid."""
+    try:
+        left, top, right, bottom = [float(v) for v in box]
+    except (TypeError, ValueError):
+        return None
+    if not (0 <= left < right <= 1 and 0 <= top < bottom <= 1):
+        return None
+    return [left, top, right, bottom]
+
+def _preprocess_image(raw, grayscale=False, crop_box=None, max_edge=OCR_IMAGE_MAX_EDGE):
+    """Returns JPEG bytes ready for OCR. Falls back to the original bytes if
+    the image can't be decoded, or if re-encoding would only make it bigger."""
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            rotated = img.getexif().get(0x0112, 1) not in (0, 1)  # EXIF Orientation tag
+            img = ImageOps.exif_transpose(img)
+            if crop_box:
+                width, height = img.size
+                img = img.crop((int(crop_box[0] * width), int(crop_box[1] * height),
+                                int(crop_box[2] * width), int(crop_box[3] * height)))
+            img = img.convert('L' if grayscale else 'RGB')
+            # Stretch contrast without shifting hue, so red-ink scores stay red
+            img = ImageOps.autocontrast(img, cutoff=1, preserve_tone=True)
+            if max(img.size) > max_edge:
+                img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            out = io.BytesIO()
+            img.save(out, 'JPEG', quality=OCR_IMAGE_JPEG_QUALITY, optimize=True)
+    except Exception as e:
+        logger.warning("Image preprocessing skipped: {}".format(e))
+        return raw
+    data = out.getvalue()
+    if len(data) >= len(raw) and not (rotated or crop_box or grayscale):
+        return raw
+    return data
+
+def _preprocess_parts(content_parts, options):
+    """Copy of content_parts with every image preprocessed. Returns (parts, bytes_in, bytes_out)."""
+    options = options or {}
+    parts, bytes_in, bytes_out = [], 0, 0
+    for part in content_parts:
+        if isinstance(part, dict) and "data" in part:
+            raw = _image_part_bytes(part)
+            data = _preprocess_image(raw, grayscale=options.get("grayscale", False), crop_box=options.get("crop_box"))
+            bytes_in += len(raw)
+            bytes_out += len(data)
+            part = {"mime_type": "image/jpeg", "data": data}
+        parts.append(part)
+    return (parts, bytes_in, bytes_out)
+
+def _merge_call_stats(total, stats):
+    """Add one call's stats (filled in by _call_gemini_async) into a running batch report."""
+    for field in ("images", "cache_hits", "bytes_in", "bytes_out", "preprocess_ms", "model_ms", "input_tokens", "cached_tokens"):
+        total[field] = total.get(field, 0) + stats.get(field, 0)
+    return total
+
+def _format_batch_report(total, image_count=None, wall_seconds=None):
+    bytes_in = total.get("bytes_in", 0)
+    bytes_out = total.get("bytes_out", 0)
+    report = {
+        "images": total.get("images", 0),
+        "cache_hits": total.get("cache_hits", 0),
+        "image_kb_in": bytes_in // 1024,
+        "image_kb_sent": bytes_out // 1024,
+        "bytes_saved_pct": round(100.0 * (bytes_in - bytes_out) / bytes_in, 1) if bytes_in else 0.0,
+        "preprocess_ms": int(total.get("preprocess_ms", 0)),
+        "model_ms": int(total.get("model_ms", 0)),
+        "input_tokens": total.get("input_tokens", 0),
+        "cached_tokens": total.get("cached_tokens", 0),
+    }
+    if wall_seconds:
+        report["wall_ms"] = int(wall_seconds * 1000)
+        report["images_per_minute"] = round((image_count or 0) * 60.0 / wall_seconds, 1)
+    return report
+
+# ═══════════════════════════════════════════════════════════════
+#  DUPLICATE DETECTION
+#  Perceptual hash (dHash) of every image in a batch, so the same script
+#  photographed twice is OCR'd once and its copies are flagged instead of
+#  producing a second, conflicting score. Photos that are only close (same
+#  printed test paper, different handwriting) are still OCR'd and flagged as
+#  possible duplicates; either way the teacher sees the row and decides.
+# ═══════════════════════════════════════════════════════════════
+import numpy as np
+
+DUPLICATE_HASH_SIZE = 16  # 16x16 gradient grid = 256-bit hash
+DUPLICATE_MAX_DISTANCE = 4  # Max differing bits (of 256) to call two photos the same script and skip OCR
+DUPLICATE_POSSIBLE_DISTANCE = 10  # Max differing bits to flag a photo as a possible duplicate
+
+def _dhash(raw):
+    """256-bit difference hash of an image as a bool array, or None if it can't be decoded."""
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            img.draft('L', (DUPLICATE_HASH_SIZE * 8, DUPLICATE_HASH_SIZE * 8))  # Fast JPEG DCT downscale
+            img = ImageOps.exif_transpose(img).convert('L')
+            small = img.resize((DUPLICATE_HASH_SIZE + 1, DUPLICATE_HASH_SIZE), Image.BILINEAR)
+    except Exception:
+        return None
+    pixels = np.asarray(small, dtype=np.int16)
+    return (pixels[:, 1:] > pixels[:, :-1]).flatten()
+
+def _find_duplicates(images):
+    """Group near-identical photos. images: [(index, raw_bytes)].
+    Returns (duplicates, possible): {duplicate_index: original_index} for photos within
+    DUPLICATE_MAX_DISTANCE (not OCR'd) and for the rest within DUPLICATE_POSSIBLE_DISTANCE
+    (OCR'd, then flagged). The first photo of a group is the original."""
+    indices, hashes = [], []
+    for idx, raw in images:
+        h = _dhash(raw)
+        if h is not None:
+            indices.append(idx)
+            hashes.append(h)
+    if len(hashes) < 2:
+        return ({}, {})
+    stacked = np.stack(hashes)
+    distances = (stacked[:, None, :] != stacked[None, :, :]).sum(axis=2)
+    duplicates, possible = {}, {}
+    for i in range(len(indices)):
+        if indices[i] in duplicates:
+            continue
+        for j in np.nonzero(distances[i, i + 1:] <= DUPLICATE_MAX_DISTANCE)[0] + i + 1:
+            if indices[j] not in duplicates:
+                duplicates[indices[j]] = indices[i]
+    for i in range(len(indices)):
+        if indices[i] in duplicates or indices[i] in possible:
+            continue
+        for j in np.nonzero(distances[i, i + 1:] <= DUPLICATE_POSSIBLE_DISTANCE)[0] + i + 1:
+            if indices[j] not in duplicates and indices[j] not in possible:
+                possible[indices[j]] = indices[i]
+    return (duplicates, possible)
+
+def _duplicate_results(paired_results, duplicates, possible=None):
+    """Copies of each original's result for its duplicates, flagged with duplicate_of.
+    Also flags, in place, results for photos in possible with possible_duplicate_of."""
+    for r in paired_results:
+        if possible and r["index"] in possible:
+            r["result"]["possible_duplicate_of"] = possible[r["index"]]
+    copies = []
+    for r in paired_results:
+        for dup_idx, orig_idx in duplicates.items():
+            if orig_idx == r["index"]:
+                copies.append({"index": dup_idx, "result": dict(r["result"], duplicate_of=orig_idx)})
+    return copies
+
+# ═══════════════════════════════════════════════════════════════
+#  STREAMING JSON DECODER
+#  OCR replies are JSON arrays of row objects. Rows are decoded as the text
+#  streams in, and every complete row survives a truncated or broken reply.
+# ═══════════════════════════════════════════════════════════════
+class JsonArrayDecoder:
+    """Incremental, tolerant decoder for a top-level JSON array of objects fed in pieces.
+    feed() returns the objects the new text completed. Code fences and prose before the
+    array are ignored, including bracketed prose ("Results [see below]:"): the array starts
+    at the first [ followed by { or ]. Decoding stops at the first malformed element (broken=True)."""
+
+    def __init__(self):
+        self.items = []
+        self.closed = False  # Saw the array's closing ]
+        self.broken = False
+        self._buf = ''
+        self._pos = 0
+        self._depth = 0  # 0 = before the array, 1 = between elements, >1 = inside one
+        self._start = None
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text):
+        self._buf += text
+        buf, i, new = self._buf, self._pos, []
+        while i < len(buf) and not (self.closed or self.broken):
+            ch = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif self._depth == 0:
+                if ch == '[':
+                    rest = buf[i + 1:].lstrip()
+                    if not rest:
+                        break  # Can't tell yet whether this [ opens the array; wait for more text
+                    if rest[0] in '{]':
+                        self._depth = 1
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                if self._depth == 1:
+                    self._start = i
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    self.closed = True
+                elif self._depth == 1 and self._start is not None:
+                    try:
+                        obj = json.loads(buf[self._start:i + 1])
+                    except ValueError:
+                        self.broken = True
+                        break
+                    self._start = None
+                    self.items.append(obj)
+                    new.append(obj)
+            i += 1
+        self._pos = i
+        return new
+
+    @property
+    def complete(self):
+        return self.closed and not self.broken
+
+def _salvage_json_array(raw_text):
+    """Decode a JSON array reply, keeping every complete element of a truncated one.
+    Returns (items, complete)."""
+    decoder = JsonArrayDecoder()
+    decoder.feed(raw_text or '')
+    return (decoder.items, decoder.complete)
+
+def _response_parts_text(response):
+    """Text of a response (or stream piece), skipping thinking-mode thought blocks."""
+    raw_text = ''
+    if hasattr(response, 'candidates') and response.candidates:
+        for part in response.candidates[0].content.parts:
+            if hasattr(part, 'thought') and part.thought:
+                continue
+            if hasattr(part, 'text') and part.text:
+                raw_text += part.text
+    return raw_text
+
+# ═══════════════════════════════════════════════════════════════
+#  ROSTER MATCHING ENGINE
+#  OCR names are scored against a roster in one rapidfuzz cdist call (a
+#  names x roster similarity matrix, multi-core for big batches) instead of
+#  a thefuzz extractOne per name. Scores are 0-100 integers like thefuzz's
+#  token_set_ratio, so existing thresholds keep their meaning; names are also
+#  accent-folded first (Adébáyọ̀ = Adebayo), which thefuzz's full_process did.
+#  Single lookups against a whole-school roster go through NameIndex, which
+#  blocks candidates with an inverted index before scoring any of them.
+# ═══════════════════════════════════════════════════════════════
+import itertools
+import unicodedata
+from rapidfuzz import process as rf_process, fuzz as rf_fuzz
+from rapidfuzz.utils import default_process
+
+NAME_MATCH_PARALLEL_CELLS = 20000  # Matrices at least this big are scored on every core
+NAME_AMBIGUITY_MARGIN = 5  # An assigned pair with a rival this close (in points) is reported as ambiguous
+
+def name_processor(name):
+    """Accent-free, lower-case, punctuation-free form of a name for scoring
+    (tone marks and underdots dropped: Adéyẹmí -> adeyemi)."""
+    text = unicodedata.normalize('NFKD', str(name))
+    return default_process(''.join(ch for ch in text if not unicodedata.combining(ch)))
+
+def name_similarity(queries, choices, scorer=rf_fuzz.token_set_ratio):
+    """len(queries) x len(choices) int32 matrix of 0-100 similarity scores."""
+    if not len(queries) or not len(choices):
+        return np.zeros((len(queries), len(choices)), dtype=np.int32)
+    workers = -1 if len(queries) * len(choices) >= NAME_MATCH_PARALLEL_CELLS else 1
+    return rf_process.cdist([str(q) for q in queries], [str(c) for c in choices], scorer=scorer,
+                            processor=name_processor, dtype=np.int32, workers=workers)
+
+def _min_cost_assignment(cost):
+    """Hungarian algorithm (shortest augmenting paths, one row at a time) on an n x m
+    cost matrix with n <= m. Returns the column assigned to each row."""
+    n, m = cost.shape
+    u, v = np.zeros(n + 1), np.zeros(m + 1)
+    owner = np.zeros(m + 1, dtype=np.int64)  # 1-based row holding each column (0 = free); column 0 is the path root
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        owner[0], j0 = i, 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            row = owner[j0]
+            free = ~used
+            free[0] = False
+            reduced = cost[row - 1] - u[row] - v[1:]
+            better = free[1:] & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+            j1 = int(np.argmin(np.where(free, minv, np.inf)))
+            delta = minv[j1]
+            u[owner[used]] += delta
+            v[used] -= delta
+            minv[free] -= delta
+            j0 = j1
+            if owner[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            owner[j0] = owner[j1]
+            j0 = j1
+    assignment = np.full(n, -1, dtype=np.int64)
+    for j in range(1, m + 1):
+        if owner[j]:
+            assignment[owner[j] - 1] = j - 1
+    return assignment
+
+class NameMatcher:
+    """A batch of names scored against a list of choices up front; lookups then read
+    the matrix. best()/top() mirror thefuzz extractOne/extract (ties go to the earlier choice)."""
+
+    def __init__(self, queries, choices, scorer=rf_fuzz.token_set_ratio):
+        self.queries = list(queries)
+        self.choices = list(choices)
+        self.matrix = name_similarity(self.queries, self.choices, scorer)
+        self._rows, self._columns = {}, {}
+        for i, q in enumerate(self.queries):
+            self._rows.setdefault(q, i)
+        for j, c in enumerate(self.choices):
+            self._columns.setdefault(c, []).append(j)
+
+    def _scores(self, query):
+        return self.matrix[self._rows[query]]
+
+    def columns(self, choice):
+        """Indices of every copy of a choice, for clearing it from an `allowed` mask."""
+        return self._columns.get(choice, [])
+
+    def best(self, query, allowed=None):
+        """(choice, score) of the best match among allowed choices, or None if there are none."""
+        scores = self._scores(query)
+        if allowed is not None:
+            scores = np.where(allowed, scores, -1)
+        if not scores.size:
+            return None
+        j = int(np.argmax(scores))
+        return (self.choices[j], int(scores[j])) if scores[j] >= 0 else None
+
+    def top(self, query, limit=3):
+        """Up to `limit` (choice, score) pairs, best first."""
+        scores = self._scores(query)
+        order = np.argsort(-scores, kind='stable')[:limit]
+        return [(self.choices[j], int(scores[j])) for j in order]
+
+    def best_scores(self):
+        """Best score per query (0 when there are no choices)."""
+        return self.matrix.max(axis=1) if self.matrix.size else np.zeros(len(self.queries), dtype=np.int32)
+
+    def assign(self, threshold, rows=None, allowed=None, margin=NAME_AMBIGUITY_MARGIN):
+        """One-to-one pairing of query rows to allowed choices that maximises the total score
+        (so processing order no longer decides who gets a contested name). Pairs under
+        `threshold` stay unmatched. Returns {"pairs": {row: (choice, score)}, "unmatched": [row],
+        "ambiguous": [...]}; ambiguous lists pairs with a rival name or student within `margin`
+        points, and unmatched queries that lost a name they scored at least `threshold` on."""
+        rows = list(range(len(self.queries))) if rows is None else list(rows)
+        columns = np.arange(len(self.choices)) if allowed is None else np.flatnonzero(allowed)
+        result = {"pairs": {}, "unmatched": [], "ambiguous": []}
+        if not rows:
+            return result
+        scores = self.matrix[np.ix_(rows, columns)].astype(np.float64)
+        # Every row also gets a zero-cost "leave unmatched" column, so nobody is forced onto a poor match
+        cost = np.hstack([np.where(scores >= threshold, -scores, 1e9), np.zeros((len(rows), len(rows)))])
+        assignment = _min_cost_assignment(cost)
+
+        strong = scores >= threshold
+        for k, row in enumerate(rows):
+            query = self.queries[row]
+            c = int(assignment[k])
+            if c >= len(columns):
+                result["unmatched"].append(row)
+                if strong[k].any():
+                    best = int(np.argmax(scores[k]))
+                    result["ambiguous"].append({"name": query, "match": None, "score": 0,
+                                                "rival": self.choices[columns[best]], "rival_score": int(scores[k, best])})
+                continue
+            choice, score = self.choices[columns[c]], int(scores[k, c])
+            result["pairs"][row] = (choice, score)
+            near = strong & (scores >= score - margin)
+            rival_choices = [(self.choices[columns[j]], int(scores[k, j])) for j in np.flatnonzero(near[k])
+                             if self.choices[columns[j]] != choice]
+            rival_queries = [(self.queries[rows[i]], int(scores[i, c])) for i in np.flatnonzero(near[:, c])
+                             if self.queries[rows[i]] != query]
+            rival = max(rival_choices + rival_queries, key=lambda r: r[1], default=None)
+            if rival:
+                result["ambiguous"].append({"name": query, "match": choice, "score": score,
+                                            "rival": rival[0], "rival_score": rival[1]})
+        return result
+
+NAME_INDEX_MAX_CANDIDATES = 48  # Names fully scored per lookup, most shared index keys first
+NAME_INDEX_WEIGHTS = {"tri": 1, "tok": 4, "sound": 3, "join": 4, "perm": 12}  # Evidence per shared key kind
+
+# Spelling variants that mean the same sound in Yoruba, Hausa and Igbo names, applied in order
+# to a lower-case, accent-free token before the vowels (the least reliable letters) are dropped
+NAME_PHONETIC_RULES = [
+    (re_mod.compile(r'^(oluwa|chukwu)(?=[a-z]{3})'), ''),  # Oluwaseun/Seun, Chukwuemeka/Emeka
+    (re_mod.compile(r'(?<=[aeiou])(tu|t|h)$'), ''),  # Hausa Aishatu/Aishat/Aishah -> Aisha
+    (re_mod.compile(r'ph'), 'f'),
+    (re_mod.compile(r'kh'), 'k'),  # Khadija/Kadija
+    (re_mod.compile(r'gh'), 'g'),
+    (re_mod.compile(r'sh'), 's'),  # Yoruba ṣ written s or sh: Sade/Shade
+    (re_mod.compile(r'qu'), 'kw'),
+    (re_mod.compile(r'x'), 'ks'),
+    (re_mod.compile(r'y'), 'i'),  # Ayisha/Aisha, Yusuf/Yussuf
+    (re_mod.compile(r'([a-z])\1+'), r'\1'),  # Nnamdi/Namdi, Yussuf/Yusuf
+]
+
+def _name_tokens(name):
+    """Lower-case, accent-free word tokens (see name_processor)."""
+    return name_processor(name).split()
+
+def name_phonetic_key(token):
+    """Sound key for one name token: variant spellings folded, then first letter plus consonants."""
+    for pattern, replacement in NAME_PHONETIC_RULES:
+        token = pattern.sub(replacement, token)
+    return token[:1] + re_mod.sub(r'[aeiou]', '', token[1:]) if token else ''
+
+def _name_keys(tokens, query=False):
+    """Index keys for a tokenised name. Names are indexed under their tokens, token sounds,
+    padded trigrams, tokens glued in pairs (Abdul Rahman / Abdulrahman) and the sorted full
+    name, so surname-first and given-name-first spellings share keys. Queries also look
+    their glued pairs up as tokens and their tokens up as glued pairs."""
+    keys = set()
+    for token in tokens:
+        keys.add(("tok", token))
+        keys.add(("sound", name_phonetic_key(token)))
+        padded = "  {} ".format(token)
+        keys.update(("tri", padded[k:k + 3]) for k in range(len(padded) - 2))
+        if query:
+            keys.add(("join", token))
+    for a, b in itertools.permutations(tokens[:4], 2):
+        keys.add(("tok" if query else "join", a + b))
+    if tokens:
+        keys.add(("perm", " ".join(sorted(tokens))))
+    return keys
+
+class NameIndex:
+    """Inverted index over a roster for one-name-at-a-time lookups at whole-school scale.
+    A lookup counts shared keys with one bincount, fully scores only the best-supported
+    NAME_INDEX_MAX_CANDIDATES names, and returns the same token_set_ratio scores as NameMatcher.
+    groups: optional label per name (e.g. its class), returned by lookup()."""
+
+    def __init__(self, names, groups=None):
+        self.names = [str(n) for n in names]
+        self.groups = list(groups) if groups is not None else [None] * len(self.names)
+        self._exact = {}
+        postings = {}
+        for position, name in enumerate(self.names):
+            self._exact.setdefault(name, position)
+            for key in _name_keys(_name_tokens(name)):
+                postings.setdefault(key, []).append(position)
+        self._postings = {key: np.array(p, dtype=np.int32) for key, p in postings.items()}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._exact
+
+    def candidates(self, query):
+        """Positions of the names sharing the most weighted keys with the query (unordered)."""
+        hits = [(self._postings[key], NAME_INDEX_WEIGHTS[key[0]]) for key in _name_keys(_name_tokens(query), query=True)
+                if key in self._postings]
+        if not hits:
+            return np.zeros(0, dtype=np.int64)
+        positions = np.concatenate([p for p, _ in hits])
+        weights = np.concatenate([np.full(len(p), w, dtype=np.float64) for p, w in hits])
+        support = np.bincount(positions, weights=weights, minlength=len(self.names))
+        found = np.flatnonzero(support)
+        if len(found) > NAME_INDEX_MAX_CANDIDATES:
+            found = found[np.argpartition(-support[found], NAME_INDEX_MAX_CANDIDATES - 1)[:NAME_INDEX_MAX_CANDIDATES]]
+        return found
+
+    def lookup(self, query, limit=3):
+        """Up to `limit` (name, score, group) triples, best first (ties go to the earlier roster entry)."""
+        query = str(query)
+        if query in self._exact:
+            found = np.union1d(self.candidates(query), [self._exact[query]])
+        else:
+            found = np.sort(self.candidates(query))
+        if not len(found):
+            return []
+        scores = name_similarity([query], [self.names[p] for p in found])[0]
+        order = np.argsort(-scores, kind='stable')[:limit]
+        return [(self.names[found[k]], int(scores[k]), self.groups[found[k]]) for k in order]
+
+    def best(self, query):
+        """(name, score) of the best match, or None - like NameMatcher.best over the whole roster."""
+        found = self.lookup(query, limit=1)
+        return found[0][:2] if found else None
+
+    def top(self, query, limit=3):
+        """Up to `limit` (name, score) pairs with distinct names, best first."""
+        pairs, seen = [], set()
+        for name, score, _ in self.lookup(query, limit=limit * 2):
+            if name not in seen:
+                seen.add(name)
+                pairs.append((name, score))
+        return pairs[:limit]
+
+# ═══════════════════════════════════════════════════════════════
+#  AI TELEMETRY
+#  One record per model call (endpoint, model, key, attempts, images, bytes,
+#  tokens, queue wait, latency, outcome) in an in-process ring buffer, with
+#  per-endpoint / per-model / per-key aggregates at /api/ai-telemetry.
+# ═══════════════════════════════════════════════════════════════
+AI_TELEMETRY_BUFFER = 2000  # Most recent calls kept for /api/ai-telemetry
+
+def _ai_error_kind(exc):
+    """'rate_limited', 'timeout', 'error', or the gateway's 'circuit_open'/'busy'/'queue_timeout', for an exception from a model call."""
+    if isinstance(exc, AIUnavailableError):
+        return exc.kind
+    err_str = str(exc).lower()
+    if 'quota' in err_str or 'rate' in err_str or '429' in err_str or 'resource' in err_str:
+        return 'rate_limited'
+    if 'deadline' in err_str or 'timeout' in err_str or 'timed out' in err_str or '504' in err_str:
+        return 'timeout'
+    return 'error'
+
+class AITelemetry:
+    """Ring buffer of per-call records plus aggregate views. Thread-safe."""
+
+    def __init__(self, size):
+        self._lock = threading.Lock()
+        self._records = deque(maxlen=size)
+        self.total_calls = 0
+
+    def record(self, entry):
+        with self._lock:
+            self._records.append(entry)
+            self.total_calls += 1
+
+    def recent(self, limit=50, endpoint=None):
+        with self._lock:
+            records = list(self._records)
+        if endpoint:
+            records = [r for r in records if r["endpoint"] == endpoint]
+        return records[max(0, len(records) - limit):][::-1]
+
+    @staticmethod
+    def _summarize(records):
+        latencies = [r["total_ms"] for r in records]
+        waits = [r["queue_ms"] for r in records]
+        outcomes = {}
+        for r in records:
+            outcomes[r["outcome"]] = outcomes.get(r["outcome"], 0) + 1
+        return {
+            "calls": len(records),
+            "outcomes": outcomes,
+            "attempts": sum(r["attempts"] for r in records),
+            "rate_limited_attempts": sum(r["rate_limited"] for r in records),
+            "images": sum(r["images"] for r in records),
+            "image_kb_sent": sum(r["bytes_out"] for r in records) // 1024,
+            "prompt_tokens": sum(r["prompt_tokens"] for r in records),
+            "output_tokens": sum(r["output_tokens"] for r in records),
+            "cached_tokens": sum(r["cached_tokens"] for r in records),
+            "latency_ms": {p: int(np.percentile(latencies, p)) for p in (50, 95, 99)} if latencies else {},
+            "queue_wait_ms": {p: int(np.percentile(waits, p)) for p in (50, 95, 99)} if waits else {},
+        }
+
+    def aggregate(self):
+        with self._lock:
+            records = list(self._records)
+        views = {}
+        for field in ("endpoint", "model", "key"):
+            groups = {}
+            for r in records:
+                groups.setdefault(str(r[field]), []).append(r)
+            views["by_" + field] = {name: self._summarize(group) for name, group in groups.items()}
+        views["overall"] = self._summarize(records)
+        views["buffered_calls"] = len(records)
+        views["total_calls"] = self.total_calls
+        return views
+
+_ai_telemetry = AITelemetry(AI_TELEMETRY_BUFFER)
+
+def _current_endpoint():
+    """Flask endpoint of the request being served, or None off-request (background workers)."""
+    from flask import has_request_context
+    return request.endpoint if has_request_context() else None
+
+# ═══════════════════════════════════════════════════════════════
+#  AI GATEWAY
+#  Every model request passes a per-model circuit breaker, a global in-flight
+#  cap and the caller's deadline. Each HTTP request gets one deadline, set
+#  below gunicorn's 160s worker timeout, so retries stop in time to answer
+#  with a friendly error instead of the worker being killed.
+# ═══════════════════════════════════════════════════════════════
+AI_MAX_IN_FLIGHT = int(os.getenv("GEMINI_MAX_IN_FLIGHT", "12"))  # Model requests in flight across all keys
+AI_REQUEST_DEADLINE_SECONDS = float(os.getenv("GEMINI_REQUEST_DEADLINE", "140"))  # gunicorn kills workers at 160s
+AI_MIN_ATTEMPT_SECONDS = 5.0  # Don't start (or retry) an attempt with less time than this left
+AI_BREAKER_FAILURES = 5  # Consecutive provider failures (5xx, timeouts) that open a model's breaker
+AI_BREAKER_COOLDOWN_SECONDS = 30  # Open breakers fail fast this long, then let one probe through
+
+class AIUnavailableError(Exception):
+    """The gateway refused or gave up on a call. The message is safe to show a teacher.
+    kind: 'circuit_open', 'busy', 'queue_timeout' or 'timeout'."""
+
+    def __init__(self, message, kind, retry_after=None):
+        super().__init__(message)
+        self.kind = kind
+        self.retry_after = retry_after
+
+class AISchedulerTimeoutError(AIUnavailableError):
+    """Every key stayed over its configured budget for the whole queue wait. Raised by the
+    key scheduler before anything was sent, so it is not a provider 429 and benches no key."""
+
+    def __init__(self):
+        super().__init__("The AI is busy with other requests. Please try again in a minute.", 'queue_timeout', retry_after=60)
+
+def _is_provider_fault(exc):
+    """True for failures that say the provider is unhealthy (not our request, not quota)."""
+    if isinstance(exc, asyncio.TimeoutError):
+        return True
+    err_str = str(exc).lower()
+    return _ai_error_kind(exc) == 'timeout' or any(s in err_str for s in (
+        '500', '502', '503', 'internal', 'unavailable', 'overloaded', 'connection', 'reset by peer'))
+
+class CircuitBreaker:
+    """Closed → open after AI_BREAKER_FAILURES consecutive provider faults → half-open
+    after the cooldown (one probe call) → closed on success. Thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.opens = 0
+        self.rejected = 0
+
+    def allow(self):
+        """Raise AIUnavailableError while open; in half-open, admit a single probe.
+        Returns True when the caller is that probe."""
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.opened_at + AI_BREAKER_COOLDOWN_SECONDS - time.monotonic()
+            if remaining <= 0 and not self.probing:
+                self.probing = True
+                return True
+            self.rejected += 1
+        raise AIUnavailableError("The AI service isn't responding right now. Please try again in about {} seconds.".format(
+            max(5, int(remaining) + 1)), 'circuit_open', retry_after=max(5, int(remaining) + 1))
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.failures, self.opened_at, self.probing = 0, None, False
+                return
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= AI_BREAKER_FAILURES):
+                if self.opened_at is None:
+                    self.opens += 1
+                    logger.warning("AI circuit breaker opened after {} provider failures".format(self.failures))
+                self.opened_at, self.probing = time.monotonic(), False
+
+    def release_probe(self):
+        """A probe ended without a verdict (cancelled, client error): let another one through."""
+        with self._lock:
+            self.probing = False
+
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half_open' if self.probing or time.monotonic() - self.opened_at >= AI_BREAKER_COOLDOWN_SECONDS else 'open'
+
+class AIGateway:
+    """Breakers per model plus the global in-flight cap. Slots are asyncio.Semaphore
+    permits on the AI event loop (recreated if the loop is replaced after a fork)."""
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._semaphore = None
+        self._semaphore_loop = None
+        self.in_flight = 0
+        self.busy_rejections = 0
+        self.deadline_stops = 0
+
+    def breaker(self, model_name):
+        with self._lock:
+            return self._breakers.setdefault(model_name, CircuitBreaker())
+
+    async def acquire(self, timeout):
+        """Take an in-flight slot, waiting at most timeout seconds."""
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore, self._semaphore_loop = asyncio.Semaphore(self.max_in_flight), loop
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=max(0.0, timeout))
+        except asyncio.TimeoutError:
+            self.busy_rejections += 1
+            raise AIUnavailableError("The AI is busy with other requests. Please try again in a minute.", 'busy', retry_after=60)
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "busy_rejections": self.busy_rejections,
+            "deadline_stops": self.deadline_stops,
+            "deadline_seconds": AI_REQUEST_DEADLINE_SECONDS,
+            "breakers": {name: {"state": b.state(), "failures": b.failures, "opens": b.opens, "rejected": b.rejected}
+                         for name, b in breakers.items()},
+        }
+
+_ai_gateway = AIGateway(AI_MAX_IN_FLIGHT)
+
+def _ai_deadline():
+    """Monotonic deadline for a model call: the current request's (see _start_ai_deadline), or a fresh one off-request."""
+    from flask import g, has_request_context
+    if has_request_context() and getattr(g, 'ai_deadline', None):
+        return g.ai_deadline
+    return time.monotonic() + AI_REQUEST_DEADLINE_SECONDS
+
+def _deadline_error():
+    _ai_gateway.deadline_stops += 1
+    return AIUnavailableError("The AI is taking too long to respond. Please try again in a minute.", 'timeout', retry_after=60)
+
+# ═══════════════════════════════════════════════════════════════
+#  AI EVENT LOOP
+#  All Gemini calls run as coroutines on one background event loop, so a
+#  batch can keep (keys x AI_CONCURRENCY_PER_KEY) calls in flight without
+#  an OS thread per call. Request threads submit work and wait on futures.
+# ═══════════════════════════════════════════════════════════════
+_ai_loop = None
+_ai_loop_pid = None
+_ai_loop_lock = threading.Lock()
+
+def _get_ai_loop():
+    """The process's AI event loop, started on first use (and again after a fork)."""
+    global _ai_loop, _ai_loop_pid
+    with _ai_loop_lock:
+        if _ai_loop is None or _ai_loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="ai-event-loop", daemon=True).start()
+            _ai_loop, _ai_loop_pid = loop, os.getpid()
+            # Async clients are tied to the loop they were created on — drop any from a parent process
+            with _key_clients_lock:
+                _key_clients.clear()
+        return _ai_loop
+
+def _ai_fanout_capacity():
+    """How many calls a fan-out keeps in flight: every key at its concurrency cap, within the gateway's cap."""
+    return min(max(1, len(API_KEYS)) * AI_CONCURRENCY_PER_KEY, AI_MAX_IN_FLIGHT)
+
+def _is_json_text(raw_text):
+    try:
+        json.loads(_strip_json_fences(raw_text))
+        return True
+    except ValueError:
+        return False
+
+async def _gemini_with_retries(model_name, content_parts, retries, generation_config, stats, on_item=None, deadline=None):
+    """Send one request (with key rotation/retries) and return the response text. Raises on total failure.
+    With on_item, the reply is streamed and on_item(position, obj) is called for each array
+    element as it decodes; a retry does not repeat positions already delivered.
+    Each attempt goes through the AI gateway (breaker, in-flight cap) and stops at deadline."""
+    est_tokens = _estimate_tokens(content_parts)
+    deadline = deadline or time.monotonic() + AI_REQUEST_DEADLINE_SECONDS
+    breaker = _ai_gateway.breaker(model_name)
     last_error = None
+    delivered = 0
     for attempt in range(retries):
+        if deadline - time.monotonic() < AI_MIN_ATTEMPT_SECONDS:
+            if isinstance(last_error, AIUnavailableError):
+                raise last_error
+            raise _deadline_error() from last_error
+        probe = breaker.allow()
+        # Waits while every key is saturated; raises if the queue wait runs too long
+        queued_at = time.monotonic()
+        try:
+            key_index = await _key_scheduler.acquire(est_tokens, max_wait=min(
+                AI_SCHEDULER_MAX_WAIT_SECONDS, deadline - queued_at - AI_MIN_ATTEMPT_SECONDS))
+            try:
+                await _ai_gateway.acquire(deadline - time.monotonic() - AI_MIN_ATTEMPT_SECONDS)
+            except BaseException:
+                _key_scheduler.release(key_index)
+                raise
+        except BaseException:
+            if probe:
+                breaker.release_probe()
+            raise
+        stats["queue_ms"] = stats.get("queue_ms", 0) + (time.monotonic() - queued_at) * 1000
+        stats["attempts"] = stats.get("attempts", 0) + 1
+        stats["key"] = key_index
+        verdict = None  # Breaker outcome: True ok, False provider fault, None no verdict
         try:
-            model = genai.GenerativeModel(model_name)
-            response = model.generate_content(content_parts)
+            model = _model_for_key(model_name, key_index, generation_config)
+            started = time.monotonic()
+
+            async def send():
+                nonlocal delivered
+                request_parts = content_parts
+                if content_parts and isinstance(content_parts[0], PromptPrefix):
+                    cached_name = await _provider_context_cache(content_parts[0], model_name, key_index)
+                    if cached_name:
+                        _use_cached_content(model, cached_name)
+                        request_parts = content_parts[1:]
+                    else:
+                        request_parts = [content_parts[0].text] + list(content_parts[1:])
+                if on_item is None:
+                    return await model.generate_content_async(request_parts)
+                response = await model.generate_content_async(request_parts, stream=True)
+                decoder = JsonArrayDecoder()
+                async for piece in response:
+                    for obj in decoder.feed(_response_parts_text(piece)):
+                        position = len(decoder.items) - 1
+                        if position >= delivered:
+                            on_item(position, obj)
+                            delivered += 1
+                return response
+
+            try:
+                response = await asyncio.wait_for(send(), timeout=deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                raise _deadline_error()
+            stats["model_ms"] = stats.get("model_ms", 0) + (time.monotonic() - started) * 1000
+            verdict = True
+            usage = getattr(response, 'usage_metadata', None)
+            _key_scheduler.settle(key_index, est_tokens, getattr(usage, 'total_token_count', 0) if usage else 0)
+            if usage:
+                stats["input_tokens"] = getattr(usage, 'prompt_token_count', 0) or 0
+                stats["output_tokens"] = getattr(usage, 'candidates_token_count', 0) or 0
+                stats["cached_tokens"] = getattr(usage, 'cached_content_token_count', 0) or 0
+            _key_scheduler.report_success(key_index)
             # Extract text — handle thinking mode responses (skip thought blocks)
-            raw_text = ''
-            if hasattr(response, 'candidates') and response.candidates:
-                for part in response.candidates[0].content.parts:
-                    if hasattr(part, 'thought') and part.thought:
-                        continue
-                    if hasattr(part, 'text') and part.text:
-                        raw_text += part.text
+            raw_text = _response_parts_text(response)
             if not raw_text:
                 raw_text = response.text.strip()
             raw_text = raw_text.strip()
@@ -100,16 +1451,270 @@ def _call_gemini(model_name, content_parts, max_retries=None):
             last_error = err
             err_str = str(err).lower()
             logger.warning("Gemini {} attempt {}/{} failed: {}".format(model_name, attempt + 1, retries, err))
+            if verdict is None and _is_provider_fault(err):
+                verdict = False
             if 'quota' in err_str or 'rate' in err_str or '429' in err_str or 'resource' in err_str:
-                rotate_api_key()
-                if attempt < retries - 1:
-                    wait = AI_BACKOFF_SECONDS[min(attempt, len(AI_BACKOFF_SECONDS) - 1)]
-                    logger.info("Rate limited — waiting {}s before retry...".format(wait))
-                    time.sleep(wait)
-            else:
+                stats["rate_limited"] = stats.get("rate_limited", 0) + 1
+                # The scheduler steers the retry to another key, or queues it until budget refills
+                _key_scheduler.report_rate_limited(key_index)
+            elif not (_key_scheduler.report_error(key_index, err) and len(API_KEYS) > 1):
                 break  # Non-rate-limit error, don't retry
+        finally:
+            _ai_gateway.release()
+            _key_scheduler.release(key_index)
+            if verdict is not None:
+                breaker.record(verdict)
+            elif probe:
+                breaker.release_probe()
     raise last_error or Exception("All AI attempts failed")
 
+# ═══════════════════════════════════════════════════════════════
+#  HEDGED REQUESTS
+#  A JSON call still running past the model's recent latency percentile gets
+#  a second, parallel request (fallback model or another key). The first valid
+#  JSON wins and the other request is cancelled.
+# ═══════════════════════════════════════════════════════════════
+AI_HEDGE_MODE = os.getenv("GEMINI_HEDGE_MODE", "fallback")  # off | fallback (other model) | key (same model, another key)
+AI_HEDGE_PERCENTILE = 90  # Hedge calls slower than this percentile of recent calls
+AI_HEDGE_MIN_SAMPLES = 20  # Recent calls needed before hedging kicks in
+AI_HEDGE_MIN_DELAY_SECONDS = 4.0
+
+class LatencyTracker:
+    """Sliding window of successful call latencies per (model, size bucket). Thread-safe."""
+
+    def __init__(self, window=200):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self.window = window
+
+    @staticmethod
+    def bucket(content_parts):
+        images = sum(1 for p in content_parts if isinstance(p, dict) and "data" in p)
+        return 0 if images == 0 else 1 if images == 1 else 5 if images <= 5 else 10
+
+    def record(self, model_name, bucket, seconds):
+        with self._lock:
+            samples = self._samples.setdefault((model_name, bucket), deque(maxlen=self.window))
+            samples.append(seconds)
+
+    def percentile(self, model_name, bucket, pct):
+        """pct-th percentile latency in seconds, or None until there are enough samples."""
+        with self._lock:
+            samples = list(self._samples.get((model_name, bucket), ()))
+        if len(samples) < AI_HEDGE_MIN_SAMPLES:
+            return None
+        return float(np.percentile(samples, pct))
+
+    def stats(self):
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._samples.items()]
+        return {
+            "{}/{}img".format(model, bucket): {
+                "n": len(v),
+                "p50": round(float(np.percentile(v, 50)), 2),
+                "p90": round(float(np.percentile(v, 90)), 2),
+                "p99": round(float(np.percentile(v, 99)), 2),
+            } for (model, bucket), v in items if v
+        }
+
+_latency = LatencyTracker()
+_hedge_stats = {"hedged": 0, "hedge_wins": 0, "primary_wins": 0, "both_failed": 0}
+
+_SUMMED_CALL_STATS = ("attempts", "rate_limited", "queue_ms", "model_ms")
+
+async def _timed_attempts(model_name, content_parts, retries, generation_config, stats, bucket, on_item=None, deadline=None):
+    """_gemini_with_retries, recording model time (not scheduler queue wait) as the call's latency.
+    Returns (raw_text, model_name). Fills its own stats, folded into stats when it ends,
+    so a racing hedge doesn't add its timings to this call's sample."""
+    own = {}
+    try:
+        raw_text = await _gemini_with_retries(model_name, content_parts, retries, generation_config, own, on_item, deadline)
+        _latency.record(model_name, bucket, own.get("model_ms", 0) / 1000.0)
+        return raw_text, model_name
+    finally:
+        for name, value in own.items():
+            stats[name] = stats.get(name, 0) + value if name in _SUMMED_CALL_STATS else value
+
+async def _hedged_gemini(model_name, content_parts, retries, generation_config, stats, expect_json, on_item=None, deadline=None):
+    """Run the call; if it outlives the latency percentile, race a hedge request against it.
+    Returns (raw_text, model that produced it). Streamed calls (on_item) are never hedged:
+    their rows are already reaching the caller. Neither are calls while every key is busy,
+    since the hedge would only queue behind the primary."""
+    bucket = LatencyTracker.bucket(content_parts)
+    primary = asyncio.ensure_future(_timed_attempts(model_name, content_parts, retries, generation_config, stats, bucket, on_item, deadline))
+    delay = _latency.percentile(model_name, bucket, AI_HEDGE_PERCENTILE)
+    if AI_HEDGE_MODE == "off" or not expect_json or delay is None or on_item is not None:
+        return await primary
+    delay = max(delay, AI_HEDGE_MIN_DELAY_SECONDS)
+    try:
+        await asyncio.wait_for(asyncio.shield(primary), timeout=delay)
+    except asyncio.TimeoutError:
+        pass
+    except asyncio.CancelledError:
+        primary.cancel()
+        raise
+    except Exception:
+        pass  # Primary failed outright; its error is raised below
+    if primary.done() or not _key_scheduler.has_capacity(_estimate_tokens(content_parts)):
+        return await primary
+
+    # Thinking configs are model specific, so those calls hedge on the same model via another key
+    hedge_model = AI_MODEL_FALLBACK if AI_HEDGE_MODE == "fallback" and generation_config is None else model_name
+    hedge = asyncio.ensure_future(_timed_attempts(hedge_model, content_parts, retries, generation_config, stats, bucket, deadline=deadline))
+    _hedge_stats["hedged"] += 1
+    stats["hedged"] = 1
+    logger.info("Hedging slow {} call ({:.1f}s) with {}".format(model_name, delay, hedge_model))
+    pending = {primary: "primary_wins", hedge: "hedge_wins"}
+    last_error, unparsed_text = None, None
+    try:
+        while pending:
+            done, _ = await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                outcome = pending.pop(task)
+                try:
+                    raw_text, used_model = task.result()
+                except Exception as err:
+                    last_error = err
+                    continue
+                if _is_json_text(raw_text):
+                    _hedge_stats[outcome] += 1
+                    return raw_text, used_model
+                unparsed_text = unparsed_text or (raw_text, used_model)
+        _hedge_stats["both_failed"] += 1
+        if unparsed_text is not None:
+            return unparsed_text
+        raise last_error or Exception("All AI attempts failed")
+    finally:
+        for task in pending:
+            task.cancel()
+
+def _hedge_report():
+    return dict(_hedge_stats, mode=AI_HEDGE_MODE, percentile=AI_HEDGE_PERCENTILE, latency=_latency.stats())
+
+async def _call_gemini_async(model_name, content_parts, max_retries=None, generation_config=None, use_cache=True, expect_json=False,
+                             preprocess=None, stats=None, on_item=None, endpoint=None, deadline=None):
+    """Coroutine behind _call_gemini. Runs on the AI event loop.
+    preprocess: image preprocessing options ({"grayscale", "crop_box"}), or False to send images as-is.
+    stats: optional dict filled with images/bytes/latency for batch reports.
+    on_item: stream the reply, calling on_item(position, obj) per decoded array element
+    (from the AI loop thread). Cache hits are returned whole, without on_item calls.
+    endpoint: label for the telemetry record (set by _submit_gemini).
+    deadline: time.monotonic() value after which no attempt is started or awaited (see AI GATEWAY)."""
+    stats = {} if stats is None else stats
+    started = time.monotonic()
+    outcome, error = 'ok', None
+    try:
+        cache_key, image_bytes = OCRResultCache.make_key(model_name, content_parts, generation_config, preprocess) if use_cache else (None, 0)
+        if cache_key:
+            cached = _ocr_cache.get(cache_key, image_bytes)
+            if cached is not None:
+                logger.info("OCR cache hit ({} KB of images skipped)".format(image_bytes // 1024))
+                stats["cache_hits"] = 1
+                outcome = 'cache_hit'
+                return cached
+
+        original_parts = content_parts
+        if preprocess is not False and any(isinstance(p, dict) and "data" in p for p in content_parts):
+            prep_started = time.monotonic()
+            content_parts, bytes_in, bytes_out = await asyncio.get_running_loop().run_in_executor(
+                _image_executor, _preprocess_parts, content_parts, preprocess)
+            stats["images"] = sum(1 for p in content_parts if isinstance(p, dict) and "data" in p)
+            stats["bytes_in"] = bytes_in
+            stats["bytes_out"] = bytes_out
+            stats["preprocess_ms"] = (time.monotonic() - prep_started) * 1000
+
+        raw_text, used_model = await _hedged_gemini(model_name, content_parts, max_retries or AI_MAX_RETRIES, generation_config, stats, expect_json, on_item, deadline)
+        # A fallback-model hedge win is cached under the fallback model, never as the primary's answer
+        if cache_key and used_model != model_name:
+            cache_key = OCRResultCache.make_key(used_model, original_parts, generation_config, preprocess)[0]
+        # With expect_json, only responses that parse are cached
+        if cache_key and (not expect_json or _is_json_text(raw_text)):
+            _ocr_cache.put(cache_key, used_model, raw_text)
+        return raw_text
+    except asyncio.CancelledError:
+        outcome = 'cancelled'
+        raise
+    except Exception as exc:
+        outcome, error = _ai_error_kind(exc), str(exc)[:200]
+        raise
+    finally:
+        _ai_telemetry.record({
+            "ts": round(time.time(), 3),
+            "endpoint": endpoint or "unknown",
+            "model": model_name,
+            "key": stats.get("key"),
+            "attempts": stats.get("attempts", 0),
+            "rate_limited": stats.get("rate_limited", 0),
+            "images": stats.get("images", sum(1 for p in content_parts if isinstance(p, dict) and "data" in p)),
+            "bytes_in": stats.get("bytes_in", 0),
+            "bytes_out": stats.get("bytes_out", 0),
+            "prompt_tokens": stats.get("input_tokens", 0),
+            "output_tokens": stats.get("output_tokens", 0),
+            "cached_tokens": stats.get("cached_tokens", 0),
+            "preprocess_ms": int(stats.get("preprocess_ms", 0)),
+            "queue_ms": int(stats.get("queue_ms", 0)),
+            "model_ms": int(stats.get("model_ms", 0)),
+            "total_ms": int((time.monotonic() - started) * 1000),
+            "streamed": on_item is not None,
+            "hedged": bool(stats.get("hedged")),
+            "outcome": outcome,
+            "error": error,
+        })
+
+def _submit_gemini(model_name, content_parts, **kwargs):
+    """Schedule a Gemini call on the AI event loop. Returns a concurrent.futures.Future."""
+    kwargs.setdefault("endpoint", _current_endpoint() or threading.current_thread().name)
+    kwargs.setdefault("deadline", _ai_deadline())
+    return asyncio.run_coroutine_threadsafe(_call_gemini_async(model_name, content_parts, **kwargs), _get_ai_loop())
+
+def _call_gemini(model_name, content_parts, max_retries=None, generation_config=None, use_cache=True, expect_json=False, preprocess=None):
+    """Centralized Gemini API caller with retry, rotation, and timeout.
+    Image-bearing calls are served from the OCR result cache when possible,
+    and images are preprocessed (see _preprocess_image) on a cache miss.
+    With expect_json=True, only responses that parse as JSON are cached.
+    Returns raw_text on success, raises on total failure."""
+    return _submit_gemini(model_name, content_parts, max_retries=max_retries, generation_config=generation_config,
+                          use_cache=use_cache, expect_json=expect_json, preprocess=preprocess).result()
+
+def _gemini_fanout(calls, concurrency=None, submit=_submit_gemini, events=None):
+    """Run [(tag, *args, call_kwargs)] through submit(*args, **call_kwargs) (default: a
+    Gemini call) with at most `concurrency` in flight. Yields (tag, result, error) as
+    each call lands. Anything else put on `events` (a queue.Queue shared with the
+    calls, e.g. streamed rows) is yielded as-is, in arrival order."""
+    limit = concurrency or _ai_fanout_capacity()
+    queued = iter(calls)
+    events = events or queue.Queue()
+    futures = {}
+
+    def submit_next():
+        for call in queued:
+            future = submit(*call[1:-1], **call[-1])
+            futures[future] = call[0]
+            future.add_done_callback(events.put)
+            return True
+        return False
+
+    try:
+        while len(futures) < limit and submit_next():
+            pass
+        while futures:
+            event = events.get()
+            if not isinstance(event, ConcurrentFuture):
+                yield event
+                continue
+            tag = futures.pop(event, None)
+            if tag is None:
+                continue
+            submit_next()  # Keep the window full while the caller handles this result
+            try:
+                yield (tag, event.result(), None)
+            except Exception as exc:
+                yield (tag, None, exc)
+    finally:
+        # Client went away (generator closed) — stop anything still queued or running
+        for future in futures:
+            future.cancel()
+
 # Configure with the first key
 genai.configure(api_key=get_current_api_key())
 
@@ -125,6 +1730,12 @@ CORS(app, origins=_allowed_origins)
 
 app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
 
+@app.before_request
+def _start_ai_deadline():
+    """Every model call a request makes shares one deadline (see AI GATEWAY)."""
+    from flask import g
+    g.ai_deadline = time.monotonic() + AI_REQUEST_DEADLINE_SECONDS
+
 # Configure Database
 db_url = os.getenv("DATABASE_URL")
 if db_url and db_url.startswith("postgres://"):
@@ -171,6 +1782,202 @@ class ScoreModel(db.Model):
     term = db.Column(db.String(20), default='1st Term', server_default='1st Term')
     student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
 
+class BatchJobModel(db.Model):
+    __tablename__ = 'batch_jobs'
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    status = db.Column(db.String(20), default='pending', index=True)  # pending, running, done, failed
+    params_json = db.Column(db.Text, nullable=False)  # targetClass, targetClasses, smartInstruction
+    total_images = db.Column(db.Integer, default=0)
+    total_chunks = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)
+    chunks = db.relationship('BatchChunkModel', backref='job_obj', lazy=True, cascade="all, delete-orphan")
+
+class BatchChunkModel(db.Model):
+    __tablename__ = 'batch_chunks'
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(32), db.ForeignKey('batch_jobs.id'), nullable=False, index=True)
+    chunk_index = db.Column(db.Integer, nullable=False)
+    image_indices = db.Column(db.Text, nullable=False)  # JSON list of global image indices
+    status = db.Column(db.String(20), default='pending', index=True)  # pending, running, done, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    lease_owner = db.Column(db.Integer)  # PID of the worker process running it
+    lease_until = db.Column(db.Float)
+    results_json = db.Column(db.Text)
+    error = db.Column(db.Text)
+
+# Roster version: bumped whenever a class or student row changes, so caches built
+# from rosters (prompt prefixes, name lookups) know when to rebuild.
+# Scores version: the same for score rows (assistant DB snapshot).
+# Both move at the flush and again when the transaction ends, so nothing another
+# thread cached in between (rows it could not see yet) outlives the commit.
+from sqlalchemy import event
+_roster_version = 0
+_scores_version = 0
+_version_lock = threading.Lock()
+
+def roster_version():
+    return _roster_version
+
+def scores_version():
+    return _scores_version
+
+def _bump_roster_version():
+    global _roster_version
+    with _version_lock:
+        _roster_version += 1
+
+def _bump_scores_version():
+    global _scores_version
+    with _version_lock:
+        _scores_version += 1
+
+def _note_changes(session, roster, scores):
+    if roster:
+        session.info["roster_changed"] = True
+        _bump_roster_version()
+    if scores:
+        session.info["scores_changed"] = True
+        _bump_scores_version()
+
+@event.listens_for(db.session, "after_flush")
+def _roster_changed_on_flush(session, flush_context):
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    _note_changes(session, any(isinstance(obj, (ClassModel, StudentModel)) for obj in changed),
+                  any(isinstance(obj, ScoreModel) for obj in changed))
+
+@event.listens_for(db.session, "do_orm_execute")
+def _roster_changed_on_bulk(orm_execute_state):
+    # query.update()/query.delete() skip the flush, so catch them here
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and orm_execute_state.bind_mapper is not None:
+        model = orm_execute_state.bind_mapper.class_
+        _note_changes(orm_execute_state.session, model in (ClassModel, StudentModel), model is ScoreModel)
+
+@event.listens_for(db.session, "after_commit")
+@event.listens_for(db.session, "after_rollback")
+def _roster_changed_on_end(session):
+    if session.info.pop("roster_changed", False):
+        _bump_roster_version()
+    if session.info.pop("scores_changed", False):
+        _bump_scores_version()
+
+# ═══════════════════════════════════════════════════════════════
+#  ROSTER CACHE
+#  Class names and per-class rosters (student ids, names, normalized names
+#  and a NameIndex) loaded from the DB once per roster version and shared by
+#  every request thread. Hot paths read rosters from here; anything that
+#  writes students still goes through the ORM, which moves the version.
+# ═══════════════════════════════════════════════════════════════
+def roster_name_key(name):
+    """Case- and spacing-insensitive form of a student name."""
+    return ' '.join(str(name).split()).lower()
+
+class ClassRoster:
+    """One class's students as of a roster version, in id order. Read-only; the
+    NameIndex is built on first use."""
+
+    def __init__(self, class_id, class_name, students):
+        self.id = class_id
+        self.name = class_name
+        self.ids = [s[0] for s in students]
+        self.names = [s[1] for s in students]
+        self.normalized = [roster_name_key(n) for n in self.names]
+        self._by_key = {}
+        for student_id, key in zip(self.ids, self.normalized):
+            self._by_key.setdefault(key, student_id)
+        self._names = set(self.names)
+        self._index = None
+        self._index_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def find(self, name):
+        """Student id for a name, ignoring case and spacing, or None."""
+        return self._by_key.get(roster_name_key(name))
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._index_lock:
+                if self._index is None:
+                    self._index = NameIndex(self.names, [self.name] * len(self.names))
+        return self._index
+
+class RosterCache:
+    """Roster data keyed by roster_version(); everything is dropped when the version moves.
+    Loads run outside the lock, and a load is only kept if the version did not move during it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._entries = {}
+        self.hits = 0
+        self.loads = 0
+
+    def get(self, key, load):
+        version = roster_version()
+        with self._lock:
+            if self._version == version and key in self._entries:
+                self.hits += 1
+                return self._entries[key]
+        value = load()
+        with self._lock:
+            self.loads += 1
+            if version == roster_version():
+                if self._version != version:
+                    self._version, self._entries = version, {}
+                value = self._entries.setdefault(key, value)  # Another thread may have loaded it first
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {"version": self._version, "entries": len(self._entries), "hits": self.hits, "loads": self.loads}
+
+_roster_cache = RosterCache()
+
+def _load_class_names():
+    names = {}
+    for class_id, name in db.session.query(ClassModel.id, ClassModel.name).order_by(ClassModel.id).all():
+        names.setdefault(name.strip().lower(), (class_id, name))
+    return names
+
+def roster_class_names():
+    """Every class name, oldest class first."""
+    return [name for _, name in _roster_cache.get("classes", _load_class_names).values()]
+
+def class_roster(class_name=None, class_id=None):
+    """Cached ClassRoster for a class, by case-insensitive name or by id; None if there is no such class."""
+    if class_id is None:
+        found = _roster_cache.get("classes", _load_class_names).get(str(class_name or '').strip().lower())
+        if not found:
+            return None
+        class_id = found[0]
+
+    def load():
+        c = db.session.get(ClassModel, class_id)
+        if c is None:
+            return None
+        rows = db.session.query(StudentModel.id, StudentModel.name).filter_by(class_id=class_id).order_by(StudentModel.id).all()
+        return ClassRoster(c.id, c.name, rows)
+    return _roster_cache.get(("class", class_id), load)
+
+def roster_name_index(class_id=None):
+    """Cached NameIndex of one class's roster (groups: class name), or of the whole school
+    when class_id is None. Rebuilt when the roster changes. Needs an app context."""
+    if class_id is not None:
+        roster = class_roster(class_id=class_id)
+        return roster.index if roster else NameIndex([])
+
+    def load():
+        rows = (db.session.query(StudentModel.name, ClassModel.name).join(ClassModel, StudentModel.class_id == ClassModel.id)
+                .order_by(ClassModel.name, StudentModel.name).all())
+        return NameIndex([r[0] for r in rows], [r[1] for r in rows])
+    return _roster_cache.get("school", load)
+
 from sqlalchemy import text
 with app.app_context():
     db.create_all()
@@ -186,6 +1993,12 @@ with app.app_context():
         db.session.commit()
     except Exception:
         db.session.rollback()
+    # Index the case-insensitive class lookups (func.lower(ClassModel.name) == ...)
+    try:
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_classes_name_lower ON classes (lower(name))"))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
 
     # --- ONE-TIME RENDER ROSTER SYNC ---
     # Automatically syncs the DB with the definitive rosters on app startup.
@@ -568,13 +2381,23 @@ def _cleanup_old_excel_files(max_age_seconds=None):
         logger.warning("Cleanup sweep error: {}".format(e))
     return removed
 
+@app.route('/api/ai-telemetry', methods=['GET'])
+def ai_telemetry():
+    """Per-call AI telemetry: aggregates by endpoint/model/key, plus the most recent calls.
+    ?limit=N recent records (default 50), ?endpoint=name to filter them."""
+    limit = max(0, min(AI_TELEMETRY_BUFFER, request.args.get('limit', 50, type=int)))
+    return jsonify({
+        "aggregate": _ai_telemetry.aggregate(),
+        "recent": _ai_telemetry.recent(limit, request.args.get('endpoint')),
+    }), 200
+
 @app.route('/health')
 def health_check():
     """Health check endpoint for Render and monitoring."""
     try:
         # Quick DB check
         db.session.execute(text('SELECT 1'))
-        return jsonify({"status": "healthy", "db": "ok", "ai_keys": len(API_KEYS)}), 200
+        return jsonify({"status": "healthy", "db": "ok", "ai_keys": len(API_KEYS), "ocr_cache": _ocr_cache.stats(), "key_scheduler": _key_scheduler.stats(), "chunk_planner": _chunk_planner.stats(), "prompt_cache": _prompt_cache_stats(), "hedging": _hedge_report(), "ai_gateway": _ai_gateway.stats(), "assistant_fast_path": _intent_report(), "roster_cache": _roster_cache.stats()}), 200
     except Exception as e:
         logger.error("Health check failed: {}".format(e))
         return jsonify({"status": "unhealthy", "error": str(e)}), 503
@@ -665,7 +2488,7 @@ def handle_classes():
             normalized_name = c.name.lower().replace(" ", "") # Modified as per instruction
             if normalized_name not in seen_names: # Modified as per instruction
                 seen_names.add(normalized_name) # Modified as per instruction
-                student_count = StudentModel.query.filter_by(class_id=c.id).count()
+                student_count = len(class_roster(class_id=c.id))
                 unique_classes.append({"id": c.id, "name": c.name, "student_count": student_count})
         return jsonify(unique_classes), 200
         
@@ -888,6 +2711,143 @@ def handle_enrollments():
         db.session.commit()
         return jsonify({"message": "Enrollments updated successfully"}), 200
 
+# Tiled score sheets: a tall sheet is cut into overlapping horizontal bands, each
+# with the header row pasted on top, OCR'd in parallel and stitched back together.
+SCORESHEET_BANDS_DEFAULT = 4
+SCORESHEET_BANDS_MAX = 8
+SCORESHEET_ROWS_PER_BAND = 18  # "tiled": "auto" sizes bands from the class roster
+SCORESHEET_TILE_MIN_ROWS = 30  # ...and leaves smaller classes as a single call
+SCORESHEET_HEADER_FRACTION = 0.12  # Header height assumed when no ruled header line is found
+SCORESHEET_HEADER_SEARCH = 0.35  # Part of the page searched for the line under the header row
+SCORESHEET_RULE_FILL = 0.5  # Share of a pixel row that must be dark for it to count as a ruled line
+SCORESHEET_BAND_OVERLAP = 0.04  # Page height shared by neighbouring bands
+SCORESHEET_STITCH_WINDOW = 8  # Most rows two neighbouring bands can have in common
+
+SCORESHEET_BAND_NOTE = """
+TILED SHEET: This image is band {band} of {bands} cut from one tall score sheet. The strip at the very top is the sheet's column header row, repeated for reference — do not extract it as a student.
+Below it is a horizontal slice of the student rows. Extract every student row in the slice, top to bottom. Skip a row cut off at the top or bottom edge if less than half of it is visible.
+"""
+
+def _scoresheet_header_bottom(img):
+    """Pixel row just below the sheet's column header row, or None if it can't be found.
+    Looks for ruled lines near the top of the page. The first line is the one under the header
+    when column rulings run up through the band above it or the lines below it are evenly spaced
+    (student rows); otherwise the header is the text between the table's top border and the next line."""
+    gray = np.asarray(ImageOps.grayscale(img))
+    height = gray.shape[0]
+    dark = gray < min(128, int(gray.mean()) - 40)
+    fill = dark.mean(axis=1)[:int(height * SCORESHEET_HEADER_SEARCH)]
+    rules, start = [], None  # (first row, last row) of each run of ruled rows
+    for y, value in enumerate(fill):
+        if value >= SCORESHEET_RULE_FILL and start is None:
+            start = y
+        elif value < SCORESHEET_RULE_FILL and start is not None:
+            rules.append((start, y - 1))
+            start = None
+    rules = [r for r in rules if r[0] > height * 0.02]  # The photo's top edge is not a rule
+    min_text_rows = max(3, height // 200)
+    if not rules:
+        return None
+    # Column rulings running through the band above the first line: that line is under the header
+    pitch = rules[1][0] - rules[0][1] if len(rules) > 1 else 3 * min_text_rows
+    band = dark[max(0, rules[0][0] - pitch):rules[0][0]]
+    if len(band) >= min_text_rows and (band.mean(axis=0) >= 0.95).sum() >= 2:
+        return rules[0][1] + 1
+    # Evenly ruled student rows start right below the first line: it has no top border above it
+    if len(rules) >= 3 and abs((rules[2][0] - rules[1][0]) - (rules[1][0] - rules[0][0])) <= 0.1 * (rules[2][0] - rules[1][0]) \
+            and (fill[:rules[0][0]] > 0.01).sum() >= min_text_rows:
+        return rules[0][1] + 1
+    for above, below in zip(rules, rules[1:]):
+        if (fill[above[1] + 1:below[0]] > 0.01).sum() >= min_text_rows:
+            return below[1] + 1
+    if len(rules) == 1 and (fill[:rules[0][0]] > 0.01).sum() >= min_text_rows:
+        return rules[0][1] + 1
+    return None
+
+def _scoresheet_bands(raw, bands, header_fraction=SCORESHEET_HEADER_FRACTION, overlap=SCORESHEET_BAND_OVERLAP):
+    """Cut a score sheet photo into `bands` overlapping horizontal slices of the rows
+    below the header, each with the header strip pasted above it. Returns JPEG bytes per band.
+    header_fraction is the header height used when no ruled header line is found."""
+    with Image.open(io.BytesIO(raw)) as img:
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        width, height = img.size
+        header_bottom = _scoresheet_header_bottom(img) or int(height * header_fraction)
+        header = img.crop((0, 0, width, header_bottom))
+        step = (height - header_bottom) / float(bands)
+        pad = int(height * overlap)
+        tiles = []
+        for i in range(bands):
+            top = max(header_bottom, int(header_bottom + i * step) - pad)
+            bottom = min(height, int(header_bottom + (i + 1) * step) + pad)
+            tile = Image.new('RGB', (width, header_bottom + bottom - top), 'white')
+            tile.paste(header, (0, 0))
+            tile.paste(img.crop((0, top, width, bottom)), (0, header_bottom))
+            out = io.BytesIO()
+            tile.save(out, 'JPEG', quality=90)
+            tiles.append(out.getvalue())
+    return tiles
+
+def _scoresheet_name_key(record):
+    return re_mod.sub(r'[^a-z]', '', str(record.get('name', '')).lower())
+
+def _stitch_scoresheet_bands(band_records):
+    """Join per-band record lists (in page order, None for a failed band) into one list.
+    Neighbouring bands overlap, so the longest run of names ending one band and starting
+    the next is the same students: those rows are merged (filling empty scores) instead of repeated."""
+    merged = []
+    joinable = False  # Previous band succeeded, so the next one overlaps it
+    for records in band_records:
+        if records is None:
+            joinable = False
+            continue
+        shared = 0
+        if joinable:
+            for k in range(min(SCORESHEET_STITCH_WINDOW, len(merged), len(records)), 0, -1):
+                tail, head = merged[-k:], records[:k]
+                if all(fuzz.ratio(_scoresheet_name_key(a), _scoresheet_name_key(b)) >= 90 for a, b in zip(tail, head)):
+                    shared = k
+                    break
+        for a, b in zip(merged[len(merged) - shared:], records[:shared]):
+            scores = a.setdefault('scores', {})
+            for col, value in (b.get('scores') or {}).items():
+                if value not in (None, '') and scores.get(col) in (None, ''):
+                    scores[col] = value
+        merged.extend(records[shared:])
+        joinable = True
+    return merged
+
+def _scoresheet_tiled(system_prompt, raw, bands):
+    """OCR a score sheet band by band in parallel. Returns the usual result object plus
+    "bands" and "failed_bands"; a failed band only loses its own rows. Raises if all fail."""
+    tiles = _scoresheet_bands(raw, bands)
+    kwargs = {"max_retries": max(3, len(API_KEYS)), "expect_json": True}
+    calls = ((i, AI_MODEL_PRIMARY, [system_prompt + SCORESHEET_BAND_NOTE.format(band=i + 1, bands=bands),
+                                    {"mime_type": "image/jpeg", "data": tile}], kwargs)
+             for i, tile in enumerate(tiles))
+    band_records = [None] * bands
+    assessment_types, last_error = [], None
+    for i, raw_text, call_error in _gemini_fanout(calls):
+        try:
+            if call_error:
+                raise call_error
+            result = json.loads(_strip_json_fences(raw_text))
+            band_records[i] = [r for r in result.get('records', []) if isinstance(r, dict)]
+            for name in result.get('assessment_types_found', []):
+                if name not in assessment_types:
+                    assessment_types.append(name)
+        except Exception as e:
+            last_error = e
+            logger.warning("Score sheet band {}/{} failed: {}".format(i + 1, bands, e))
+    failed = [i + 1 for i, records in enumerate(band_records) if records is None]
+    if len(failed) == bands:
+        raise last_error
+    return {
+        "assessment_types_found": assessment_types,
+        "records": _stitch_scoresheet_bands(band_records),
+        "bands": bands,
+        "failed_bands": failed,
+    }
+
 @app.route('/upload-scoresheet', methods=['POST'])
 def upload_scoresheet():
     try:
@@ -897,15 +2857,23 @@ def upload_scoresheet():
             
         img_b64 = data['image']
         target_class = data.get('targetClass', '').strip()
+        # Optional: "tiled": true, a band count, or "auto" (by roster size) splits a tall sheet into parallel bands
+        tiled = data.get('tiled', False)
+        if tiled not in (True, False, None, 'auto'):
+            try:
+                tiled = int(tiled)
+            except (TypeError, ValueError):
+                tiled = 0
+            if tiled < 1:
+                return jsonify({"error": "tiled must be true, false, \"auto\" or a band count"}), 400
         
         # Pull known names for this class
         known_names = []
         if target_class:
             try:
-                c = ClassModel.query.filter(func.lower(ClassModel.name) == target_class.lower()).first()
-                if c:
-                    students = StudentModel.query.filter_by(class_id=c.id).all()
-                    known_names = [s.name for s in students]
+                roster = class_roster(target_class)
+                if roster:
+                    known_names = list(roster.names)
             except Exception as e:
                 print("Error fetching known names: {}".format(e))
                 
@@ -948,25 +2916,17 @@ Use the following JSON schema:
 Return ONLY the raw JSON object. DO NOT wrap it in markdown block quotes like ```json ... ```.
 """.format(roster_context)
 
-        # Process with AI model — with retry + key rotation for rate limits
-        raw_text = None
-        for attempt in range(len(API_KEYS) if API_KEYS else 3):
-            try:
-                model = genai.GenerativeModel('gemini-2.5-flash')
-                contents = [system_prompt, {"mime_type": "image/jpeg", "data": img_b64}]
-                response = model.generate_content(contents)
-                raw_text = response.text.strip()
-                break
-            except Exception as model_err:
-                err_str = str(model_err).lower()
-                if 'quota' in err_str or 'rate' in err_str or '429' in err_str or 'resource' in err_str:
-                    rotate_api_key()
-                    time.sleep(min(3 * (attempt + 1), 10))
-                else:
-                    raise
-        if not raw_text:
-            raise Exception('All API keys exhausted')
-        
+        if tiled == 'auto':
+            tiled = -(-len(known_names) // SCORESHEET_ROWS_PER_BAND) if len(known_names) >= SCORESHEET_TILE_MIN_ROWS else False
+        if tiled:
+            bands = SCORESHEET_BANDS_DEFAULT if tiled is True else tiled
+            bands = max(2, min(SCORESHEET_BANDS_MAX, bands))
+            return jsonify(_scoresheet_tiled(system_prompt, _image_part_bytes({"data": img_b64}), bands)), 200
+
+        # Process with AI model — cached, with retry + key rotation for rate limits
+        contents = [system_prompt, {"mime_type": "image/jpeg", "data": img_b64}]
+        raw_text = _call_gemini(AI_MODEL_PRIMARY, contents, max_retries=max(3, len(API_KEYS)), expect_json=True)
+
         if raw_text.startswith("```json"):
             raw_text = raw_text[7:]
         if raw_text.endswith("```"):
@@ -979,188 +2939,462 @@ Return ONLY the raw JSON object. DO NOT wrap it in markdown block quotes like ``
         print("Error processing score sheet: {}".format(e))
         return jsonify({"error": str(e)}), 500
 
-@app.route('/upload-batch', methods=['POST'])
-def upload_batch():
+BATCH_CHUNK_SIZE = 5  # Starting chunk size; the planner adapts it from there
+BATCH_CHUNK_MIN = 1
+BATCH_CHUNK_MAX = 10
+BATCH_CHUNK_TOKEN_BUDGET = 16000  # Max prompt + image input tokens per chunk
+BATCH_CHUNK_TARGET_SECONDS = 30  # Chunks slower than this shrink, faster ones grow
+
+def _estimate_image_tokens(raw):
+    """Gemini input tokens for one image after preprocessing: 258 per 768px tile
+    (small images are a single tile). Reads only the image header."""
     try:
-        data = request.json
-        if not data or 'images' not in data:
-            return jsonify({"error": "No images provided"}), 400
-        
-        images_base64 = data['images']
-        target_class = data.get('targetClass', '').strip()
-        target_classes = data.get('targetClasses', [target_class] if target_class else [])
-        smart_instruction = data.get('smartInstruction', '').strip()
-        
-        if not images_base64:
-             return jsonify({"error": "Empty images list"}), 400
+        with Image.open(io.BytesIO(raw)) as img:
+            width, height = img.size
+    except Exception:
+        return AI_TOKENS_PER_IMAGE
+    scale = min(1.0, float(OCR_IMAGE_MAX_EDGE) / max(width, height, 1))
+    width, height = width * scale, height * scale
+    if width <= 384 and height <= 384:
+        return 258
+    return 258 * int(-(-width // 768)) * int(-(-height // 768))
+
+class ChunkPlanner:
+    """Sizes batch chunks from a token budget and from how recent calls went
+    (additive increase while calls are fast, halve after a timeout or a
+    truncated JSON reply). Process-wide and thread-safe."""
+
+    def __init__(self, initial, min_size, max_size, token_budget, target_seconds):
+        self._lock = threading.Lock()
+        self.size = initial
+        self.min_size = min_size
+        self.max_size = max_size
+        self.token_budget = token_budget
+        self.target_seconds = target_seconds
+        self.ewma_seconds_per_image = None
+        self.ewma_error_rate = 0.0
+        self.ewma_images_per_minute = None
+        self.chunks = 0
+        self.shrinks = 0
+        self.grows = 0
+
+    def next_size(self, upcoming_tokens, prompt_tokens):
+        """How many of the upcoming images (per-image token estimates, in order) go in the next chunk."""
+        with self._lock:
+            limit = self.size
+        count, total = 0, prompt_tokens
+        for tokens in upcoming_tokens[:limit]:
+            if count and total + tokens > self.token_budget:
+                break
+            count += 1
+            total += tokens
+        return max(1, count)
+
+    def split(self, indices, image_tokens, prompt_tokens):
+        """Plan all chunks of image indices up front at the current size (used for durable jobs)."""
+        chunks = []
+        pos = 0
+        while pos < len(indices):
+            upcoming = [image_tokens.get(idx, AI_TOKENS_PER_IMAGE) for idx in indices[pos:pos + self.max_size]]
+            n = self.next_size(upcoming, prompt_tokens)
+            chunks.append(indices[pos:pos + n])
+            pos += n
+        return chunks
+
+    def record(self, images, seconds, outcome):
+        """Feed back one chunk call. outcome: 'ok', 'timeout', 'truncated' or 'error'
+        (rate limits are the scheduler's business and should not be recorded)."""
+        with self._lock:
+            self.chunks += 1
+            failed = outcome != 'ok'
+            self.ewma_error_rate = 0.8 * self.ewma_error_rate + 0.2 * (1.0 if failed else 0.0)
+            if outcome == 'ok' and images and seconds > 0:
+                per_image = seconds / images
+                if self.ewma_seconds_per_image is None:
+                    self.ewma_seconds_per_image = per_image
+                else:
+                    self.ewma_seconds_per_image = 0.7 * self.ewma_seconds_per_image + 0.3 * per_image
+            if outcome in ('timeout', 'truncated') or (outcome == 'ok' and seconds > self.target_seconds):
+                # Sized from the chunk that failed, so several in-flight chunks of the same size only shrink once
+                new_size = max(self.min_size, min(self.size, images // 2 if failed else images - 1))
+                if new_size < self.size:
+                    self.shrinks += 1
+                    logger.info("Chunk planner: {} after {:.1f}s — chunk size {} -> {}".format(outcome, seconds, self.size, new_size))
+                self.size = new_size
+            elif outcome == 'ok' and images >= self.size and seconds < self.target_seconds / 2 and self.ewma_error_rate < 0.1:
+                if self.size < self.max_size:
+                    self.grows += 1
+                    self.size += 1
+
+    def record_throughput(self, images, seconds):
+        """Whole-batch throughput, kept as an EWMA for before/after comparisons."""
+        if not images or seconds <= 0:
+            return
+        per_minute = images * 60.0 / seconds
+        with self._lock:
+            if self.ewma_images_per_minute is None:
+                self.ewma_images_per_minute = per_minute
+            else:
+                self.ewma_images_per_minute = 0.7 * self.ewma_images_per_minute + 0.3 * per_minute
+
+    def stats(self):
+        with self._lock:
+            return {
+                "chunk_size": self.size,
+                "chunks": self.chunks,
+                "grows": self.grows,
+                "shrinks": self.shrinks,
+                "seconds_per_image": round(self.ewma_seconds_per_image, 2) if self.ewma_seconds_per_image else None,
+                "error_rate": round(self.ewma_error_rate, 3),
+                "images_per_minute": round(self.ewma_images_per_minute, 1) if self.ewma_images_per_minute else None,
+            }
 
-        print("Received a batch of {} images for processing...".format(len(images_base64)))
-        if smart_instruction:
-            print("Smart Instruction Applied: {}".format(smart_instruction))
-        
+_chunk_planner = ChunkPlanner(BATCH_CHUNK_SIZE, BATCH_CHUNK_MIN, BATCH_CHUNK_MAX, BATCH_CHUNK_TOKEN_BUDGET, BATCH_CHUNK_TARGET_SECONDS)
+
+def _chunk_outcome(chunk, paired, exc):
+    """Classify a finished chunk call for the planner, or None if it should not count (rate limits)."""
+    if exc is not None:
+        kind = _ai_error_kind(exc)
+        return None if kind in ('rate_limited', 'circuit_open', 'busy', 'queue_timeout') else kind
+    return 'truncated' if len(paired) < len(chunk) else 'ok'
+
+def _batch_roster_prefix(target_class, target_classes):
+    """SYSTEM_PROMPT plus the known-names block for the selected classes, built once
+    per (class set, roster version). Returns (PromptPrefix, {"class_rosters", "known_names", "name_index"})."""
+    selected = tuple(target_classes if target_classes else [target_class])
+
+    def build():
         # Build roster pool from ALL selected classes (3-Layer Routing)
         known_names_text = ""
         known_names = []
         class_rosters = {}  # {class_name: [student_names]}
-        
-        for tc in (target_classes if target_classes else [target_class]):
+        index_names, index_classes = [], []  # Every (name, class) pair, for the NameIndex
+
+        for tc in selected:
             if not tc:
                 continue
             try:
-                c = ClassModel.query.filter(func.lower(ClassModel.name) == tc.lower()).first()
-                if c:
-                    students = StudentModel.query.filter_by(class_id=c.id).all()
-                    names = [s.name for s in students]
+                roster = class_roster(tc)
+                if roster:
+                    names = list(roster.names)
                     class_rosters[tc] = names
                     known_names.extend(names)
+                    index_names.extend(names)
+                    index_classes.extend([tc] * len(names))
             except Exception as e:
                 print("Error loading roster for {}: {}".format(tc, e))
-        
+
         if known_names:
-            known_names = list(set(known_names))  # Deduplicate
+            # Deduplicate; sorted so the prompt (and its OCR cache key) is stable across processes
+            known_names = sorted(set(known_names))
             known_names_text = "\n\nCRITICAL INSTRUCTION: You are grading papers for class(es) '{}'. Here is the authoritative list of known student names across all classes: {}. If the handwritten name on the paper resembles any of these, you MUST output the exact spelling from this list. Do not invent new names.".format(
-                ', '.join(target_classes if target_classes else [target_class]),
+                ', '.join(selected),
                 known_names
             )
-        
-        # Prepare contents for AI model
-        dynamic_prompt = SYSTEM_PROMPT + known_names_text
+        return (SYSTEM_PROMPT + known_names_text, {"class_rosters": class_rosters, "known_names": known_names,
+                                                   "name_index": NameIndex(index_names, index_classes)})
+
+    return _cached_prompt_prefix(("batch", selected, roster_version()), build)
+
+def _build_batch_context(target_class, target_classes, smart_instruction, crop_box=None):
+    """Roster prefix and per-request settings for a batch scan.
+    crop_box optionally limits OCR to the score/name region of every photo."""
+    prefix, rosters = _batch_roster_prefix(target_class, target_classes)
+
+    instruction = ""
+    if smart_instruction:
+        instruction = "\n\n--- TEACHER'S CUSTOM SMART INSTRUCTION ---\n{}\n--- END OF CUSTOM INSTRUCTION ---\nYou MUST strictly obey the above manual instruction given by the teacher when processing these images and finalizing the output JSON.".format(smart_instruction)
+
+    return {
+        "prompt_prefix": prefix,
+        "instruction": instruction,
+        "prompt_tokens": prefix.tokens + len(instruction) // 4,
+        "target_class": target_class,
+        "target_classes": target_classes,
+        "class_rosters": rosters["class_rosters"],  # Shared with the prefix cache — read only
+        "known_names": rosters["known_names"],
+        "name_index": rosters["name_index"],  # Names grouped by class
+        # Colour is kept: the prompt relies on scores being written in red ink
+        "preprocess": {"crop_box": crop_box} if crop_box else None,
+    }
+
+def _batch_image_bytes(img):
+    """Raw bytes of a batch image (base64 string, bytes, or spooled file)."""
+    if hasattr(img, 'read'):
+        img.seek(0)
+        return img.read()
+    return _image_part_bytes({"data": img})
+
+def _batch_chunk_contents(chunk_indexed_images, ctx):
+    """Gemini content parts for a chunk of (global_index, image) pairs.
+    Images may be base64 strings (optionally data URLs), raw bytes, or uploaded files."""
+    contents = [ctx["prompt_prefix"]]
+    if ctx["instruction"]:
+        contents.append(ctx["instruction"])
+    for idx, img in chunk_indexed_images:
+        if hasattr(img, 'read'):
+            # Multipart upload: read from the spooled file only when the chunk is sent
+            img = _batch_image_bytes(img)
+        if isinstance(img, str) and 'base64,' in img:
+            img = img.split('base64,')[1]
+        contents.append({
+            "mime_type": "image/jpeg",
+            "data": img
+        })
+    return contents
+
+BATCH_TAIL_RETRIES = 2  # Follow-up calls for the images a truncated chunk reply left out
+
+async def _batch_chunk_async(chunk_indexed_images, ctx, on_item=None, stats=None, **kwargs):
+    """OCR one chunk on the AI event loop. Returns the decoded row objects in image order.
+    Complete rows are kept from a truncated or malformed reply and only the images after
+    the last complete row are re-requested. on_item(position, obj) streams rows as they decode."""
+    stats = {} if stats is None else stats
+    loop = asyncio.get_running_loop()
+    items = []
+    for attempt in range(1 + BATCH_TAIL_RETRIES):
+        tail = chunk_indexed_images[len(items):]
+        offset = len(items)
+        emit = (lambda pos, obj, offset=offset: on_item(offset + pos, obj)) if on_item else None
+        call_stats = stats if attempt == 0 else {}
+        contents = await loop.run_in_executor(_image_executor, _batch_chunk_contents, tail, ctx)
+        try:
+            raw_text = await _call_gemini_async(AI_MODEL_PRIMARY, contents, on_item=emit, stats=call_stats, **kwargs)
+        except Exception as exc:
+            if attempt == 0:
+                raise
+            logger.warning("Tail re-request for {} image(s) failed: {}".format(len(tail), exc))
+            break
+        finally:
+            if attempt:
+                _merge_call_stats(stats, call_stats)
+        rows, complete = _salvage_json_array(raw_text)
+        items.extend(rows[:len(tail)])
+        if complete or len(items) >= len(chunk_indexed_images):
+            break
+        logger.info("Chunk reply cut off after {} of {} rows; re-requesting the rest".format(len(items), len(chunk_indexed_images)))
+    return items
+
+def _submit_batch_chunk(chunk_indexed_images, ctx, **kwargs):
+    """Schedule _batch_chunk_async on the AI event loop. Returns a concurrent.futures.Future."""
+    kwargs.setdefault("endpoint", _current_endpoint() or threading.current_thread().name)
+    # Streamed batches keep the connection alive, so each chunk gets its own deadline rather than the request's
+    kwargs.setdefault("deadline", time.monotonic() + AI_REQUEST_DEADLINE_SECONDS)
+    return asyncio.run_coroutine_threadsafe(_batch_chunk_async(chunk_indexed_images, ctx, **kwargs), _get_ai_loop())
+
+def _batch_call_kwargs(ctx):
+    # Scale retries to number of keys (at least 3, up to keys * 2)
+    max_retries = max(3, len(API_KEYS) * 2) if API_KEYS else 3
+    return {"max_retries": max_retries, "expect_json": True, "preprocess": ctx["preprocess"], "stats": {}}
+
+def _pair_batch_results(results, chunk_indexed_images, ctx):
+    """Route classes and resolve names for a chunk's decoded rows.
+    Returns [{"index": global_idx, "result": {...}}]."""
+    # Map back the global index to the result
+    return [_pair_batch_result(i, res, chunk_indexed_images, ctx)
+            for i, res in enumerate(results) if i < len(chunk_indexed_images) and isinstance(res, dict)]
+
+def _pair_batch_result(i, res, chunk_indexed_images, ctx):
+    """Pair row i of a chunk with its image and clean it up. Returns {"index": global_idx, "result": {...}}."""
+    target_class = ctx["target_class"]
+    target_classes = ctx["target_classes"]
+    class_rosters = ctx["class_rosters"]
+    name_index = ctx["name_index"]
+
+    global_idx = chunk_indexed_images[i][0]
+
+    # Clean the score (e.g., "8/10" -> "8")
+    raw_score = str(res.get('score', '')).strip()
+    if raw_score and '/' in raw_score:
+        res['score'] = raw_score.split('/')[0].strip()
+
+    name = str(res.get('name', '')).strip().title()
+    confidence = str(res.get('confidence', 'high')).lower()
+
+    # === 3-LAYER CLASS ROUTING ===
+    # Layer 1: OCR - try to match AI-extracted class
+    extracted_class = str(res.get('class', '')).strip().upper()
+    matched_class = None
+
+    if extracted_class:
+        ec_cleaned = re_mod.sub(r'[^A-Z0-9]', '', extracted_class)
+        for tc in target_classes:
+            tc_cleaned = re_mod.sub(r'[^A-Z0-9]', '', tc.upper())
+            if ec_cleaned == tc_cleaned:
+                matched_class = tc
+                break
+
+    # Layer 2: Roster lookup - find which class this student is in
+    if not matched_class and name and class_rosters:
+        hits = [h for h in name_index.lookup(name, limit=NAME_INDEX_MAX_CANDIDATES) if h[1] >= 85]
+        for class_name in class_rosters:
+            in_class = [h for h in hits if h[2] == class_name]
+            if in_class:
+                matched_class = class_name
+                res['name'] = in_class[0][0]  # Also fix name spelling
+                break
+
+    # Layer 3: Fallback to primary target class
+    if matched_class:
+        res['class'] = matched_class
+    elif target_class:
+        res['class'] = target_class
+
+    if name and len(name_index):
+        if confidence in ['low', 'medium'] or name not in name_index:
+            best_matches = name_index.top(name, limit=3)
+
+            # Smart auto-correction if the top match is very high confidence and distinct
+            if best_matches and best_matches[0][1] >= 85:
+                # Check for ambiguity string ties
+                if len(best_matches) == 1 or best_matches[0][1] > best_matches[1][1] + 5:
+                    res['name'] = best_matches[0][0]
+                    res['needs_resolution'] = False
+                    res['fuzzy_matches'] = []
+                else:
+                    res['needs_resolution'] = True
+                    res['fuzzy_matches'] = [(m[0], m[1]) for m in best_matches]
+            elif best_matches:
+                res['needs_resolution'] = True
+                res['fuzzy_matches'] = [(m[0], m[1]) for m in best_matches]
+
+    return {"index": global_idx, "result": res}
+
+def _batch_request_params():
+    """Batch scan parameters from either a JSON body (base64 images) or a
+    multipart form (binary 'images' files, spooled to disk by Werkzeug as they
+    arrive). Returns (params, images); images are base64 strings or FileStorage objects.
+    Raises ValueError for malformed form fields."""
+    if request.files:
+        form = request.form
+        images = [f for f in request.files.getlist('images') if f]
+        target_classes = form.getlist('targetClasses')
+        try:
+            if len(target_classes) == 1 and target_classes[0].startswith('['):
+                target_classes = json.loads(target_classes[0])
+        except ValueError:
+            raise ValueError("targetClasses is not a valid JSON list")
+        crop_box = form.get('cropBox')
+        try:
+            crop_box = json.loads(crop_box) if crop_box else None
+        except ValueError:
+            raise ValueError("cropBox is not valid JSON")
+        data = form
+    else:
+        data = request.get_json(silent=True) or {}
+        images = data.get('images') or []
+        target_classes = data.get('targetClasses')
+        crop_box = data.get('cropBox')
+    target_class = (data.get('targetClass') or '').strip()
+    params = {
+        "targetClass": target_class,
+        "targetClasses": target_classes or ([target_class] if target_class else []),
+        "smartInstruction": (data.get('smartInstruction') or '').strip(),
+        "cropBox": _normalize_crop_box(crop_box),
+    }
+    return (params, images)
 
+@app.route('/upload-batch', methods=['POST'])
+def upload_batch():
+    try:
+        try:
+            params, images = _batch_request_params()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if not images:
+            return jsonify({"error": "No images provided"}), 400
+        smart_instruction = params["smartInstruction"]
+
+        print("Received a batch of {} images for processing...".format(len(images)))
         if smart_instruction:
-            dynamic_prompt += "\n\n--- TEACHER'S CUSTOM SMART INSTRUCTION ---\n{}\n--- END OF CUSTOM INSTRUCTION ---\nYou MUST strictly obey the above manual instruction given by the teacher when processing these images and finalizing the output JSON.".format(smart_instruction)
-        
-        # Concurrent processing: split images into chunks and process in parallel
-        CHUNK_SIZE = 5  # Increased from 3 - Gemini handles 5 images well, fewer API calls
-        
-        # Attach global index to each image
-        indexed_images = list(enumerate(images_base64))
-        
-        # Split images into chunks
-        image_chunks = []
-        for i in range(0, len(indexed_images), CHUNK_SIZE):
-            image_chunks.append(indexed_images[i:i + CHUNK_SIZE])
-        
-        def process_chunk(chunk_indexed_images):
-            """Process a chunk of images through the AI model."""
-            contents = [dynamic_prompt]
-            for idx, img_b64 in chunk_indexed_images:
-                if 'base64,' in img_b64:
-                    img_b64 = img_b64.split('base64,')[1]
-                contents.append({
-                    "mime_type": "image/jpeg",
-                    "data": img_b64
-                })
-            # Retry with key rotation on rate limit
-            # Scale retries to number of keys (at least 3, up to keys * 2)
-            max_retries = max(3, len(API_KEYS) * 2) if API_KEYS else 3
-            backoff_times = [3, 5, 8, 12, 15]
-            response = None
-            model = genai.GenerativeModel('gemini-2.5-flash')
-            for attempt in range(max_retries):
-                try:
-                    response = model.generate_content(contents)
-                    break
-                except Exception as retry_err:
-                    err_str = str(retry_err).lower()
-                    if 'quota' in err_str or 'rate' in err_str or '429' in err_str or 'resource' in err_str:
-                        print("Rate limit hit on attempt {} — rotating key...".format(attempt + 1))
-                        rotate_api_key()
-                        # Re-create model with the newly configured key
-                        model = genai.GenerativeModel('gemini-2.5-flash')
-                        if attempt < max_retries - 1:
-                            wait = backoff_times[min(attempt, len(backoff_times) - 1)]
-                            time.sleep(wait)
-                    else:
-                        raise retry_err
-            if not response:
-                raise Exception("All API keys exhausted for this chunk after {} retries".format(max_retries))
-            response_text = response.text.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            try:
-                results = json.loads(response_text.strip())
-            except Exception as e:
-                print("Error parsing JSON from model: {}".format(e))
-                results = []
-                
-            # Map back the global index to the result
-            paired_results = []
-            for i, res in enumerate(results):
-                if i < len(chunk_indexed_images):
-                    global_idx = chunk_indexed_images[i][0]
-                    
-                    # Clean the score (e.g., "8/10" -> "8")
-                    raw_score = str(res.get('score', '')).strip()
-                    if raw_score and '/' in raw_score:
-                        res['score'] = raw_score.split('/')[0].strip()
-                        
-                    name = str(res.get('name', '')).strip().title()
-                    confidence = str(res.get('confidence', 'high')).lower()
-                    
-                    # === 3-LAYER CLASS ROUTING ===
-                    # Layer 1: OCR - try to match AI-extracted class
-                    extracted_class = str(res.get('class', '')).strip().upper()
-                    matched_class = None
-                    
-                    if extracted_class:
-                        ec_cleaned = re_mod.sub(r'[^A-Z0-9]', '', extracted_class)
-                        for tc in target_classes:
-                            tc_cleaned = re_mod.sub(r'[^A-Z0-9]', '', tc.upper())
-                            if ec_cleaned == tc_cleaned:
-                                matched_class = tc
-                                break
-                    
-                    # Layer 2: Roster lookup - find which class this student is in
-                    if not matched_class and name and class_rosters:
-                        for class_name, roster in class_rosters.items():
-                            if roster:
-                                best = process.extractOne(name, roster, scorer=fuzz.token_set_ratio)
-                                if best and best[1] >= 85:
-                                    matched_class = class_name
-                                    res['name'] = best[0]  # Also fix name spelling
-                                    break
-                    
-                    # Layer 3: Fallback to primary target class
-                    if matched_class:
-                        res['class'] = matched_class
-                    elif target_class:
-                        res['class'] = target_class
-
-                    if name and known_names:
-                        if confidence in ['low', 'medium'] or name not in known_names:
-                            best_matches = process.extract(name, known_names, scorer=fuzz.token_set_ratio, limit=3)
-                            
-                            # Smart auto-correction if the top match is very high confidence and distinct
-                            if best_matches and best_matches[0][1] >= 85:
-                                # Check for ambiguity string ties
-                                if len(best_matches) == 1 or best_matches[0][1] > best_matches[1][1] + 5:
-                                    res['name'] = best_matches[0][0]
-                                    res['needs_resolution'] = False
-                                    res['fuzzy_matches'] = []
-                                else:
-                                    res['needs_resolution'] = True
-                                    res['fuzzy_matches'] = [(m[0], m[1]) for m in best_matches]
-                            elif best_matches:
-                                res['needs_resolution'] = True
-                                res['fuzzy_matches'] = [(m[0], m[1]) for m in best_matches]
-                        
-                    paired_results.append({"index": global_idx, "result": res})
-            return paired_results
+            print("Smart Instruction Applied: {}".format(smart_instruction))
+        
+        ctx = _build_batch_context(params["targetClass"], params["targetClasses"], smart_instruction, params["cropBox"])
+        
+        if hasattr(images[0], 'stream'):
+            # Werkzeug closes the request's uploads when the view returns, before the
+            # stream runs — move each one to our own temp file (disk, not memory)
+            import shutil
+            import tempfile
+            spooled = []
+            for upload in images:
+                tmp = tempfile.TemporaryFile()
+                shutil.copyfileobj(upload.stream, tmp)
+                spooled.append(tmp)
+            images = spooled
+
+        # Same script photographed twice: OCR the first copy only.
+        # The same pass reads each image header for the chunk planner's token estimate.
+        image_tokens = {}
+        def read_images():
+            for i, img in enumerate(images):
+                raw = _batch_image_bytes(img)
+                image_tokens[i] = _estimate_image_tokens(raw)
+                yield (i, raw)
+        duplicates, possible = _find_duplicates(read_images())
+        if duplicates or possible:
+            logger.info("Batch has {} duplicate photo(s): {}, {} possible: {}".format(len(duplicates), duplicates, len(possible), possible))
+        pending = [(i, img) for i, img in enumerate(images) if i not in duplicates]
+        prompt_tokens = ctx["prompt_tokens"]
         
         @stream_with_context
         def generate():
-            with ThreadPoolExecutor(max_workers=3) as executor:
-                futures = {executor.submit(process_chunk, chunk): chunk for chunk in image_chunks}
-                for future in as_completed(futures):
-                    try:
-                        chunk_res = future.result()
-                        for r in chunk_res:
-                            yield "data: {}\n\n".format(json.dumps(r))
-                    except Exception as exc:
-                        print('Chunk generated an exception: {}'.format(exc))
-                        yield "data: {}\n\n".format(json.dumps({"error": str(exc)}))
+            # Chunks fan out on the AI event loop, every key at its concurrency cap.
+            # Each chunk is sized when it enters the window, so it sees the planner's latest feedback.
+            # Replies stream: each row is sent as soon as it decodes, before its chunk finishes.
+            events = queue.Queue()
+            def calls():
+                pos = 0
+                while pos < len(pending):
+                    upcoming = [image_tokens[i] for i, _ in pending[pos:pos + BATCH_CHUNK_MAX]]
+                    chunk = pending[pos:pos + _chunk_planner.next_size(upcoming, prompt_tokens)]
+                    pos += len(chunk)
+                    kwargs = _batch_call_kwargs(ctx)
+                    tag = (chunk, kwargs["stats"], {})  # {} collects rows already sent, by position
+                    kwargs["on_item"] = lambda position, obj, tag=tag: events.put(("row", tag, position, obj))
+                    yield (tag, chunk, ctx, kwargs)
+            started = time.monotonic()
+            totals = {}
+            try:
+                for event in _gemini_fanout(calls(), submit=_submit_batch_chunk, events=events):
+                    if event[0] == "row":
+                        _, (chunk, _, sent), position, obj = event
+                        if position < len(chunk) and isinstance(obj, dict):
+                            sent[position] = _pair_batch_result(position, obj, chunk, ctx)
+                            for r in [sent[position]] + _duplicate_results([sent[position]], duplicates, possible):
+                                yield "data: {}\n\n".format(json.dumps(r))
+                        continue
+                    (chunk, stats, sent), rows, call_error = event
+                    _merge_call_stats(totals, stats)
+                    paired, unsent = list(sent.values()), []
+                    if not call_error:
+                        try:
+                            paired = []
+                            for i, res in enumerate(rows[:len(chunk)]):
+                                if i in sent:
+                                    paired.append(sent[i])
+                                elif isinstance(res, dict):
+                                    paired.append(_pair_batch_result(i, res, chunk, ctx))
+                                    unsent.append(paired[-1])
+                        except Exception as exc:
+                            call_error = exc
+                    outcome = _chunk_outcome(chunk, paired, call_error)
+                    if outcome:
+                        _chunk_planner.record(len(chunk), stats.get("model_ms", 0) / 1000.0, outcome)
+                    if call_error:
+                        print('Chunk generated an exception: {}'.format(call_error))
+                        yield "data: {}\n\n".format(json.dumps({"error": str(call_error)}))
+                        continue
+                    for r in unsent + _duplicate_results(unsent, duplicates, possible):
+                        yield "data: {}\n\n".format(json.dumps(r))
+            finally:
+                for img in images:
+                    if hasattr(img, 'close'):
+                        img.close()
+            report = _format_batch_report(totals, len(images), time.monotonic() - started)
+            _chunk_planner.record_throughput(len(images), time.monotonic() - started)
+            logger.info("Batch report: {}".format(report))
+            yield "data: {}\n\n".format(json.dumps({"report": report}))
             yield "data: [DONE]\n\n"
         
         return Response(generate(), mimetype='text/event-stream')
@@ -1169,6 +3403,352 @@ def upload_batch():
         print("Error processing batch: {}".format(e))
         return jsonify({"error": str(e)}), 500
 
+# ═══════════════════════════════════════════════════════════════
+#  DURABLE BATCH JOBS
+#  Batches are stored as jobs with per-chunk state, so a gunicorn worker
+#  recycle (max_requests) or timeout only loses the chunk in flight.
+#  Images are spooled to disk; results live in the database.
+# ═══════════════════════════════════════════════════════════════
+import uuid
+
+BATCH_JOB_LEASE_SECONDS = 180  # A 'running' chunk older than this is assumed orphaned
+BATCH_JOB_MAX_ATTEMPTS = 3  # Chunk attempts before it is marked failed
+BATCH_JOB_RETENTION_SECONDS = 24 * 3600  # Finished jobs are purged after a day
+_batch_jobs_dir = '/data/batch_jobs' if os.path.exists('/data') else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'batch_jobs')
+_batch_job_wakeup = threading.Event()
+_batch_job_reports = {}  # {job_id: preprocessing/latency totals} — in memory, for the job's SSE report
+
+def _batch_job_image_path(job_id, index):
+    return os.path.join(_batch_jobs_dir, job_id, "{}.jpg".format(index))
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except (OSError, TypeError, ValueError):
+        return False
+
+def _claim_batch_chunk(skip_ids=()):
+    """Atomically claim the next runnable chunk. Returns the chunk id or None.
+    Pending chunks run first; 'running' chunks whose lease expired or whose
+    owning process is gone (worker recycled/killed) are reclaimed.
+    skip_ids are chunks this process is still working on."""
+    now = time.time()
+    candidates = (BatchChunkModel.query
+                  .join(BatchJobModel, BatchChunkModel.job_id == BatchJobModel.id)
+                  .filter(BatchJobModel.status.in_(['pending', 'running']))
+                  .filter(BatchChunkModel.status.in_(['pending', 'running']))
+                  .order_by(BatchJobModel.created_at, BatchChunkModel.chunk_index)
+                  .limit(20 + len(skip_ids)).all())
+    for chunk in candidates:
+        if chunk.id in skip_ids:
+            continue
+        if chunk.status == 'running':
+            owner_gone = chunk.lease_owner != os.getpid() and not _pid_alive(chunk.lease_owner)
+            if (chunk.lease_until or 0) > now and not owner_gone:
+                continue
+        # Optimistic claim: only succeeds if nobody else changed the row meanwhile
+        claimed = (BatchChunkModel.query
+                   .filter_by(id=chunk.id, status=chunk.status, attempts=chunk.attempts)
+                   .update({
+                       "status": "running",
+                       "attempts": chunk.attempts + 1,
+                       "lease_owner": os.getpid(),
+                       "lease_until": now + BATCH_JOB_LEASE_SECONDS,
+                   }, synchronize_session=False))
+        if claimed:
+            BatchJobModel.query.filter_by(id=chunk.job_id, status='pending').update(
+                {"status": "running", "updated_at": now}, synchronize_session=False)
+            db.session.commit()
+            return chunk.id
+        db.session.rollback()
+    return None
+
+def _finish_batch_job_if_complete(job_id):
+    """Mark the job finished once every chunk is done or failed, and drop its spooled images."""
+    open_chunks = BatchChunkModel.query.filter(
+        BatchChunkModel.job_id == job_id,
+        BatchChunkModel.status.in_(['pending', 'running'])
+    ).count()
+    if open_chunks:
+        return
+    job = BatchJobModel.query.get(job_id)
+    if not job or job.status in ('done', 'failed'):
+        return
+    done_chunks = BatchChunkModel.query.filter_by(job_id=job_id, status='done').count()
+    job.status = 'done' if done_chunks else 'failed'
+    job.updated_at = time.time()
+    db.session.commit()
+    import shutil
+    shutil.rmtree(os.path.join(_batch_jobs_dir, job_id), ignore_errors=True)
+    _chunk_planner.record_throughput(job.total_images, job.updated_at - job.created_at)
+    logger.info("Batch job {} finished: {} ({}/{} chunks ok) {}".format(
+        job_id, job.status, done_chunks, job.total_chunks, _batch_job_report(job)))
+
+def _batch_job_report(job):
+    """Preprocessing/latency report for a job, with throughput once it has finished."""
+    wall_seconds = job.updated_at - job.created_at if job.status in ('done', 'failed') else None
+    return _format_batch_report(_batch_job_reports.get(job.id, {}), job.total_images, wall_seconds)
+
+def _start_batch_chunk(chunk_id):
+    """Load a claimed chunk's images and submit its OCR call to the AI event loop.
+    Returns (future, indexed_images, ctx, stats)."""
+    chunk = BatchChunkModel.query.get(chunk_id)
+    job = BatchJobModel.query.get(chunk.job_id)
+    params = json.loads(job.params_json)
+    indexed_images = []
+    for idx in json.loads(chunk.image_indices):
+        with open(_batch_job_image_path(job.id, idx), 'rb') as f:
+            indexed_images.append((idx, f.read()))
+    ctx = _build_batch_context(params.get('targetClass', ''), params.get('targetClasses', []), params.get('smartInstruction', ''),
+                               params.get('cropBox'))
+    kwargs = _batch_call_kwargs(ctx)
+    future = _submit_batch_chunk(indexed_images, ctx, **kwargs)
+    return (future, indexed_images, ctx, kwargs["stats"])
+
+def _record_batch_chunk(chunk_id, future, indexed_images, ctx, stats):
+    """Persist the outcome of a finished chunk call."""
+    chunk = BatchChunkModel.query.get(chunk_id)
+    job = BatchJobModel.query.get(chunk.job_id)
+    _merge_call_stats(_batch_job_reports.setdefault(job.id, {}), stats)
+    results, call_error = [], None
+    try:
+        results = _pair_batch_results(future.result(), indexed_images, ctx)
+        params = json.loads(job.params_json)
+        duplicates = {int(k): v for k, v in params.get('duplicates', {}).items()}
+        possible = {int(k): v for k, v in params.get('possible_duplicates', {}).items()}
+        chunk.results_json = json.dumps(results + _duplicate_results(results, duplicates, possible))
+        chunk.status = 'done'
+        chunk.error = None
+    except Exception as exc:
+        call_error = exc
+        logger.warning("Batch job {} chunk {} attempt {} failed: {}".format(job.id, chunk.chunk_index, chunk.attempts, exc))
+        chunk.error = str(exc)[:500]
+        chunk.status = 'failed' if chunk.attempts >= BATCH_JOB_MAX_ATTEMPTS else 'pending'
+    outcome = _chunk_outcome(indexed_images, results, call_error)
+    if outcome:
+        _chunk_planner.record(len(indexed_images), stats.get("model_ms", 0) / 1000.0, outcome)
+    chunk.lease_until = None
+    job.updated_at = time.time()
+    db.session.commit()
+    _finish_batch_job_if_complete(job.id)
+
+def _fail_batch_chunk(chunk_id, exc):
+    """A chunk could not even be started (missing images, bad params)."""
+    chunk = BatchChunkModel.query.get(chunk_id)
+    if not chunk:
+        return
+    logger.warning("Batch job {} chunk {} could not start: {}".format(chunk.job_id, chunk.chunk_index, exc))
+    chunk.error = str(exc)[:500]
+    chunk.status = 'failed' if chunk.attempts >= BATCH_JOB_MAX_ATTEMPTS else 'pending'
+    chunk.lease_until = None
+    db.session.commit()
+    _finish_batch_job_if_complete(chunk.job_id)
+
+def _purge_old_batch_jobs():
+    """Delete finished jobs past retention (and any leftover image folders)."""
+    cutoff = time.time() - BATCH_JOB_RETENTION_SECONDS
+    old_jobs = BatchJobModel.query.filter(
+        BatchJobModel.status.in_(['done', 'failed']),
+        BatchJobModel.updated_at < cutoff
+    ).all()
+    import shutil
+    for job in old_jobs:
+        shutil.rmtree(os.path.join(_batch_jobs_dir, job.id), ignore_errors=True)
+        _batch_job_reports.pop(job.id, None)
+        db.session.delete(job)
+    if old_jobs:
+        db.session.commit()
+        logger.info("Purged {} old batch job(s)".format(len(old_jobs)))
+
+def _batch_job_worker():
+    """Background loop that drains the batch job queue. Survives worker restarts via the DB.
+    One thread: claimed chunks run concurrently on the AI event loop, and the
+    loop keeps claiming until the fan-out window (keys x per-key concurrency) is full."""
+    last_purge = 0
+    in_flight = {}  # {future: (chunk_id, indexed_images, ctx, stats)}
+    while True:
+        claimed = False
+        try:
+            with app.app_context():
+                if time.time() - last_purge > 3600:
+                    last_purge = time.time()
+                    _purge_old_batch_jobs()
+                for future in [f for f in in_flight if f.done()]:
+                    chunk_id, indexed_images, ctx, stats = in_flight.pop(future)
+                    _record_batch_chunk(chunk_id, future, indexed_images, ctx, stats)
+                while len(in_flight) < _ai_fanout_capacity():
+                    chunk_id = _claim_batch_chunk(skip_ids={v[0] for v in in_flight.values()})
+                    if not chunk_id:
+                        break
+                    claimed = True
+                    try:
+                        future, indexed_images, ctx, stats = _start_batch_chunk(chunk_id)
+                        in_flight[future] = (chunk_id, indexed_images, ctx, stats)
+                    except Exception as exc:
+                        _fail_batch_chunk(chunk_id, exc)
+        except Exception as e:
+            logger.error("Batch job worker error: {}".format(e))
+            try:
+                with app.app_context():
+                    db.session.rollback()
+            except Exception:
+                pass
+        if in_flight:
+            futures_wait(list(in_flight), timeout=5, return_when=FIRST_COMPLETED)
+        elif not claimed:
+            _batch_job_wakeup.wait(5)
+            _batch_job_wakeup.clear()
+
+_batch_job_worker_started = False
+_batch_job_worker_lock = threading.Lock()
+
+def ensure_batch_job_worker():
+    """Start this process's batch job worker once. Called from gunicorn's post_worker_init
+    (so a recycled worker resumes queued jobs) and on the first batch job request, never at
+    import, so scripts and tests that import the app don't start draining the queue."""
+    global _batch_job_worker_started
+    with _batch_job_worker_lock:
+        if _batch_job_worker_started:
+            return
+        _batch_job_worker_started = True
+    threading.Thread(target=_batch_job_worker, name="batch-job-worker", daemon=True).start()
+
+def _serialize_batch_job(job, include_results=True):
+    chunks = BatchChunkModel.query.filter_by(job_id=job.id).order_by(BatchChunkModel.chunk_index).all()
+    results = []
+    errors = []
+    for ch in chunks:
+        if ch.status == 'done' and ch.results_json and include_results:
+            results.extend(json.loads(ch.results_json))
+        elif ch.status == 'failed':
+            errors.append({"chunk": ch.chunk_index, "error": ch.error})
+    payload = {
+        "job_id": job.id,
+        "status": job.status,
+        "total_images": job.total_images,
+        "total_chunks": job.total_chunks,
+        "done_chunks": sum(1 for ch in chunks if ch.status == 'done'),
+        "failed_chunks": sum(1 for ch in chunks if ch.status == 'failed'),
+        "errors": errors,
+    }
+    if include_results:
+        payload["results"] = sorted(results, key=lambda r: r.get("index", 0))
+    if job.id in _batch_job_reports:
+        payload["report"] = _batch_job_report(job)
+    return payload
+
+@app.route('/api/batch-jobs', methods=['POST'])
+def create_batch_job():
+    """Submit a batch scan as a durable job. Same payload as /upload-batch (JSON or multipart)."""
+    try:
+        try:
+            params, images = _batch_request_params()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if not images:
+            return jsonify({"error": "No images provided"}), 400
+
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(_batch_jobs_dir, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        for idx, img in enumerate(images):
+            if hasattr(img, 'save'):
+                img.save(_batch_job_image_path(job_id, idx))  # Copies the spooled upload in blocks
+                continue
+            if 'base64,' in img:
+                img = img.split('base64,')[1]
+            with open(_batch_job_image_path(job_id, idx), 'wb') as f:
+                f.write(base64.b64decode(img))
+
+        image_tokens = {}
+        def saved_images():
+            for idx in range(len(images)):
+                with open(_batch_job_image_path(job_id, idx), 'rb') as f:
+                    raw = f.read()
+                image_tokens[idx] = _estimate_image_tokens(raw)
+                yield (idx, raw)
+        duplicates, possible = _find_duplicates(saved_images())
+        params["duplicates"] = duplicates
+        params["possible_duplicates"] = possible
+        ctx = _build_batch_context(params["targetClass"], params["targetClasses"], params["smartInstruction"], params["cropBox"])
+        chunks = _chunk_planner.split([idx for idx in range(len(images)) if idx not in duplicates],
+                                      image_tokens, ctx["prompt_tokens"])
+        now = time.time()
+        db.session.add(BatchJobModel(
+            id=job_id, status='pending', params_json=json.dumps(params),
+            total_images=len(images), total_chunks=len(chunks),
+            created_at=now, updated_at=now
+        ))
+        for chunk_index, indices in enumerate(chunks):
+            db.session.add(BatchChunkModel(
+                job_id=job_id, chunk_index=chunk_index,
+                image_indices=json.dumps(indices), status='pending'
+            ))
+        db.session.commit()
+        ensure_batch_job_worker()
+        _batch_job_wakeup.set()
+
+        logger.info("Queued batch job {} ({} images, {} chunks, {} duplicates)".format(job_id, len(images), len(chunks), len(duplicates)))
+        return jsonify({
+            "job_id": job_id,
+            "total_images": len(images),
+            "total_chunks": len(chunks),
+            "duplicates": len(duplicates),
+            "status_url": "/api/batch-jobs/{}".format(job_id),
+            "stream_url": "/api/batch-jobs/{}/stream".format(job_id)
+        }), 202
+    except Exception as e:
+        db.session.rollback()
+        logger.error("Batch job submit error: {}".format(e))
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/batch-jobs/<job_id>', methods=['GET'])
+def get_batch_job(job_id):
+    """Poll a batch job's progress and the results of finished chunks."""
+    ensure_batch_job_worker()
+    job = BatchJobModel.query.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(_serialize_batch_job(job)), 200
+
+@app.route('/api/batch-jobs/<job_id>/stream', methods=['GET'])
+def stream_batch_job(job_id):
+    """SSE feed of a batch job — same event format as /upload-batch. Safe to reconnect:
+    a new connection replays every finished chunk, and clients de-duplicate rows by index."""
+    ensure_batch_job_worker()
+    if not BatchJobModel.query.get(job_id):
+        return jsonify({"error": "Job not found"}), 404
+
+    @stream_with_context
+    def generate():
+        sent_chunks = set()
+        reported_failures = set()
+        while True:
+            db.session.expire_all()
+            job = BatchJobModel.query.get(job_id)
+            if not job:
+                break
+            chunks = BatchChunkModel.query.filter_by(job_id=job_id).order_by(BatchChunkModel.chunk_index).all()
+            for ch in chunks:
+                if ch.status == 'done' and ch.id not in sent_chunks:
+                    sent_chunks.add(ch.id)
+                    for r in json.loads(ch.results_json or '[]'):
+                        yield "data: {}\n\n".format(json.dumps(r))
+                elif ch.status == 'failed' and ch.id not in reported_failures:
+                    reported_failures.add(ch.id)
+                    yield "data: {}\n\n".format(json.dumps({"error": ch.error or "Chunk failed"}))
+            if job.status in ('done', 'failed'):
+                if job_id in _batch_job_reports:
+                    yield "data: {}\n\n".format(json.dumps({"report": _batch_job_report(job)}))
+                break
+            yield ": keep-alive\n\n"
+            time.sleep(1)
+        yield "data: [DONE]\n\n"
+
+    return Response(generate(), mimetype='text/event-stream')
+
+
 
 def parse_class_level(class_name):
     """Smart class parser: extracts level and arm from any Nigerian school format.
@@ -1265,69 +3845,87 @@ def export_excel():
 
         # 3. Correct scanned names to roster names BEFORE merging
         #    This prevents duplicates from OCR spelling differences
+        ambiguous_names = {}  # {class: pairs the assignment could not call confidently}
+        roster_classes = set()  # Classes whose scanned names were corrected to roster names
         for class_name, students in new_scores_by_class.items():
-            c = ClassModel.query.filter(func.lower(ClassModel.name) == class_name.lower()).first()
-            if c:
-                db_students = StudentModel.query.filter_by(class_id=c.id).all()
-                roster_names = [s.name for s in db_students]
+            roster = class_roster(class_name)
+            if roster:
+                roster_names = roster.names
                 if roster_names:
+                    roster_classes.add(class_name)
                     corrected = {}
-                    claimed = set()
+                    roster_set = set(roster_names)
+                    fuzzy_names = [n for n in students if n not in roster_set]
+                    matcher = NameMatcher(fuzzy_names, roster_names)
+                    available = np.ones(len(roster_names), dtype=bool)  # Roster names not taken by an exact match
                     for name, score in students.items():
-                        if name in roster_names:
+                        if name in roster_set:
                             corrected[name] = score
-                            claimed.add(name)
-                        else:
-                            available = [n for n in roster_names if n not in claimed]
-                            if not available:
-                                available = roster_names
-                            best = process.extractOne(name, available, scorer=fuzz.token_set_ratio)
-                            if best and best[1] >= 75:
-                                corrected[best[0]] = score
-                                claimed.add(best[0])
-                            else:
-                                # Drop unmatched OCR names — only roster names belong in the Excel
-                                print("[ROSTER] Dropped unrecognized name '{}' (no roster match)".format(name))
+                            available[matcher.columns(name)] = False
+                    # Everyone else gets the best one-to-one pairing over the remaining roster names
+                    assignment = matcher.assign(75, allowed=available)
+                    for row, (roster_name, _) in assignment["pairs"].items():
+                        corrected[roster_name] = students[fuzzy_names[row]]
+                    for row in assignment["unmatched"]:
+                        # Drop unmatched OCR names — only roster names belong in the Excel
+                        print("[ROSTER] Dropped unrecognized name '{}' (no free roster match)".format(fuzzy_names[row]))
+                    if assignment["ambiguous"]:
+                        ambiguous_names[class_name] = assignment["ambiguous"]
                     new_scores_by_class[class_name] = corrected
 
         # 4. Merge corrected scans into existing records
         for class_name, students in new_scores_by_class.items():
             if class_name not in merged_by_class:
                 merged_by_class[class_name] = {}
-                
-            for name, score in students.items():
-                if not score: continue
-                
-                # Fuzzy match name against existing merged records to prevent duplicates
-                existing_names = list(merged_by_class[class_name].keys())
-                target_name = name
-                if existing_names:
-                    best = process.extractOne(name, existing_names, scorer=fuzz.token_set_ratio)
+            records = merged_by_class[class_name]
+            scanned = [name for name, score in students.items() if score]
+
+            # Pair scanned names one-to-one with existing records, so two students never share a row
+            existing = list(records)
+            matcher = NameMatcher(scanned, existing)
+            free = np.ones(len(existing), dtype=bool)  # Existing records without an exact hit
+            targets, fuzzy_rows = {}, []
+            for row, name in enumerate(scanned):
+                if name in records:
+                    targets[name] = name
+                    free[matcher.columns(name)] = False
+                else:
+                    fuzzy_rows.append(row)
+            assignment = matcher.assign(85, rows=fuzzy_rows, allowed=free)
+            for row, (record_name, _) in assignment["pairs"].items():
+                targets[scanned[row]] = record_name
+            ambiguous_names.setdefault(class_name, []).extend(a for a in assignment["ambiguous"] if a["match"])
+
+            # Without a roster the names are raw OCR, so fold near-duplicates scanned in this batch together
+            batch = NameMatcher(scanned, scanned) if class_name not in roster_classes else None
+            added = np.zeros(len(scanned), dtype=bool)
+            for row, name in enumerate(scanned):
+                target_name = targets.get(name, name)
+                if target_name not in records and batch is not None and added.any():
+                    best = batch.best(name, added)
                     if best and best[1] >= 85:
                         target_name = best[0]
                 
-                if target_name not in merged_by_class[class_name]:
-                    merged_by_class[class_name][target_name] = {"Name": target_name, "Class": class_name}
+                if target_name not in records:
+                    records[target_name] = {"Name": target_name, "Class": class_name}
+                    if batch is not None:
+                        added[batch.columns(target_name)] = True
                 
                 # Update the new assessment column (this will overwrite previous session's value IF they regrade the SAME assessment)
-                merged_by_class[class_name][target_name][assessment_type] = score
+                records[target_name][assessment_type] = students[name]
+            if not ambiguous_names[class_name]:
+                del ambiguous_names[class_name]
         
         # === ROSTER PADDING (All Subjects) ===
         # Always ensure all students known to the database for this class are listed.
         for class_name in list(merged_by_class.keys()):
-            c = ClassModel.query.filter(func.lower(ClassModel.name) == class_name.lower()).first()
-            if c:
-                db_students = StudentModel.query.filter_by(class_id=c.id).all()
+            roster = class_roster(class_name)
+            if roster:
                 existing_names = list(merged_by_class[class_name].keys())
+                found = NameMatcher(roster.names, existing_names).best_scores() >= 85
                 
-                for db_stu in db_students:
-                    target_name = db_stu.name
-                    found = False
-                    if existing_names:
-                        best = process.extractOne(target_name, existing_names, scorer=fuzz.token_set_ratio)
-                        if best and best[1] >= 85:
-                            found = True
-                    if not found:
+                for target_name, is_found in zip(roster.names, found):
+                    if not is_found:
                         # Pad with missing student
                         merged_by_class[class_name][target_name] = {"Name": target_name, "Class": class_name}
         
@@ -1664,6 +4262,7 @@ def export_excel():
             "message": "Grades saved! {} file(s) ready for download.".format(len(downloads)),
             "sheets": all_sheets_summary,
             "downloads": downloads,
+            "ambiguous_names": ambiguous_names,
             "subject": subject_name
         }), 200
 
@@ -1908,11 +4507,16 @@ def upload_excel_scorelist():
 
             roster_students = StudentModel.query.filter_by(class_id=c.id).all()
             roster_names = [s.name for s in roster_students]
-            roster_names_lower = [n.lower() for n in roster_names]
-            claimed = set()
-
-            for r in records:
-                s_name = r.get('Name', '').strip()
+            roster_names_lower = set(n.lower() for n in roster_names)
+            # Students added below join the roster for later rows, so they are scored as candidates
+            # up front and switched on in the masks when added
+            uploaded_names = [r.get('Name', '').strip() for r in records]
+            matcher = NameMatcher(uploaded_names, roster_names + [n.title() for n in uploaded_names])
+            on_roster = np.zeros(len(matcher.choices), dtype=bool)
+            on_roster[:len(roster_names)] = True
+            available = on_roster.copy()  # On the roster and not claimed by an earlier row
+
+            for r, s_name in zip(records, uploaded_names):
                 if not s_name:
                     continue
 
@@ -1921,23 +4525,21 @@ def upload_excel_scorelist():
                     continue
 
                 # Fuzzy match against unclaimed roster names
-                available = [n for n in roster_names if n not in claimed]
-                if not available:
-                    available = roster_names
-                if available:
-                    best = process.extractOne(s_name, available, scorer=fuzz.token_set_ratio)
+                if on_roster.any():
+                    best = matcher.best(s_name, available if available.any() else on_roster)
                     if best and best[1] >= 75:
                         # Correct the record's name to the official roster version
                         logger.info("[UPLOAD ROSTER] Corrected '{}' -> '{}' (score={})".format(s_name, best[0], best[1]))
                         r['Name'] = best[0]
-                        claimed.add(best[0])
+                        available[matcher.columns(best[0])] = False
                         continue
 
                 # No match at all — genuinely new student, add to roster
                 new_student = StudentModel(name=s_name.title(), class_id=c.id)
                 db.session.add(new_student)
-                roster_names.append(s_name.title())
-                roster_names_lower.append(s_name.lower())
+                on_roster[matcher.columns(s_name.title())] = True
+                available[matcher.columns(s_name.title())] = True
+                roster_names_lower.add(s_name.lower())
                 logger.info("[UPLOAD ROSTER] Added new student '{}' to class '{}'".format(s_name, class_name))
 
             db.session.commit()
@@ -1971,10 +4573,9 @@ def extract_names():
         
         known_names = []
         if target_class:
-            c = ClassModel.query.filter(func.lower(ClassModel.name) == target_class.lower()).first()
-            if c:
-                students = StudentModel.query.filter_by(class_id=c.id).all()
-                known_names = [s.name for s in students]
+            roster = class_roster(target_class)
+            if roster:
+                known_names = list(roster.names)
                 
         system_prompt = """
 You are an OCR assistant. I will provide an image of a handwritten or typed list of student names.
@@ -1988,42 +4589,18 @@ Return ONLY the raw JSON array. DO NOT wrap it in markdown block quotes like `js
         if known_names:
             system_prompt += "\nCRITICAL CONTEXT: Here is the authoritative list of known students in this class: {}. You MUST map the extracted handwritten names to exactly match a name from this list whenever visually possible.".format(known_names)
             
-        # Process with AI model — with retry + key rotation for rate limits
-        raw_text = None
-        for attempt in range(len(API_KEYS) if 'API_KEYS' in dir() else 3):
-            try:
-                model = genai.GenerativeModel(
-                    'gemini-2.5-flash',
-                    generation_config=genai.GenerationConfig(
-                        thinking_config=genai.types.ThinkingConfig(
-                            thinking_budget=8192
-                        )
-                    )
-                )
-                contents = [system_prompt, {"mime_type": "image/jpeg", "data": img_b64}]
-                response = model.generate_content(contents)
-                # Extract text — handle thinking mode responses where thoughts may be separate parts
-                raw_text = ''
-                if hasattr(response, 'candidates') and response.candidates:
-                    for part in response.candidates[0].content.parts:
-                        if hasattr(part, 'thought') and part.thought:
-                            continue  # Skip thought blocks, we only want the final JSON
-                        if hasattr(part, 'text') and part.text:
-                            raw_text += part.text
-                if not raw_text:
-                    raw_text = response.text.strip()
-                raw_text = raw_text.strip()
-                break
-            except Exception as model_err:
-                err_str = str(model_err).lower()
-                if 'quota' in err_str or 'rate' in err_str or '429' in err_str or 'resource' in err_str:
-                    rotate_api_key()
-                    time.sleep(min(3 * (attempt + 1), 10))
-                else:
-                    raise
-        if not raw_text:
-            raise Exception('All API keys exhausted')
-        
+        # Process with AI model — cached, with retry + key rotation for rate limits
+        # (_call_gemini already skips thought blocks in thinking-mode responses)
+        generation_config = genai.GenerationConfig(
+            thinking_config=genai.types.ThinkingConfig(
+                thinking_budget=8192
+            )
+        )
+        contents = [system_prompt, {"mime_type": "image/jpeg", "data": img_b64}]
+        # Name lists carry no colour cues, so grayscale is safe here
+        raw_text = _call_gemini(AI_MODEL_PRIMARY, contents, generation_config=generation_config, expect_json=True,
+                                preprocess={"grayscale": True})
+
         if raw_text.startswith("```json"):
             raw_text = raw_text[7:]
         if raw_text.endswith("```"):
@@ -2032,12 +4609,13 @@ Return ONLY the raw JSON array. DO NOT wrap it in markdown block quotes like `js
         result_json = json.loads(raw_text.strip())
         
         final_names = []
-        for name in result_json:
-            name_str = str(name).strip().title()
-            if known_names:
-                best_matches = process.extract(name_str, known_names, scorer=fuzz.token_set_ratio, limit=1)
-                if best_matches and best_matches[0][1] >= 85:
-                    final_names.append(best_matches[0][0])
+        extracted_names = [str(name).strip().title() for name in result_json]
+        matcher = NameMatcher(extracted_names, known_names) if known_names else None
+        for name_str in extracted_names:
+            if matcher:
+                best = matcher.best(name_str)
+                if best and best[1] >= 85:
+                    final_names.append(best[0])
                 else:
                     final_names.append(name_str)
             else:
@@ -2049,6 +4627,131 @@ Return ONLY the raw JSON array. DO NOT wrap it in markdown block quotes like `js
         print("Error extracting names: {}".format(e))
         return jsonify({"error": str(e)}), 500
 
+# ═══════════════════════════════════════════════════════════════
+#  SCORE TEXT NORMALIZER
+#  Parses odd score text ("8 out of 10", "eight", "80%", "7½", "1O") locally
+#  with validate_and_cap_score's rules, so ai_resolve's weird_score only
+#  reaches the model for values that are genuinely ambiguous.
+# ═══════════════════════════════════════════════════════════════
+import functools
+
+SCORE_NUMBER_WORDS = {
+    "zero": 0, "nil": 0, "none": 0, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7,
+    "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12, "thirteen": 13, "fourteen": 14, "fifteen": 15,
+    "sixteen": 16, "seventeen": 17, "eighteen": 18, "nineteen": 19, "twenty": 20, "thirty": 30, "forty": 40,
+    "fourty": 40, "fifty": 50, "sixty": 60, "seventy": 70, "eighty": 80, "ninety": 90, "hundred": 100,
+}
+# Letters OCR and hurried handwriting mistake for digits; only applied to tokens that already hold a digit
+# or sit in an unambiguous "x/y" / "out of" slot
+SCORE_OCR_CONFUSIONS = str.maketrans({"O": "0", "o": "0", "D": "0", "Q": "0", "l": "1", "I": "1", "i": "1", "|": "1",
+                                      "S": "5", "s": "5", "B": "8", "Z": "2", "z": "2", "g": "9", "q": "9"})
+_SCORE_NUMBER = r"[0-9OoDQlIi|SsBZzgq]+(?:\.\d+)?"
+
+def _score_column_max(column_name):
+    """Mark book maximum for a column, or None when the column is unknown."""
+    config = NIGERIAN_MARK_BOOK_CONFIG
+    column = normalize_column_name(column_name) if column_name else None
+    if column in config["ca_columns"]:
+        return config["ca_columns"][column]["max"]
+    return {"Total CA": config["ca_total_max"], "Exam": config["exam_max"],
+            "Grand Total": config["grand_total_max"], "Total Score": config["grand_total_max"]}.get(column)
+
+def _score_column_maxes(column_name, col_max):
+    """Denominators that mean "out of the column max" — a CA that can be 20 accepts /20 too."""
+    column = normalize_column_name(column_name) if column_name else None
+    ca_info = NIGERIAN_MARK_BOOK_CONFIG["ca_columns"].get(column, {})
+    return {col_max, 20} if ca_info.get("can_be_20") else {col_max}
+
+def _score_number(token, in_slot=False):
+    """float for a numeric token with OCR confusions fixed, or None."""
+    if not in_slot and not re_mod.search(r"\d", token):
+        return None
+    try:
+        return float(token.translate(SCORE_OCR_CONFUSIONS))
+    except ValueError:
+        return None
+
+def _score_words(text):
+    """Number for "eight", "twenty-five", "eight and a half", or None."""
+    words = re_mod.sub(r"[-,]", " ", text).split()
+    total, seen = 0.0, False
+    for i, word in enumerate(words):
+        if word in ("and", "a") and i + 1 < len(words):
+            continue
+        if word == "half" and seen:
+            total += 0.5
+        elif word == "hundred" and seen:
+            total *= 100
+        elif word in SCORE_NUMBER_WORDS:
+            total += SCORE_NUMBER_WORDS[word]
+            seen = True
+        else:
+            return None
+    return total if seen else None
+
+@functools.lru_cache(maxsize=4096)
+def normalize_score_text(value, column_name=None, max_score=None):
+    """Normalize free-form score text to validate_and_cap_score's output.
+    Returns (score, warnings, reasoning), with score 'ABS' for absent markers,
+    or None when the text is ambiguous and needs a human (or the model).
+    Percentages are scaled to the column max (max_score, else the mark book
+    max for column_name); x/y keeps the numerator, as validate_and_cap_score does, but
+    only when y is the column max: any other y is ambiguous. So are values
+    validate_and_cap_score would cap."""
+    column = column_name or "Score"
+    col_max = max_score or _score_column_max(column_name)
+    text = unicodedata.normalize("NFKC", str(value)).strip()
+    # NFKC turns "7½" into "71⁄2"; mark the fraction off so it can't merge with the whole part
+    text = re_mod.sub(r"(\d*)(\d)⁄(\d+)", lambda m: "{} {}/{}".format(m.group(1) or 0, m.group(2), m.group(3)), text)
+    text = text.replace("⁄", "/").strip(" .:;=")
+    if text.upper() in [m.upper() for m in NIGERIAN_MARK_BOOK_CONFIG["absent_markers"]] or text.lower() == "absent":
+        return ("ABS", (), "absent marker")
+    lower = text.lower()
+
+    # Mixed fraction: "7 1/2" (numerator smaller than a denominator of 2-4)
+    match = re_mod.fullmatch(r"(\d+)\s+([123])\s*/\s*([234])", lower)
+    if match and int(match.group(2)) < int(match.group(3)):
+        number, reasoning = int(match.group(1)) + int(match.group(2)) / float(match.group(3)), "mixed fraction"
+    else:
+        number, reasoning = None, None
+
+    # Percentages: "80%", "80 percent" → share of the column max
+    match = re_mod.fullmatch(r"(" + _SCORE_NUMBER + r")\s*(?:%|per ?cent|pct)", text, re_mod.I) if number is None else None
+    if match:
+        pct = _score_number(match.group(1))
+        if pct is None or not col_max or pct > 100:
+            return None
+        number, reasoning = pct / 100.0 * col_max, "{:g}% of {:g}".format(pct, col_max)
+
+    # x/y, "x out of y", "x over y"
+    match = re_mod.fullmatch(r"(" + _SCORE_NUMBER + r"|[a-z -]+?)\s*(?:/|out of|over|of)\s*(" + _SCORE_NUMBER + r"|[a-z -]+?)", text, re_mod.I) if number is None else None
+    if match:
+        numerator = _score_number(match.group(1), in_slot=True)
+        if numerator is None:
+            numerator = _score_words(match.group(1).lower())
+        denominator = _score_number(match.group(2), in_slot=True)
+        if denominator is None:
+            denominator = _score_words(match.group(2).lower())
+        if numerator is None or not denominator or numerator > denominator:
+            return None
+        number, reasoning = numerator, "{:g} out of {:g}".format(numerator, denominator)
+        # Marked out of something other than the column max ("15/20" in a /10 CA): not ours to rescale
+        if col_max and denominator not in _score_column_maxes(column_name, col_max):
+            return None
+
+    if number is None:
+        number = _score_number(text) if re_mod.fullmatch(_SCORE_NUMBER, text) else None
+        reasoning = "plain number" if number is not None and re_mod.fullmatch(r"\d+(?:\.\d+)?", text) else "OCR letters read as digits"
+    if number is None:
+        number, reasoning = _score_words(lower), "number words"
+    if number is None:
+        return None
+    score, warnings = validate_and_cap_score(column, round(number, 2))
+    # Over-max or negative values were capped — a guess, not a reading; leave them to a human
+    if not isinstance(score, int) or warnings:
+        return None
+    return (score, tuple(warnings), reasoning)
+
 @app.route('/api/ai-resolve', methods=['POST'])
 def ai_resolve():
     """General-purpose AI resolver for sticky situations — called when the app hits ambiguity."""
@@ -2056,7 +4759,20 @@ def ai_resolve():
         data = request.json
         situation = data.get('situation', '')
         context = data.get('context', {})
-        
+
+        # Most "weird" scores parse locally; only ambiguous ones go to the model
+        if situation == 'weird_score' and context.get('value') is not None:
+            try:
+                max_score = float(context.get('max')) if context.get('max') else None
+            except (TypeError, ValueError):
+                max_score = None
+            local = normalize_score_text(str(context['value']), context.get('column') or context.get('assessment_type'), max_score)
+            if local:
+                score, warnings, reasoning = local
+                return jsonify({"success": True, "result": {
+                    "normalized_score": score, "original": context['value'],
+                    "reasoning": "; ".join((reasoning,) + warnings), "source": "local"}}), 200
+
         resolver_prompts = {
             'unreadable_name': """A student's name could not be read from their test script.
 Here is the context: {context}
@@ -2094,23 +4810,8 @@ Return JSON: {{"friendly_message": "...", "suggestion": "...", "can_retry": true
         prompt = template.format(**context) if context else template
         prompt += "\n\nReturn ONLY raw JSON. Do NOT wrap in markdown."
         
-        # Process with AI — retry + rotate on rate limits
-        raw_text = None
-        for attempt in range(len(API_KEYS) if 'API_KEYS' in dir() else 3):
-            try:
-                model = genai.GenerativeModel('gemini-2.5-flash')
-                response = model.generate_content(prompt)
-                raw_text = response.text.strip()
-                break
-            except Exception as model_err:
-                err_str = str(model_err).lower()
-                if 'quota' in err_str or 'rate' in err_str or '429' in err_str or 'resource' in err_str:
-                    rotate_api_key()
-                    time.sleep(min(3 * (attempt + 1), 10))
-                else:
-                    raise
-        if not raw_text:
-            raise Exception('All API keys exhausted')
+        # Process with AI — scheduled across the key pool, retried on rate limits
+        raw_text = _call_gemini(AI_MODEL_PRIMARY, [prompt])
         
         if raw_text.startswith("```json"):
             raw_text = raw_text[7:]
@@ -2138,21 +4839,24 @@ def move_student():
             return jsonify({"error": "Missing student name, source class, or target class"}), 400
         
         # Find source class and student
-        source = ClassModel.query.filter(func.lower(ClassModel.name) == from_class.lower()).first()
+        source = class_roster(from_class)
         if not source:
             return jsonify({"error": "Source class '{}' not found".format(from_class)}), 404
         
-        student = StudentModel.query.filter_by(class_id=source.id, name=student_name).first()
-        if not student:
+        student_id = source.find(student_name)
+        if student_id is None:
             # Try fuzzy match
-            existing = StudentModel.query.filter_by(class_id=source.id).all()
-            names = [s.name for s in existing]
-            if names:
-                best = process.extractOne(student_name, names, scorer=fuzz.token_set_ratio)
-                if best and best[1] >= 80:
-                    student = StudentModel.query.filter_by(class_id=source.id, name=best[0]).first()
-            if not student:
-                return jsonify({"error": "Student '{}' not found in {}".format(student_name, from_class)}), 404
+            best = source.index.best(student_name)
+            if best and best[1] >= 80:
+                student_id = source.find(best[0])
+        student = db.session.get(StudentModel, student_id) if student_id is not None else None
+        if student is None or student.class_id != source.id:
+            # Point at the class they are actually in, if the name is on another roster
+            elsewhere = roster_name_index().lookup(student_name, limit=1)
+            if elsewhere and elsewhere[0][1] >= 85 and elsewhere[0][2] != source.name:
+                return jsonify({"error": "Student '{}' not found in {}. Did you mean {} in {}?".format(
+                    student_name, from_class, elsewhere[0][0], elsewhere[0][2])}), 404
+            return jsonify({"error": "Student '{}' not found in {}".format(student_name, from_class)}), 404
         
         # Ensure target class exists
         target = ClassModel.query.filter(func.lower(ClassModel.name) == to_class.lower()).first()
@@ -2177,6 +4881,208 @@ def move_student():
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+SCAN_ROSTER_CONTEXT = """
+
+===== MANDATORY NAME MATCHING =====
+This image belongs to class '{class_name}'. There are {count} students enrolled in this class.
+Here is the COMPLETE OFFICIAL ROSTER — every name the AI outputs MUST come from this list:
+
+{numbered_roster}
+
+RULES FOR NAME MATCHING:
+- For EVERY row in the handwritten table, you MUST assign the "name" field to the CLOSEST matching name from the roster above.
+- The handwriting may be messy, abbreviated, or misspelled. Use your best judgment to match each handwritten name to the correct roster entry.
+- NEVER output a name that is NOT in the roster above. NEVER leave a name as empty string "".
+- NEVER skip a student row. If you can see a row with scores, there MUST be a name for it.
+- The number of rows you extract should approximately match the number of students in the roster ({count}).
+- If you truly cannot determine which roster name a row belongs to, use your BEST GUESS from the roster — a wrong guess from the roster is better than an empty name or an invented name.
+===================================="""
+
+SCAN_NO_ROSTER_CONTEXT = """
+
+===== NAME EXTRACTION (NO ROSTER AVAILABLE) =====
+No class roster was provided for matching. You must read names directly from the handwriting.
+RULES:
+- Read EVERY name carefully, character by character. Nigerian names are often multi-part (e.g. "Abdulkareem Ihtimod Oyewumi").
+- NEVER leave a name blank. Every row with scores MUST have a name.
+- NEVER invent or guess names. Only write what you can actually SEE in the handwriting.
+- If a name is partially readable, write the readable parts and use "?" for unclear characters.
+- Pay attention to common Nigerian name patterns: Abdul-, Ade-, Ola-, Ayo-, Oba-, etc.
+=================================================="""
+
+SCAN_PROMPT_HEAD = """
+You are an expert OCR and data extraction AI specializing in Nigerian school record sheets. A teacher has uploaded image(s) of a handwritten document.
+
+"""
+
+SCAN_PROMPT_RULES = """
+
+YOUR JOB: Read ALL the images and produce ONE combined JSON array of row objects representing the table data.
+
+CRITICAL RULES:
+1. **OUTPUT FORMAT**: Return ONLY a raw JSON array. Start with [ and end with ]. No markdown, no backticks, no explanations.
+2. **COLUMN NAMING**: 
+   - The student name column MUST always be keyed as "name" (lowercase).
+   - If the teacher says "extract everything" or "all columns", auto-detect every column from the HEADER ROW and use readable names.
+3. **ONLY EXTRACT WHAT IS PHYSICALLY WRITTEN**: 
+   - Do NOT compute, calculate, or generate any values. Only extract what you can SEE written on the paper.
+   - Do NOT add columns like "Grade", "Remarks", "Position", "Rank" etc. unless they are PHYSICALLY WRITTEN as a column on the sheet.
+   - If you see columns like "Total CA", "Exam", "Grand Total" written on the sheet with handwritten values, extract them.
+4. **COMMON COLUMN HEADERS** (detect even if handwritten messily):
+   - "1st CA" / "1st Test" = First Continuous Assessment
+   - "2nd CA" / "2nd Test" = Second Continuous Assessment  
+   - "Open Day" / "Open" = Open Day score
+   - "Note" / "NB" / "Note Book" = Notebook score
+   - "Ass" / "Assig" / "Assignment" = Assignment score
+   - "Attend" / "Attendance" = Attendance score
+   - "Total CA" = Total Continuous Assessment
+   - "Exam" = Examination score
+   - "Grand Total" / "Total" = Final total score
+5. **FRACTIONAL SCORES**: Convert fractions: 6½ → 6.5, 8½ → 8.5, 7½ → 7.5. If unsure, round to nearest 0.5.
+6. **OVERWRITTEN VALUES**: If crossed out and rewritten, use the CORRECTED value.
+7. **MISSING/UNREADABLE SCORES**: Mark completely unreadable or missing scores as exactly `null` (not "", not 0). This signals a gap for review.
+8. **NAMES ARE MANDATORY**: Every single row MUST have a non-empty "name" field. NEVER output a row with an empty or missing name.
+9. **SERIAL NUMBERS**: Do NOT include the S/N column unless specifically asked.
+10. **MULTI-IMAGE**: If multiple images show pages of the SAME class, combine all rows into one array.
+11. **NUMERIC VALUES**: All score values should be numbers (integers or decimals), NOT strings. Use 0 for zero, "" for missing.
+12. **ROW-BY-ROW VERIFICATION**: For each row, verify: Is the name assigned? Are scores in correct columns? Do numbers make sense (CAs: 0-10, Exam: 0-70)?
+13. **ROW POSITION**: Give every row two extra keys: "_page" = which image it is on (1 for the first image) and "_y" = the vertical centre of the row as a fraction of that image's height (0 = top, 1 = bottom, two decimals).
+"""
+
+def _scan_roster_prefix(class_obj):
+    """Static part of the scan-to-Excel prompt (rules + numbered roster), built once per
+    (class, roster version). Returns (PromptPrefix, roster_names); class_obj (a ClassRoster) None = no roster."""
+    def build():
+        roster_names = list(class_obj.names) if class_obj is not None else []
+        if roster_names:
+            # Build a numbered roster for the AI to use as a lookup table
+            numbered_roster = '\n'.join(['  {}. {}'.format(i+1, name) for i, name in enumerate(roster_names)])
+            roster_context = SCAN_ROSTER_CONTEXT.format(class_name=class_obj.name, count=len(roster_names), numbered_roster=numbered_roster)
+        else:
+            roster_context = SCAN_NO_ROSTER_CONTEXT
+        return (SCAN_PROMPT_HEAD + roster_context + SCAN_PROMPT_RULES, roster_names)
+    return _cached_prompt_prefix(("scan", class_obj.id if class_obj is not None else None, roster_version()), build)
+
+SCAN_GAP_BAND_MIN = 0.02  # Smallest half-height of a row crop, as a fraction of the page
+SCAN_GAP_HEADER_MAX = 0.3  # Tallest header crop above the first row
+
+SCAN_GAP_PROMPT = """
+You are filling gaps in a table already extracted from a Nigerian school record sheet.
+The images are crops of the original sheet, in this order:
+{crops}
+
+COLUMNS: {columns}
+ROWS WITH GAPS (one per line; "missing" lists the unreadable cells):
+{rows}
+
+Rules:
+1. Use the image crops as the source of truth, not rigid math.
+2. If you can SEE the value clearly in the handwriting, use it.
+3. If you can logically INFER it from the row's other values and visible column totals, prefix it with ~ (e.g. "~8").
+4. If you truly cannot determine it, use null.
+5. Return ONLY a JSON array with one object per row above: {{"row": <row number>, "<missing column>": <value>, ...}}. No explanation, no markdown.
+"""
+
+def _scan_row_position(row, page_count):
+    """(page index, y fraction) reported by Pass 1 for a row, or (page, None) / (None, None) when unusable."""
+    try:
+        page = int(row.get('_page')) - 1
+    except (TypeError, ValueError):
+        page = 0 if page_count == 1 else None
+    if page is not None and not 0 <= page < page_count:
+        page = None
+    try:
+        y = float(row.get('_y'))
+    except (TypeError, ValueError):
+        return (page, None)
+    return (page, y if 0 <= y <= 1 else None)
+
+def _scan_gap_crops(extracted_data, gap_rows, image_parts):
+    """Image parts for Pass 2: per page, the header band plus merged bands around the gap rows.
+    Pages whose gap rows have no usable position are sent whole. Returns (parts, crop labels)."""
+    positions = [_scan_row_position(row, len(image_parts)) for row in extracted_data]
+    bands, whole_pages = {}, set()
+    for i in gap_rows:
+        page, y = positions[i]
+        if page is None:
+            whole_pages.update(range(len(image_parts)))
+        elif y is None:
+            whole_pages.add(page)
+        else:
+            bands.setdefault(page, []).append((y, i))
+
+    parts, labels = [], []
+    for page in range(len(image_parts)):
+        raw = _image_part_bytes(image_parts[page])
+        if page in whole_pages:
+            parts.append({"mime_type": image_parts[page].get("mime_type", "image/jpeg"), "data": raw})
+            labels.append("page {}, whole page".format(page + 1))
+            continue
+        if page not in bands:
+            continue
+        # Band height follows the row spacing Pass 1 saw on this page
+        ys = sorted(y for p, y in positions if p == page and y is not None)
+        gaps = [b - a for a, b in zip(ys, ys[1:]) if b > a]
+        half = max(SCAN_GAP_BAND_MIN, 0.75 * sorted(gaps)[len(gaps) // 2]) if gaps else SCAN_GAP_BAND_MIN * 2
+        header_bottom = ys[0] - half
+        if header_bottom > 0.01:
+            parts.append({"mime_type": "image/jpeg", "data": _preprocess_image(raw, crop_box=[0, max(0, header_bottom - SCAN_GAP_HEADER_MAX), 1, header_bottom])})
+            labels.append("page {}, column headers".format(page + 1))
+        merged = []
+        for y, i in sorted(bands[page]):
+            top, bottom = max(0, y - half), min(1, y + half)
+            if merged and top <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], bottom)
+                merged[-1][2].append(i)
+            else:
+                merged.append([top, bottom, [i]])
+        for top, bottom, rows in merged:
+            parts.append({"mime_type": "image/jpeg", "data": _preprocess_image(raw, crop_box=[0, top, 1, bottom])})
+            labels.append("page {}, row(s) {}".format(page + 1, ", ".join(str(i + 1) for i in rows)))
+    return (parts, labels)
+
+def _scan_fill_gaps(extracted_data, image_parts):
+    """Pass 2: re-read only the rows that have null cells, from crops of those rows, and
+    merge the answers into extracted_data in place. Returns the number of cells filled."""
+    gap_rows = [i for i, row in enumerate(extracted_data)
+                if any(v is None for k, v in row.items() if not k.startswith('_'))]
+    if not gap_rows:
+        return 0
+    columns = [k for k in extracted_data[0].keys() if not k.startswith('_')]
+    row_lines = []
+    for i in gap_rows:
+        row = extracted_data[i]
+        row_lines.append(json.dumps({
+            "row": i + 1,
+            "values": {k: v for k, v in row.items() if v is not None and not k.startswith('_')},
+            "missing": [k for k, v in row.items() if v is None and not k.startswith('_')],
+        }, separators=(',', ':')))
+    crop_parts, labels = _scan_gap_crops(extracted_data, gap_rows, image_parts)
+    prompt = SCAN_GAP_PROMPT.format(
+        crops='\n'.join("  Image {}: {}".format(n + 1, label) for n, label in enumerate(labels)),
+        columns=json.dumps(columns), rows='\n'.join(row_lines))
+    # Fallback model is fine for the simpler gap-filling task; crops are already preprocessed
+    raw_text = _call_gemini(AI_MODEL_FALLBACK, [prompt] + crop_parts, expect_json=True, preprocess=False)
+    answers = json.loads(_strip_json_fences(raw_text))
+    if not isinstance(answers, list):
+        return 0
+    filled = 0
+    for answer in answers:
+        if not isinstance(answer, dict):
+            continue
+        try:
+            i = int(answer.get('row')) - 1
+        except (TypeError, ValueError):
+            continue
+        if i not in gap_rows:
+            continue
+        row = extracted_data[i]
+        for k, v in answer.items():
+            if k in row and row[k] is None and v is not None:
+                row[k] = v
+                filled += 1
+    return filled
+
 @app.route('/api/assistant-scan-to-excel', methods=['POST'])
 def assistant_scan_to_excel():
     """Receives an image + instruction, uses Vision AI to extract a table, returns an Excel file."""
@@ -2241,107 +5147,43 @@ def assistant_scan_to_excel():
             instruction = "extract all columns"
         
         # Build optional roster context for smarter OCR
-        roster_context = ""
         roster_names = []
         matched_class = None
         if class_name:
             # Fuzzy class name lookup: "ss1s" should match "SS 1S"
             # First try exact (case-insensitive)
-            c = ClassModel.query.filter(func.lower(ClassModel.name) == class_name.lower()).first()
+            c = class_roster(class_name)
             if not c:
                 # Normalize: strip spaces/punctuation and compare
                 normalized_input = re_mod.sub(r'[^a-zA-Z0-9]', '', class_name).lower()
-                all_classes = ClassModel.query.all()
-                for cls in all_classes:
-                    normalized_db = re_mod.sub(r'[^a-zA-Z0-9]', '', cls.name).lower()
+                class_names = roster_class_names()
+                for name in class_names:
+                    normalized_db = re_mod.sub(r'[^a-zA-Z0-9]', '', name).lower()
                     if normalized_db == normalized_input:
-                        c = cls
+                        c = class_roster(name)
                         break
                 # If still not found, use thefuzz with a VERY strict threshold (classes differ by 1 letter often)
-                if not c and all_classes:
-                    class_names = [cls.name for cls in all_classes]
-                    best = process.extractOne(class_name, class_names, scorer=fuzz.token_set_ratio)
+                if not c and class_names:
+                    best = NameMatcher([class_name], class_names).best(class_name)
                     if best and best[1] >= 95:
-                        c = next((cls for cls in all_classes if cls.name == best[0]), None)
+                        c = class_roster(best[0])
             
             if c:
                 matched_class = c
-                students = StudentModel.query.filter_by(class_id=c.id).all()
-                if students:
-                    roster_names = [s.name for s in students]
-                    # Build a numbered roster for the AI to use as a lookup table
-                    numbered_roster = '\n'.join(['  {}. {}'.format(i+1, name) for i, name in enumerate(roster_names)])
-                    roster_context = """
-
-===== MANDATORY NAME MATCHING =====
-This image belongs to class '{class_name}'. There are {count} students enrolled in this class.
-Here is the COMPLETE OFFICIAL ROSTER — every name the AI outputs MUST come from this list:
-
-{numbered_roster}
-
-RULES FOR NAME MATCHING:
-- For EVERY row in the handwritten table, you MUST assign the "name" field to the CLOSEST matching name from the roster above.
-- The handwriting may be messy, abbreviated, or misspelled. Use your best judgment to match each handwritten name to the correct roster entry.
-- NEVER output a name that is NOT in the roster above. NEVER leave a name as empty string "".
-- NEVER skip a student row. If you can see a row with scores, there MUST be a name for it.
-- The number of rows you extract should approximately match the number of students in the roster ({count}).
-- If you truly cannot determine which roster name a row belongs to, use your BEST GUESS from the roster — a wrong guess from the roster is better than an empty name or an invented name.
-====================================""".format(class_name=c.name, count=len(roster_names), numbered_roster=numbered_roster)
+                prompt_prefix, roster_names = _scan_roster_prefix(c)
         
-        # No-roster fallback: class not in DB or no students yet
-        if not roster_names and not roster_context:
-            roster_context = """
-
-===== NAME EXTRACTION (NO ROSTER AVAILABLE) =====
-No class roster was provided for matching. You must read names directly from the handwriting.
-RULES:
-- Read EVERY name carefully, character by character. Nigerian names are often multi-part (e.g. "Abdulkareem Ihtimod Oyewumi").
-- NEVER leave a name blank. Every row with scores MUST have a name.
-- NEVER invent or guess names. Only write what you can actually SEE in the handwriting.
-- If a name is partially readable, write the readable parts and use "?" for unclear characters.
-- Pay attention to common Nigerian name patterns: Abdul-, Ade-, Ola-, Ayo-, Oba-, etc.
-=================================================="""
+        if not roster_names:
+            # No-roster fallback: class not in DB or no students yet
+            prompt_prefix, _ = _scan_roster_prefix(None)
         
         prompt = """
-You are an expert OCR and data extraction AI specializing in Nigerian school record sheets. A teacher has uploaded image(s) of a handwritten document.
-
-TEACHER'S INSTRUCTION: "{instruction}"{roster_context}
-
-YOUR JOB: Read ALL the images and produce ONE combined JSON array of row objects representing the table data.
-
-CRITICAL RULES:
-1. **OUTPUT FORMAT**: Return ONLY a raw JSON array. Start with [ and end with ]. No markdown, no backticks, no explanations.
-2. **COLUMN NAMING**: 
-   - The student name column MUST always be keyed as "name" (lowercase).
-   - If the teacher says "extract everything" or "all columns", auto-detect every column from the HEADER ROW and use readable names.
-3. **ONLY EXTRACT WHAT IS PHYSICALLY WRITTEN**: 
-   - Do NOT compute, calculate, or generate any values. Only extract what you can SEE written on the paper.
-   - Do NOT add columns like "Grade", "Remarks", "Position", "Rank" etc. unless they are PHYSICALLY WRITTEN as a column on the sheet.
-   - If you see columns like "Total CA", "Exam", "Grand Total" written on the sheet with handwritten values, extract them.
-4. **COMMON COLUMN HEADERS** (detect even if handwritten messily):
-   - "1st CA" / "1st Test" = First Continuous Assessment
-   - "2nd CA" / "2nd Test" = Second Continuous Assessment  
-   - "Open Day" / "Open" = Open Day score
-   - "Note" / "NB" / "Note Book" = Notebook score
-   - "Ass" / "Assig" / "Assignment" = Assignment score
-   - "Attend" / "Attendance" = Attendance score
-   - "Total CA" = Total Continuous Assessment
-   - "Exam" = Examination score
-   - "Grand Total" / "Total" = Final total score
-5. **FRACTIONAL SCORES**: Convert fractions: 6½ → 6.5, 8½ → 8.5, 7½ → 7.5. If unsure, round to nearest 0.5.
-6. **OVERWRITTEN VALUES**: If crossed out and rewritten, use the CORRECTED value.
-7. **MISSING/UNREADABLE SCORES**: Mark completely unreadable or missing scores as exactly `null` (not "", not 0). This signals a gap for review.
-8. **NAMES ARE MANDATORY**: Every single row MUST have a non-empty "name" field. NEVER output a row with an empty or missing name.
-9. **SERIAL NUMBERS**: Do NOT include the S/N column unless specifically asked.
-10. **MULTI-IMAGE**: If multiple images show pages of the SAME class, combine all rows into one array.
-11. **NUMERIC VALUES**: All score values should be numbers (integers or decimals), NOT strings. Use 0 for zero, "" for missing.
-12. **ROW-BY-ROW VERIFICATION**: For each row, verify: Is the name assigned? Are scores in correct columns? Do numbers make sense (CAs: 0-10, Exam: 0-70)?
-""".format(instruction=instruction, roster_context=roster_context)
+TEACHER'S INSTRUCTION: "{instruction}"
+""".format(instruction=instruction)
 
         # Call AI using centralized helper with retry + key rotation
         try:
-            query_parts = [prompt] + image_parts
-            raw_text = _call_gemini(AI_MODEL_PRIMARY, query_parts)
+            query_parts = [prompt_prefix, prompt] + image_parts
+            raw_text = _call_gemini(AI_MODEL_PRIMARY, query_parts, expect_json=True)
         except Exception as ai_err:
             err_str = str(ai_err).lower()
             logger.error("OCR scan AI failed after retries: {}".format(ai_err))
@@ -2358,36 +5200,20 @@ CRITICAL RULES:
         if not isinstance(extracted_data, list) or len(extracted_data) == 0:
             return jsonify({"error": "No valid data or table found in the image based on your instructions."}), 400
             
-        # --- PASS 2: AI Smart Gap-Filling ---
-        null_count = sum(1 for row in extracted_data for k, v in row.items() if v is None)
+        # --- PASS 2: AI Smart Gap-Filling (only the rows with gaps, from crops of those rows) ---
+        null_count = sum(1 for row in extracted_data for k, v in row.items() if v is None and not k.startswith('_'))
         if null_count > 0:
             logger.info("Found {} null cells. Triggering Pass 2 Smart Fill...".format(null_count))
-            pass2_prompt = """
-You are reviewing a partially extracted Nigerian school record sheet.
-Here is what was extracted so far (null = unreadable):
-{}
-
-Using the ORIGINAL IMAGE, fill in ONLY the null cells.
-Rules:
-1. Use the image as the source of truth, not rigid math.
-2. If you can SEE the value clearly in the handwriting, use it.
-3. If you can logically INFER it from the row's other values and visible column totals, prefix it with ~ (e.g. "~8").
-4. If you truly cannot determine it, leave it null.
-5. Return ONLY the same JSON array structure with nulls filled. No explanation, no markdown.
-""".format(json.dumps(extracted_data, indent=2))
-            
             try:
-                pass2_query = [pass2_prompt] + image_parts
-                # Fallback model is fine for the simpler gap-filling task
-                pass2_raw = _call_gemini(AI_MODEL_FALLBACK, pass2_query)
-                pass2_raw = re_mod.sub(r'^```(?:json)?\s*', '', pass2_raw)
-                pass2_raw = re_mod.sub(r'\s*```$', '', pass2_raw)
-                pass2_data = json.loads(pass2_raw.strip())
-                if isinstance(pass2_data, list) and len(pass2_data) == len(extracted_data):
-                    extracted_data = pass2_data
-                    logger.info("Pass 2 Smart Fill successful.")
+                filled = _scan_fill_gaps(extracted_data, image_parts)
+                logger.info("Pass 2 Smart Fill filled {} of {} cells.".format(filled, null_count))
             except Exception as p2_err:
                 logger.warning("Pass 2 Smart Fill failed, falling back to Pass 1 data: {}".format(p2_err))
+
+        # Row positions were only needed for Pass 2 crops
+        for row in extracted_data:
+            row.pop('_page', None)
+            row.pop('_y', None)
                 
         # Clean up any remaining nulls back to "" for the frontend
         for row in extracted_data:
@@ -2397,15 +5223,17 @@ Rules:
         
         # Post-OCR fuzzy name correction against the roster
         if roster_names:
+            roster_set = set(roster_names)
+            matcher = NameMatcher([str(row.get('name', '')).strip() for row in extracted_data], roster_names)
             for row in extracted_data:
                 ocr_name = str(row.get('name', '')).strip()
                 if not ocr_name:
                     continue
                 # Check if name already matches roster exactly
-                if ocr_name in roster_names:
+                if ocr_name in roster_set:
                     continue
                 # Fuzzy match against roster
-                best = process.extractOne(ocr_name, roster_names, scorer=fuzz.token_set_ratio)
+                best = matcher.best(ocr_name)
                 if best and best[1] >= 75:
                     row['name'] = best[0]  # Correct to official roster spelling
         
@@ -2469,12 +5297,13 @@ def assistant_build_excel():
             if name_col and ex_name_col:
                 ex_names = existing_df[ex_name_col].apply(lambda x: str(x).strip()).tolist()
                 valid_ex_names = [n for n in ex_names if str(n).lower() not in ['nan', 'none', '']]
+                matcher = NameMatcher([str(df.at[idx, name_col]).strip() for idx in df.index], valid_ex_names)
                 
                 for idx in df.index:
                     ocr_name = str(df.at[idx, name_col]).strip()
                     if not ocr_name or ocr_name.lower() in ['nan', 'none', '']: continue
                     
-                    best = process.extractOne(ocr_name, valid_ex_names, scorer=fuzz.token_set_ratio)
+                    best = matcher.best(ocr_name)
                     if best and best[1] >= 75:
                         matched_name = best[0]
                         # Account for potential duplicate names in existing_df; just take first
@@ -2498,11 +5327,11 @@ def assistant_build_excel():
         # --- PHASE 1: Correct OCR names to official roster names ---
         # --- PHASE 2: Pad with unscanned roster students ---
         # This ensures ALL names in the output come from the class roster.
+        ambiguous_names = []  # Roster pairings the assignment could not call confidently
         if class_name:
-            c = ClassModel.query.filter(func.lower(ClassModel.name) == class_name.lower()).first()
+            c = class_roster(class_name)
             if c:
-                db_students = StudentModel.query.filter_by(class_id=c.id).all()
-                roster_names = [s.name for s in db_students]
+                roster_names = c.names
                 name_col = next((col for col in df.columns if str(col).lower() == 'name'), None)
                 class_col = next((col for col in df.columns if str(col).lower() == 'class'), None)
                 term_col = next((col for col in df.columns if str(col).lower() == 'term'), None)
@@ -2510,7 +5339,11 @@ def assistant_build_excel():
                 # PHASE 1: Correct every OCR name to the closest roster match
                 matched_roster_names = set()
                 if name_col and not df.empty and roster_names:
-                    for idx in df.index:
+                    roster_set = set(roster_names)
+                    matcher = NameMatcher([str(n).strip() for n in df[name_col].tolist()], roster_names)
+                    available = np.ones(len(roster_names), dtype=bool)  # Roster names not taken by an exact match
+                    fuzzy_rows = []  # (matrix row, df index) of names that need a fuzzy match
+                    for row, idx in enumerate(df.index):
                         # Skip validation for rows belonging to OTHER classes in a multi-tab upload
                         if class_col:
                             row_class = str(df.at[idx, class_col]).strip()
@@ -2522,32 +5355,31 @@ def assistant_build_excel():
                             continue
                             
                         # Check if exact match
-                        if ocr_name in roster_names:
+                        if ocr_name in roster_set:
                             matched_roster_names.add(ocr_name)
+                            available[matcher.columns(ocr_name)] = False
                             continue
+                        fuzzy_rows.append((row, idx))
                             
-                        # Fuzzy match against unclaimed
-                        available_roster = [n for n in roster_names if n not in matched_roster_names]
-                        if not available_roster:
-                            available_roster = roster_names
-                        best = process.extractOne(ocr_name, available_roster, scorer=fuzz.token_set_ratio)
-                        if best and best[1] >= 75:
-                            df.at[idx, name_col] = best[0]
-                            matched_roster_names.add(best[0])
+                    # One-to-one pairing of the rest against the roster names still free
+                    assignment = matcher.assign(75, rows=[row for row, _ in fuzzy_rows], allowed=available)
+                    ambiguous_names = assignment["ambiguous"]
+                    for row, idx in fuzzy_rows:
+                        if row in assignment["pairs"]:
+                            roster_name = assignment["pairs"][row][0]
+                            df.at[idx, name_col] = roster_name
+                            matched_roster_names.add(roster_name)
                         else:
-                            print("[ROSTER] Dropped unrecognized name '{}' from preview (no roster match)".format(ocr_name))
+                            print("[ROSTER] Dropped unrecognized name '{}' from preview (no free roster match)".format(
+                                str(df.at[idx, name_col]).strip()))
                             df.drop(idx, inplace=True)
                 
                 # PHASE 2: Pad with roster students who had NO match in the scanned data
                 if name_col and roster_names:
                     current_names = [str(n).strip() for n in df[name_col].tolist() if pd.notna(n) and str(n).strip()] if not df.empty else []
                     missing_students = []
-                    for roster_name in roster_names:
-                        found = False
-                        if current_names:
-                            best = process.extractOne(roster_name, current_names, scorer=fuzz.token_set_ratio)
-                            if best and best[1] >= 85:
-                                found = True
+                    found_names = NameMatcher(roster_names, current_names).best_scores() >= 85
+                    for roster_name, found in zip(roster_names, found_names):
                         if not found:
                             row_dict = {name_col: roster_name}
                             for col in df.columns:
@@ -2802,7 +5634,8 @@ def assistant_build_excel():
         return jsonify({
             "success": True,
             "message": "Excel file ready! {} rows, {} columns.".format(len(df), len(df.columns)),
-            "download_url": "/api/download-edited-excel?file={}".format(output_filename)
+            "download_url": "/api/download-edited-excel?file={}".format(output_filename),
+            "ambiguous_names": ambiguous_names
         }), 200
         
     except Exception as e:
@@ -2864,23 +5697,8 @@ Return ONLY raw JSON. Example:
 {{"edits": [{{"type": "update_column", "column": "Assignment", "expression": "x + 5"}}], "summary": "Added 5 marks to Assignment column"}}
 """.format(columns=columns, rows=row_count, sample=sample, instruction=instruction)
         
-        # Call AI with retry
-        raw_text = None
-        for attempt in range(len(API_KEYS) if API_KEYS else 3):
-            try:
-                model = genai.GenerativeModel('gemini-2.5-flash')
-                response = model.generate_content(prompt)
-                raw_text = response.text.strip()
-                break
-            except Exception as model_err:
-                err_str = str(model_err).lower()
-                if 'quota' in err_str or 'rate' in err_str or '429' in err_str or 'resource' in err_str:
-                    rotate_api_key()
-                    time.sleep(min(3 * (attempt + 1), 10))
-                else:
-                    raise
-        if not raw_text:
-            raise Exception('All API keys exhausted')
+        # Call AI — scheduled across the key pool, retried on rate limits
+        raw_text = _call_gemini(AI_MODEL_PRIMARY, [prompt], max_retries=max(3, len(API_KEYS)))
         
         # Parse AI response
         if raw_text.startswith("```json"):
@@ -3038,6 +5856,439 @@ def download_edited_excel():
     return response
 
 
+# ═══════════════════════════════════════════════════════════════
+#  ASSISTANT DB SNAPSHOT
+#  The smart assistant's per-class context (roster sample, subjects, terms,
+#  grading progress) is built from aggregate queries and cached until a
+#  class, student or score row changes, so chat messages don't load scores.
+# ═══════════════════════════════════════════════════════════════
+ASSISTANT_ASSESSMENT_ORDER = ['1st CA', '2nd CA', 'Open Day', 'Note Book', 'Assignment', 'Exam']
+_assistant_snapshot = {"key": None, "value": None}
+_assistant_snapshot_lock = threading.Lock()
+
+def _build_assistant_snapshot():
+    """(class_data, grading_progress) for the assistant prompt, from four aggregate queries."""
+    classes = (db.session.query(ClassModel.id, ClassModel.name, func.count(StudentModel.id))
+               .outerjoin(StudentModel, StudentModel.class_id == ClassModel.id)
+               .group_by(ClassModel.id, ClassModel.name)
+               .order_by(ClassModel.name).all())
+    sample_names = {}
+    for class_id, name in db.session.query(StudentModel.class_id, StudentModel.name).order_by(StudentModel.class_id, StudentModel.name):
+        names = sample_names.setdefault(class_id, [])
+        if len(names) < MAX_STUDENTS_IN_CONTEXT:
+            names.append(name)
+    # {class_id: {subject: {"assessments": set, "terms": set}}}
+    breakdown = {}
+    for class_id, subject, term, assessment in (db.session.query(StudentModel.class_id, ScoreModel.subject_name, ScoreModel.term, ScoreModel.assessment_type)
+                                                .join(StudentModel, ScoreModel.student_id == StudentModel.id)
+                                                .group_by(StudentModel.class_id, ScoreModel.subject_name, ScoreModel.term, ScoreModel.assessment_type)):
+        subj = breakdown.setdefault(class_id, {}).setdefault(subject, {"assessments": set(), "terms": set()})
+        subj["assessments"].add(assessment)
+        subj["terms"].add(term)
+    students_scored = {(class_id, subject): count for class_id, subject, count in (
+        db.session.query(StudentModel.class_id, ScoreModel.subject_name, func.count(func.distinct(ScoreModel.student_id)))
+        .join(StudentModel, ScoreModel.student_id == StudentModel.id)
+        .group_by(StudentModel.class_id, ScoreModel.subject_name))}
+
+    class_data = {}
+    grading_progress = []  # Proactive suggestions for the AI
+    for class_id, class_name, student_count in classes:
+        subjects = breakdown.get(class_id, {}) if student_count else {}
+        subject_progress = {}
+        for subj in sorted(subjects):
+            subj_assessments = sorted(subjects[subj]["assessments"])
+            subj_terms = sorted(subjects[subj]["terms"])
+            subject_progress[subj] = {
+                "assessments_done": subj_assessments,
+                "terms_done": subj_terms,
+                "students_scored": students_scored.get((class_id, subj), 0)
+            }
+            # Figure out next logical assessment
+            missing = [a for a in ASSISTANT_ASSESSMENT_ORDER if a not in subj_assessments]
+            if missing:
+                grading_progress.append("{} → {} needs {} next for {}".format(
+                    class_name, subj, missing[0],
+                    subj_terms[0] if subj_terms else "1st Term"
+                ))
+        class_data[class_name] = {
+            "student_count": student_count,
+            "students": sample_names.get(class_id, []),
+            "assessments": sorted(set(a for v in subjects.values() for a in v["assessments"])),
+            "subjects": sorted(subjects),
+            "terms": sorted(set(t for v in subjects.values() for t in v["terms"])),
+            "subject_progress": subject_progress,
+            "has_scores": bool(subjects)
+        }
+    return (class_data, grading_progress)
+
+def _assistant_db_snapshot():
+    """Cached (class_data, grading_progress); rebuilt only after roster or score writes. Treat as read-only."""
+    key = (roster_version(), scores_version())
+    with _assistant_snapshot_lock:
+        if _assistant_snapshot["key"] == key:
+            return _assistant_snapshot["value"]
+    value = _build_assistant_snapshot()
+    with _assistant_snapshot_lock:
+        # A write during the build bumped the version: keep serving this build once, but don't store it
+        if key == (roster_version(), scores_version()):
+            _assistant_snapshot["key"] = key
+            _assistant_snapshot["value"] = value
+    return value
+
+# ═══════════════════════════════════════════════════════════════
+#  SCORE ANALYTICS
+#  Exact statistics over the scores table for the assistant's analysis
+#  actions: distributions, z-score/IQR anomalies, at-risk lists against the
+#  grade_map pass line and class comparisons. Results are cached per
+#  (class, subject, term) until a roster or score write.
+# ═══════════════════════════════════════════════════════════════
+ANALYTICS_PASS_LINE = min(low for low, high, grade, remark in NIGERIAN_MARK_BOOK_CONFIG["grade_map"] if remark != "Fail")
+ANALYTICS_Z_THRESHOLD = 2.0
+ANALYTICS_IQR_FACTOR = 1.5
+ANALYTICS_MIN_GROUP = 4  # Fewer scores than this: no outlier tests
+ANALYTICS_CACHE_SIZE = 64
+ANALYTICS_DERIVED_COLUMNS = {"Total CA", "Grade", "Remarks", "Position", "Rank", "Total Score", "Average"}
+_analytics_cache = OrderedDict()  # {(class, subject, term): ((roster_version, scores_version), result)}
+_analytics_cache_lock = threading.Lock()
+
+def _analytics_score(assessment, raw):
+    """(value, max) for a stored score string, or (None, None) if absent or unreadable."""
+    config = NIGERIAN_MARK_BOOK_CONFIG
+    val_str = str(raw).strip().replace('½', '.5').replace('¼', '.25').replace('¾', '.75')
+    if val_str.upper() in [m.upper() for m in config["absent_markers"]]:
+        return (None, None)
+    max_val = None
+    if '/' in val_str:
+        val_str, _, denominator = val_str.partition('/')
+        try:
+            max_val = float(denominator) or None
+        except ValueError:
+            pass
+    try:
+        value = float(val_str)
+    except ValueError:
+        return (None, None)
+    column = normalize_column_name(assessment)
+    if column in config["ca_columns"]:
+        info = config["ca_columns"][column]
+        max_val = 20 if info["can_be_20"] and value > 10 else info["max"]
+    elif column == "Exam":
+        max_val = config["exam_max"]
+    elif column == "Grand Total":
+        max_val = config["grand_total_max"]
+    return (value, max_val)
+
+def _describe_scores(values):
+    """count/mean/median/std/min/max/quartiles of a 1-D array, rounded for display."""
+    values = np.asarray(values, dtype=float)
+    if not values.size:
+        return {"count": 0}
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    return {
+        "count": int(values.size),
+        "mean": round(float(values.mean()), 1),
+        "median": round(float(median), 1),
+        "std": round(float(values.std(ddof=1)), 1) if values.size > 1 else 0.0,
+        "min": round(float(values.min()), 1),
+        "max": round(float(values.max()), 1),
+        "q1": round(float(q1), 1),
+        "q3": round(float(q3), 1),
+    }
+
+def _score_outliers(values):
+    """Per value, the reason it is unusual (z-score or IQR fence) or None."""
+    values = np.asarray(values, dtype=float)
+    reasons = [None] * values.size
+    if values.size < ANALYTICS_MIN_GROUP:
+        return reasons
+    mean, std = values.mean(), values.std(ddof=1)
+    q1, q3 = np.percentile(values, [25, 75])
+    low, high = q1 - ANALYTICS_IQR_FACTOR * (q3 - q1), q3 + ANALYTICS_IQR_FACTOR * (q3 - q1)
+    for i, value in enumerate(values):
+        z = (value - mean) / std if std > 0 else 0.0
+        if abs(z) > ANALYTICS_Z_THRESHOLD:
+            reasons[i] = "far {} the average of {:.1f} (z = {:+.1f})".format("above" if z > 0 else "below", mean, z)
+        elif q3 > q1 and not low <= value <= high:
+            reasons[i] = "outside the usual range {:g}–{:g}".format(round(max(low, 0), 1), round(high, 1))
+    return reasons
+
+def _analytics_frame(class_name=None, subject=None, term=None):
+    """One row per numeric score: class, student, subject, term, assessment, value, max."""
+    query = (db.session.query(ClassModel.name, StudentModel.name, ScoreModel.subject_name, ScoreModel.term,
+                              ScoreModel.assessment_type, ScoreModel.score_value)
+             .join(StudentModel, ScoreModel.student_id == StudentModel.id)
+             .join(ClassModel, StudentModel.class_id == ClassModel.id))
+    if class_name:
+        query = query.filter(func.lower(ClassModel.name) == class_name.strip().lower())
+    if subject:
+        query = query.filter(func.lower(ScoreModel.subject_name) == subject.strip().lower())
+    if term:
+        query = query.filter(ScoreModel.term == term)
+    rows = []
+    for cls, student, subj, trm, assessment, raw in query:
+        if assessment in ANALYTICS_DERIVED_COLUMNS:
+            continue
+        value, max_val = _analytics_score(assessment, raw)
+        if value is not None:
+            rows.append((cls, student, subj, trm, normalize_column_name(assessment), value, max_val))
+    return pd.DataFrame(rows, columns=["class", "student", "subject", "term", "assessment", "value", "max"])
+
+def _student_standing(scores):
+    """(standing out of 100, basis) for one student's {assessment: (value, max)} in a subject/term."""
+    if "Grand Total" in scores:
+        return (scores["Grand Total"][0], "grand total")
+    values = {a: v for a, (v, m) in scores.items()}
+    if "Exam" in values and any(a in NIGERIAN_MARK_BOOK_CONFIG["ca_columns"] for a in values):
+        derived, _ = compute_derived_scores(values)
+        if derived.get("Grand Total") not in (None, ""):
+            return (float(derived["Grand Total"]), "grand total")
+    marked = [(v, m) for v, m in scores.values() if m]
+    if not marked:
+        return (None, None)
+    return (100.0 * sum(v for v, m in marked) / sum(m for v, m in marked), "marks so far")
+
+def _build_score_analytics(class_name=None, subject=None, term=None):
+    frame = _analytics_frame(class_name, subject, term)
+    groups, anomalies, at_risk = [], [], []
+    for (cls, subj, trm), group in frame.groupby(["class", "subject", "term"], sort=True):
+        assessments = {}
+        for assessment, rows in group.groupby("assessment", sort=False):
+            assessments[assessment] = _describe_scores(rows["value"])
+            for (student, value, max_val), reason in zip(rows[["student", "value", "max"]].itertuples(index=False, name=None),
+                                                         _score_outliers(rows["value"])):
+                if max_val and value > max_val:
+                    reason = "{:g} is above the {:g}-mark maximum".format(value, max_val)
+                if reason:
+                    anomalies.append({"name": student, "class": cls, "subject": subj, "term": trm,
+                                      "assessment": assessment, "score": value, "reason": reason})
+        standings = {}
+        for student, rows in group.groupby("student", sort=True):
+            standing, basis = _student_standing({a: (v, m) for a, v, m in rows[["assessment", "value", "max"]].itertuples(index=False, name=None)})
+            if standing is not None:
+                standings[student] = standing
+                if standing < ANALYTICS_PASS_LINE:
+                    at_risk.append({"name": student, "class": cls, "subject": subj, "term": trm,
+                                    "score": round(standing, 1), "basis": basis, "grade": get_grade_and_remark(round(standing))[0]})
+        grades = {}
+        for standing in standings.values():
+            grade = get_grade_and_remark(round(standing))[0]
+            grades[grade] = grades.get(grade, 0) + 1
+        top = max(standings, key=standings.get) if standings else None
+        groups.append({
+            "class": cls, "subject": subj, "term": trm,
+            "students": len(standings),
+            "standing": _describe_scores(list(standings.values())),
+            "pass_rate": round(100.0 * sum(1 for s in standings.values() if s >= ANALYTICS_PASS_LINE) / len(standings), 1) if standings else None,
+            "grades": grades,
+            "top": {"name": top, "score": round(standings[top], 1)} if top else None,
+            "assessments": assessments,
+        })
+    comparisons = []
+    by_subject = {}
+    for g in groups:
+        if g["students"]:
+            by_subject.setdefault((g["subject"], g["term"]), []).append(g)
+    for (subj, trm), rivals in sorted(by_subject.items()):
+        if len(rivals) > 1:
+            ranked = sorted(rivals, key=lambda g: -g["standing"]["mean"])
+            comparisons.append({"subject": subj, "term": trm, "classes": [
+                {"class": g["class"], "students": g["students"], "mean": g["standing"]["mean"],
+                 "median": g["standing"]["median"], "pass_rate": g["pass_rate"]} for g in ranked]})
+    at_risk.sort(key=lambda s: s["score"])
+    return {"filters": {"class": class_name, "subject": subject, "term": term}, "pass_line": ANALYTICS_PASS_LINE,
+            "scores": int(len(frame)), "groups": groups, "anomalies": anomalies, "at_risk": at_risk, "comparisons": comparisons}
+
+def _score_analytics(class_name=None, subject=None, term=None):
+    """Cached analytics for a (class, subject, term) filter; None matches everything. Treat as read-only."""
+    key = tuple((v or '').strip().lower() for v in (class_name, subject, term))
+    version = (roster_version(), scores_version())
+    with _analytics_cache_lock:
+        entry = _analytics_cache.get(key)
+        if entry and entry[0] == version:
+            _analytics_cache.move_to_end(key)
+            return entry[1]
+    value = _build_score_analytics(class_name, subject, term)
+    with _analytics_cache_lock:
+        if version == (roster_version(), scores_version()):
+            _analytics_cache[key] = (version, value)
+            _analytics_cache.move_to_end(key)
+            while len(_analytics_cache) > ANALYTICS_CACHE_SIZE:
+                _analytics_cache.popitem(last=False)
+    return value
+
+def _analytics_summary(analytics, limit=15):
+    """Short lines for the assistant prompt: one per class/subject/term."""
+    lines = []
+    for g in analytics["groups"][:limit]:
+        if not g["students"]:
+            continue
+        lines.append("{} · {} · {}: {} students, mean {}, median {}, pass rate {}%, top {} ({}), {} at risk".format(
+            g["class"], g["subject"], g["term"], g["students"], g["standing"]["mean"], g["standing"]["median"],
+            g["pass_rate"], g["top"]["name"], g["top"]["score"],
+            sum(1 for s in analytics["at_risk"] if (s["class"], s["subject"], s["term"]) == (g["class"], g["subject"], g["term"]))))
+    if analytics["anomalies"]:
+        lines.append("{} unusual score(s) flagged".format(len(analytics["anomalies"])))
+    return "\n".join(lines) if lines else "No scores recorded yet."
+
+def _analytics_params(action, params, session_classes=()):
+    """Replace the model's numbers in an analysis action's params with exact ones from the scores table.
+    Single-class actions need a class: the one the model named, else the session's only class.
+    Without one the model was describing the unsaved session, so its answer is kept."""
+    term = params.get("assessment_type") if params.get("assessment_type") in NIGERIAN_MARK_BOOK_CONFIG["terms"] else params.get("term")
+    class_name = None
+    if action != "compare_classes":
+        class_name = params.get("class_name") or (session_classes[0] if len(session_classes) == 1 else None)
+        if not class_name:
+            return params
+    analytics = _score_analytics(class_name, params.get("subject_name"), term)
+    if not analytics["scores"]:
+        return params  # Nothing in the DB (e.g. only an unsaved session): keep the model's answer
+    params = dict(params)
+    if action == "find_at_risk":
+        params["at_risk"] = [{"name": s["name"], "score": s["score"], "class": s["class"]} for s in analytics["at_risk"]]
+    elif action == "flag_anomalies":
+        params["anomalies"] = [{"name": a["name"], "score": a["score"], "reason": "{}: {}".format(a["assessment"], a["reason"])}
+                               for a in analytics["anomalies"]]
+    elif action == "compare_classes":
+        params["insights"] = ["{} {}: {}".format(c["subject"], c["term"], ", ".join(
+            "{} mean {} ({}% pass)".format(r["class"], r["mean"], r["pass_rate"]) for r in c["classes"]))
+            for c in analytics["comparisons"]]
+    elif action == "analyze_scores":
+        params["insights"] = _analytics_summary(analytics).split("\n")
+    return params
+
+def _analytics_reply(action, params):
+    """Chat text for an analysis action whose params came from _analytics_params. Only counts from
+    those params, so the bubble can't contradict the card (the model's prose carries its own arithmetic)."""
+    if action == "find_at_risk":
+        n = len(params.get("at_risk") or [])
+        if not n:
+            return "Nobody is below the {}% pass line in the saved scores.".format(ANALYTICS_PASS_LINE)
+        return "{} student{} below the {}% pass line in the saved scores.".format(n, "" if n == 1 else "s", ANALYTICS_PASS_LINE)
+    if action == "flag_anomalies":
+        n = len(params.get("anomalies") or [])
+        if not n:
+            return "No unusual scores in the saved marks."
+        return "{} score{} look{} unusual — worth a second look.".format(n, "" if n == 1 else "s", "s" if n == 1 else "")
+    if action == "compare_classes":
+        return "Here's how the classes compare on the saved scores."
+    return "Here's the breakdown from the saved scores."
+
+@app.route('/api/analytics', methods=['GET'])
+def score_analytics():
+    """Score analytics for ?class=&subject=&term= (each optional)."""
+    try:
+        return jsonify(_score_analytics(request.args.get('class'), request.args.get('subject'), request.args.get('term'))), 200
+    except Exception as e:
+        logger.error("Analytics error: {}".format(e))
+        return jsonify({"error": str(e)}), 500
+
+# ═══════════════════════════════════════════════════════════════
+#  ASSISTANT INTENT FAST-PATH
+#  Short, unambiguous messages ("download", "show results", "yes") map
+#  straight to an action without a Gemini round-trip. Anything the rules
+#  aren't sure about (extra words, attachments, no prior action) goes to the LLM.
+# ═══════════════════════════════════════════════════════════════
+ASSISTANT_AT_RISK_FRACTION = ANALYTICS_PASS_LINE / 100.0  # Below the grade_map pass line is failing
+_INTENT_POLITE = r"(?:please |pls |kindly |can you |could you |i want to |let me )?"
+_INTENT_TAIL = r"(?: please| pls| now| for me)?"
+ASSISTANT_INTENT_RULES = [
+    ("confirm", re_mod.compile(r"(?:yes|yeah|yep|yup|ok|okay|sure|alright|do it|go ahead|proceed|continue|set it up|yes please|ok do it|yes do it|yes go ahead|please do)")),
+    ("export_data", re_mod.compile(_INTENT_POLITE + r"(?:download|export|save and download|get my excel|get the excel)(?: it| the| my)?(?: excel| file| results| scores| sheet| spreadsheet| mark ?book)?" + _INTENT_TAIL)),
+    ("view_standings", re_mod.compile(_INTENT_POLITE + r"(?:show|see|view|open)(?: me)?(?: the| my)?(?: results| scores| standings| rankings| positions)" + _INTENT_TAIL)),
+    ("edit_scores", re_mod.compile(_INTENT_POLITE + r"(?:fix|edit|review|correct)(?: the| my)? scores" + _INTENT_TAIL)),
+    ("add_class", re_mod.compile(_INTENT_POLITE + r"(?:add|create)(?: a)?(?: new)? class" + _INTENT_TAIL)),
+    ("find_at_risk", re_mod.compile(r"(?:who is|whos|who are|which students are|which student is|anyone) (?:failing|at risk)|(?:show|list)(?: me)?(?: the)? (?:failing|at risk) students")),
+]
+ASSISTANT_INTENT_REPLIES = {
+    "export_data": "Downloading your Excel now.",
+    "view_standings": "Here are the results.",
+    "edit_scores": "Opening the scores — tap any name or score to edit it.",
+    "add_class": "Opening the add-class form.",
+}
+# Actions the frontend can run without params. A reply proposing one as a question is held for
+# confirmation (needs_confirmation), and only those pending actions are confirmed without the LLM
+ASSISTANT_PARAMLESS_ACTIONS = {"export_data", "download_results", "view_standings", "edit_scores", "add_class", "update_roster"}
+_intent_stats = {"messages": 0, "fast_path": 0, "by_action": {}}
+_intent_stats_lock = threading.Lock()
+
+def _intent_text(message):
+    """Lower-case, punctuation-free, single-spaced message for the intent rules."""
+    text = re_mod.sub(r"[^a-z0-9 ]+", " ", message.lower().replace("'", ""))
+    return " ".join(text.split())
+
+def _intent_at_risk(current_results):
+    """at_risk params from the session's "score/max" results, or None if any score can't be read that way."""
+    at_risk = []
+    for r in current_results:
+        name = str(r.get('name', '')).strip()
+        match = re_mod.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*/\s*(\d+(?:\.\d+)?)\s*", str(r.get('score', '')))
+        if not name:
+            continue
+        if not match or float(match.group(2)) <= 0:
+            return None
+        if float(match.group(1)) < ASSISTANT_AT_RISK_FRACTION * float(match.group(2)):
+            at_risk.append({"name": name, "score": r.get('score'), "class": r.get('class', '')})
+    return at_risk
+
+def _assistant_fast_path(message, history, current_results, images):
+    """{"response", "action", "params"} for a high-confidence message, else None (ask the LLM)."""
+    text = _intent_text(message)
+    if images or not text or message.lstrip().startswith('[SYSTEM]') or len(text) > 60:
+        return None
+    intent = next((name for name, rule in ASSISTANT_INTENT_RULES if rule.fullmatch(text)), None)
+    if intent is None:
+        return None
+    if intent == "confirm":
+        # Only a paramless action the assistant's latest turn is still waiting on; an action that
+        # already ran, or one carrying params from client-sent history, is never replayed
+        last = next((h for h in reversed(history[:-1]) if h.get('role') != 'user'), None) or {}
+        action = last.get('action') or 'none'
+        if not last.get('needs_confirmation') or action not in ASSISTANT_PARAMLESS_ACTIONS:
+            return None
+        return {"response": "On it.", "action": action, "params": {}}
+    if intent == "find_at_risk":
+        at_risk = _intent_at_risk(current_results) if current_results else None
+        if at_risk is None:
+            return None
+        if not at_risk:
+            return {"response": "Nobody in this session is below {:.0f}% — everyone is passing.".format(ASSISTANT_AT_RISK_FRACTION * 100),
+                    "action": "none", "params": {}}
+        return {"response": "{} student{} below {:.0f}% in this session.".format(len(at_risk), "" if len(at_risk) == 1 else "s", ASSISTANT_AT_RISK_FRACTION * 100),
+                "action": "find_at_risk", "params": {"at_risk": at_risk}}
+    return {"response": ASSISTANT_INTENT_REPLIES[intent], "action": intent, "params": {}}
+
+def _record_intent(action):
+    """Count an assistant message; action is the fast-path action, or None when it went to the LLM."""
+    with _intent_stats_lock:
+        _intent_stats["messages"] += 1
+        if action:
+            _intent_stats["fast_path"] += 1
+            _intent_stats["by_action"][action] = _intent_stats["by_action"].get(action, 0) + 1
+
+def _intent_report():
+    with _intent_stats_lock:
+        messages = _intent_stats["messages"]
+        return dict(_intent_stats, by_action=dict(_intent_stats["by_action"]),
+                    hit_rate=round(_intent_stats["fast_path"] / messages, 3) if messages else 0.0)
+
+def _roster_student_params(params):
+    """Snap a move_student action's student_name, and its class_name if that is missing or
+    wrong, to the roster entry the teacher most likely meant. Unclear names are left alone."""
+    name = str(params.get("student_name") or "").strip().title()
+    if not name:
+        return params
+    hits = [h for h in roster_name_index().lookup(name, limit=NAME_INDEX_MAX_CANDIDATES) if h[1] >= 85]
+    source = str(params.get("class_name") or "").strip().lower()
+    in_source = [h for h in hits if (h[2] or "").lower() == source]
+    if in_source:
+        hit = in_source[0]
+    elif len(hits) == 1 or (len(hits) > 1 and hits[0][1] > hits[1][1] + 5):
+        hit = hits[0]
+    else:
+        return params
+    return dict(params, student_name=hit[0], class_name=hit[2])
+
 @app.route('/api/smart-assistant', methods=['POST'])
 def smart_assistant():
     """Smart Assistant v3 — Full intelligence upgrade. Designed by XO.
@@ -3052,7 +6303,14 @@ def smart_assistant():
         session_info = data.get('sessionInfo', {})  # Classes graded, subject, etc.
         history = data.get('history', [])  # Conversation history
         images = data.get('images', [])  # Base64 images from frontend
-        
+
+        # Trivial messages ("download", "yes") don't need the LLM
+        fast = _assistant_fast_path(message, history, current_results, images)
+        _record_intent(fast and fast["action"])
+        if fast:
+            fast["fast_path"] = True
+            return jsonify(fast), 200
+
         # Build SMART conversation context with action tracking
         conversation_context = ""
         last_proposed_action = None
@@ -3086,52 +6344,7 @@ def smart_assistant():
                 conversation_context += ">>> If teacher says 'yes'/'ok'/'do it'/'go ahead', RE-EXECUTE this action with SAME params! <<<\n"
         
         # Build RICH context from actual database — gives the AI real intelligence
-        classes = ClassModel.query.order_by(ClassModel.name).all()
-        class_data = {}
-        grading_progress = []  # Proactive suggestions for the AI
-        
-        for c in classes:
-            students = StudentModel.query.filter_by(class_id=c.id).order_by(StudentModel.name).all()
-            scores = ScoreModel.query.filter(
-                ScoreModel.student_id.in_([s.id for s in students])
-            ).all() if students else []
-            
-            # Rich breakdown per class
-            assessment_types = list(set(s.assessment_type for s in scores)) if scores else []
-            subjects = list(set(s.subject_name for s in scores)) if scores else []
-            terms = list(set(s.term for s in scores)) if scores else []
-            
-            # Per-subject grading completion check
-            subject_progress = {}
-            for subj in subjects:
-                subj_scores = [s for s in scores if s.subject_name == subj]
-                subj_assessments = list(set(s.assessment_type for s in subj_scores))
-                subj_terms = list(set(s.term for s in subj_scores))
-                students_scored = len(set(s.student_id for s in subj_scores))
-                subject_progress[subj] = {
-                    "assessments_done": subj_assessments,
-                    "terms_done": subj_terms,
-                    "students_scored": students_scored
-                }
-                
-                # Figure out next logical assessment
-                standard_order = ['1st CA', '2nd CA', 'Open Day', 'Note Book', 'Assignment', 'Exam']
-                missing = [a for a in standard_order if a not in subj_assessments]
-                if missing:
-                    grading_progress.append("{} → {} needs {} next for {}".format(
-                        c.name, subj, missing[0],
-                        subj_terms[0] if subj_terms else "1st Term"
-                    ))
-            
-            class_data[c.name] = {
-                "student_count": len(students),
-                "students": [s.name for s in students[:MAX_STUDENTS_IN_CONTEXT]],
-                "assessments": assessment_types,
-                "subjects": subjects,
-                "terms": terms,
-                "subject_progress": subject_progress,
-                "has_scores": len(scores) > 0
-            }
+        class_data, grading_progress = _assistant_db_snapshot()
         
         # Build current session analytics if results are available
         session_analytics = ""
@@ -3158,14 +6371,8 @@ def smart_assistant():
                 highest = max(valid_scores, key=lambda x: x['score'])
                 lowest = min(valid_scores, key=lambda x: x['score'])
                 
-                # Anomaly detection — scores that deviate significantly from average
-                anomalies = []
-                if len(scores_list) > 3:
-                    import statistics
-                    stdev = statistics.stdev(scores_list) if len(scores_list) > 1 else 0
-                    for s in valid_scores:
-                        if stdev > 0 and abs(s['score'] - avg) > (2 * stdev):
-                            anomalies.append(s)
+                # Anomaly detection — z-score and IQR outliers
+                anomalies = [s for s, reason in zip(valid_scores, _score_outliers(scores_list)) if reason]
                 
                 session_analytics = """
 CURRENT GRADING SESSION ANALYTICS:
@@ -3213,6 +6420,9 @@ CURRENT STATE:
 DATABASE (live rosters):
 {db_data}
 
+SCORE ANALYTICS (exact, precomputed from saved scores — quote these numbers, never compute your own; pass line {pass_line}):
+{score_analytics}
+
 {analytics}
 
 {progress}
@@ -3342,7 +6552,9 @@ Return ONLY raw JSON. No markdown wrapping."""
             db_data=json.dumps(class_data, indent=2),
             analytics=session_analytics,
             progress=progress_text,
-            conversation=conversation_context
+            conversation=conversation_context,
+            pass_line=ANALYTICS_PASS_LINE,
+            score_analytics=_analytics_summary(_score_analytics())
         )
 
         
@@ -3365,16 +6577,20 @@ Return ONLY raw JSON. No markdown wrapping."""
         
         # Try primary model, fallback to lighter model
         raw_text = None
+        last_model_error = None
         for model_name in [AI_MODEL_PRIMARY, AI_MODEL_FALLBACK]:
             try:
-                raw_text = _call_gemini(model_name, content_parts)
+                raw_text = _call_gemini(model_name, content_parts, use_cache=False)
                 if raw_text:
                     break
             except Exception as model_err:
+                last_model_error = model_err
                 logger.warning("Chat model {} failed, trying fallback: {}".format(model_name, model_err))
                 continue
         
         if not raw_text:
+            if isinstance(last_model_error, AIUnavailableError):
+                raise last_model_error
             raise Exception("All AI models failed to respond")
         
         # ─── Robust JSON extraction ───────────────────────────────
@@ -3420,7 +6636,22 @@ Return ONLY raw JSON. No markdown wrapping."""
                     "action": "none",
                     "params": {}
                 }
-        
+
+        # Analysis actions carry exact numbers, not the model's arithmetic
+        if result.get("action") in ("analyze_scores", "compare_classes", "find_at_risk", "flag_anomalies"):
+            session_classes = {str(c).strip().upper(): str(c).strip() for c in
+                               list((session_info or {}).get('selectedClasses') or []) + [r.get('class') for r in current_results]
+                               if c and str(c).strip()}
+            model_params = result.get("params") or {}
+            result["params"] = _analytics_params(result["action"], model_params, list(session_classes.values()))
+            if result["params"] is not model_params:
+                result["response"] = _analytics_reply(result["action"], result["params"])
+        elif result.get("action") == "move_student":
+            result["params"] = _roster_student_params(result.get("params") or {})
+        # "Want me to download your results?" proposes the action; the frontend waits for a yes
+        if result.get("action") in ASSISTANT_PARAMLESS_ACTIONS and str(result.get("response", "")).rstrip().endswith("?"):
+            result["needs_confirmation"] = True
+
         return jsonify(result), 200
         
     except Exception as e:
@@ -3430,7 +6661,9 @@ Return ONLY raw JSON. No markdown wrapping."""
         
         # Categorize the error for a smart, specific response
         error_msg = str(e).lower()
-        if 'quota' in error_msg or '429' in error_msg or 'resource' in error_msg:
+        if isinstance(e, AIUnavailableError):
+            return jsonify({"response": str(e), "action": "none", "params": {}}), 200
+        elif 'quota' in error_msg or '429' in error_msg or 'resource' in error_msg:
             return jsonify({
                 "response": "We're hitting the AI rate limit right now. Give it about 60 seconds and try again — I'll be ready!",
                 "action": "none",
@@ -3469,7 +6702,7 @@ def safe_add_student():
             return jsonify({"error": "Student name and class are required."}), 400
         
         # Guard 1: Validate class exists
-        c = ClassModel.query.filter(func.lower(ClassModel.name) == class_name.lower()).first()
+        c = class_roster(class_name)
         if not c:
             return jsonify({
                 "error": "Class '{}' not found. Please create the class first.".format(class_name),
@@ -3485,10 +6718,8 @@ def safe_add_student():
             }), 409
         
         # Guard 3: Fuzzy duplicate check - catch near-matches (skip if forced)
-        all_students = StudentModel.query.filter_by(class_id=c.id).all()
-        all_names = [s.name for s in all_students]
-        if all_names and not force:
-            best_match = process.extractOne(student_name, all_names, scorer=fuzz.token_set_ratio)
+        if len(c) and not force:
+            best_match = c.index.best(student_name)
             if best_match and best_match[1] >= 88:
                 return jsonify({
                     "warning": "A similar name exists: '{}' ({}% match). Is this the same student?".format(
@@ -3509,7 +6740,7 @@ def safe_add_student():
             "message": "{} has been added to {}.".format(student_name, class_name),
             "student_id": new_student.id,
             "class_name": class_name,
-            "total_students": len(all_students) + 1
+            "total_students": len(c) + 1
         }), 201
         
     except Exception as e:
@@ -0,0 +1,265 @@
+"""
+Local stand-in for the Gemini API, for load tests and offline development.
+
+Enabled with AI_BACKEND=fake: app._model_for_key then hands out FakeGenerativeModel
+instead of a real genai.GenerativeModel. Replies are schema-correct JSON for every
+prompt the app sends (batch OCR, scan-to-Excel, gap fill, name extraction, Excel
+edits, smart assistant), built from the roster names found in the prompt.
+
+Failure behaviour is configured with environment variables (or configure()):
+  FAKE_GEMINI_LATENCY          median seconds per call (lognormal), default 1.5
+  FAKE_GEMINI_LATENCY_SIGMA    lognormal spread, default 0.5 (1.0+ gives a long tail)
+  FAKE_GEMINI_SECONDS_PER_IMAGE  extra latency per image, default 0.3
+  FAKE_GEMINI_RPM              per-key requests/minute before 429s, 0 = unlimited
+  FAKE_GEMINI_429_EVERY        start a 429 storm every N seconds, 0 = never
+  FAKE_GEMINI_429_SECONDS      how long each storm lasts, default 5
+  FAKE_GEMINI_ERROR_RATE       fraction of calls failing with a 500, default 0
+  FAKE_GEMINI_TIMEOUT_RATE     fraction of calls failing with a 504, default 0
+  FAKE_GEMINI_TRUNCATE_RATE    fraction of replies cut off mid-JSON, default 0
+  FAKE_GEMINI_SEED             RNG seed, for repeatable runs
+"""
+import os
+import ast
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+import re as re_mod
+from collections import deque
+
+from google.api_core import exceptions as api_exceptions
+
+DEFAULT_NAMES = ["Adebayo Tunde", "Okafor Chioma", "Musa Aishat", "Bello Ibrahim", "Eze Ngozi",
+                 "Ogunleye Femi", "Abubakar Hauwa", "Nwosu Emeka", "Adeyemi Kemi", "Yusuf Zainab"]
+SCAN_COLUMNS = ["1st CA", "2nd CA", "Exam"]
+TOKENS_PER_IMAGE = 258
+
+_config = {
+    "latency": float(os.getenv("FAKE_GEMINI_LATENCY", "1.5")),
+    "latency_sigma": float(os.getenv("FAKE_GEMINI_LATENCY_SIGMA", "0.5")),
+    "seconds_per_image": float(os.getenv("FAKE_GEMINI_SECONDS_PER_IMAGE", "0.3")),
+    "rpm": int(os.getenv("FAKE_GEMINI_RPM", "0")),
+    "burst_every": float(os.getenv("FAKE_GEMINI_429_EVERY", "0")),
+    "burst_seconds": float(os.getenv("FAKE_GEMINI_429_SECONDS", "5")),
+    "error_rate": float(os.getenv("FAKE_GEMINI_ERROR_RATE", "0")),
+    "timeout_rate": float(os.getenv("FAKE_GEMINI_TIMEOUT_RATE", "0")),
+    "truncate_rate": float(os.getenv("FAKE_GEMINI_TRUNCATE_RATE", "0")),
+}
+_rng = random.Random(os.getenv("FAKE_GEMINI_SEED"))
+_lock = threading.Lock()
+_key_calls = {}  # {key_index: deque of call times} for the RPM limit
+_started = time.monotonic()
+_stats = {"calls": 0, "images": 0, "rate_limited": 0, "errors": 0, "timeouts": 0, "truncated": 0}
+
+
+def configure(**overrides):
+    """Change failure behaviour at runtime (the _config keys, plus seed). Resets counters."""
+    global _started
+    seed = overrides.pop("seed", None)
+    unknown = set(overrides) - set(_config)
+    if unknown:
+        raise ValueError("Unknown fake Gemini setting(s): {}".format(", ".join(sorted(unknown))))
+    with _lock:
+        _config.update(overrides)
+        _key_calls.clear()
+        _started = time.monotonic()
+        for field in _stats:
+            _stats[field] = 0
+    if seed is not None:
+        _rng.seed(seed)
+
+
+def stats():
+    with _lock:
+        return dict(_stats, config=dict(_config))
+
+
+class _Part:
+    def __init__(self, text):
+        self.text = text
+        self.thought = False
+
+
+class _Content:
+    def __init__(self, text):
+        self.parts = [_Part(text)]
+
+
+class _Candidate:
+    def __init__(self, text):
+        self.content = _Content(text)
+
+
+class _Usage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.cached_content_token_count = 0
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class FakeResponse:
+    """Same attributes the app reads from a GenerateContentResponse."""
+
+    def __init__(self, text, usage=None):
+        self.text = text
+        self.candidates = [_Candidate(text)]
+        self.usage_metadata = usage
+
+
+class FakeStream(FakeResponse):
+    """Async-iterable reply for stream=True; pieces arrive spread over the call's latency."""
+
+    def __init__(self, text, usage, seconds):
+        super().__init__(text, usage)
+        self._seconds = seconds
+
+    def __aiter__(self):
+        return self._pieces()
+
+    async def _pieces(self):
+        size = 64
+        count = max(1, (len(self.text) + size - 1) // size)
+        for i in range(count):
+            await asyncio.sleep(self._seconds / count)
+            yield FakeResponse(self.text[i * size:(i + 1) * size])
+
+
+class FakeGenerativeModel:
+    """Drop-in for genai.GenerativeModel's generate_content_async."""
+
+    def __init__(self, model_name, key_index=None, generation_config=None):
+        self.model_name = model_name
+        self.key_index = key_index
+        self.generation_config = generation_config
+
+    async def generate_content_async(self, contents, stream=False):
+        texts = [p if isinstance(p, str) else getattr(p, "text", "") for p in contents
+                 if not (isinstance(p, dict) and "data" in p)]
+        images = [p for p in contents if isinstance(p, dict) and "data" in p]
+        prompt = "\n".join(t for t in texts if t)
+        with _lock:
+            _stats["calls"] += 1
+            _stats["images"] += len(images)
+        self._check_rate_limit()
+
+        seconds = _rng.lognormvariate(0, _config["latency_sigma"]) * _config["latency"] + _config["seconds_per_image"] * len(images)
+        roll = _rng.random()
+        if roll < _config["timeout_rate"]:
+            await asyncio.sleep(seconds)
+            _count("timeouts")
+            raise api_exceptions.DeadlineExceeded("504 Deadline Exceeded (fake)")
+        if roll < _config["timeout_rate"] + _config["error_rate"]:
+            await asyncio.sleep(seconds / 4)
+            _count("errors")
+            raise api_exceptions.InternalServerError("500 An internal error has occurred (fake)")
+
+        text = json.dumps(_reply_for(prompt, images))
+        if _rng.random() < _config["truncate_rate"]:
+            _count("truncated")
+            text = text[:max(1, int(len(text) * _rng.uniform(0.3, 0.9)))]
+        usage = _Usage(len(prompt) // 4 + TOKENS_PER_IMAGE * len(images), len(text) // 4)
+        if stream:
+            return FakeStream(text, usage, seconds)
+        await asyncio.sleep(seconds)
+        return FakeResponse(text, usage)
+
+    def _check_rate_limit(self):
+        now = time.monotonic()
+        # Storms fill the last burst_seconds of every burst_every-second period
+        if _config["burst_every"] and (now - _started) % _config["burst_every"] >= _config["burst_every"] - _config["burst_seconds"]:
+            _count("rate_limited")
+            raise api_exceptions.ResourceExhausted("429 Resource has been exhausted (fake storm)")
+        if not _config["rpm"]:
+            return
+        with _lock:
+            calls = _key_calls.setdefault(self.key_index, deque())
+            while calls and now - calls[0] > 60:
+                calls.popleft()
+            if len(calls) >= _config["rpm"]:
+                _stats["rate_limited"] += 1
+                raise api_exceptions.ResourceExhausted("429 Resource has been exhausted (fake quota)")
+            calls.append(now)
+
+
+def _count(field):
+    with _lock:
+        _stats[field] += 1
+
+
+def _image_rng(image):
+    """RNG seeded from the image bytes, so the same photo always reads the same way."""
+    data = image.get("data", b"")
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return random.Random(hashlib.md5(data).hexdigest())
+
+
+def _roster_names(prompt):
+    """Names the app put in the prompt: a numbered roster or a Python-style list."""
+    names = re_mod.findall(r"^\s+\d+\.\s+(.+?)\s*$", prompt, re_mod.M)
+    if names:
+        return names
+    match = re_mod.search(r"(?:across all classes|in this class): (\[.*?\])\.", prompt, re_mod.S)
+    if match:
+        try:
+            return list(ast.literal_eval(match.group(1)))
+        except (ValueError, SyntaxError):
+            pass
+    return list(DEFAULT_NAMES)
+
+
+def _misspell(name, rng):
+    """Drop or swap a letter now and then, like messy handwriting."""
+    if len(name) < 5 or rng.random() < 0.6:
+        return name
+    i = rng.randrange(1, len(name) - 1)
+    return name[:i] + name[i + 1:] if rng.random() < 0.5 else name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def _reply_for(prompt, images):
+    """Schema-correct reply for whichever app prompt this is."""
+    names = _roster_names(prompt)
+    if "filling gaps in a table" in prompt:
+        rows = [json.loads(line) for line in re_mod.findall(r'^\{"row".*\}$', prompt, re_mod.M)]
+        return [dict({"row": r["row"]}, **{col: _rng.randint(3, 10) for col in r.get("missing", [])}) for r in rows]
+    if "OCR Assistant helping a Nigerian teacher grade" in prompt:
+        classes = re_mod.findall(r"grading papers for class\(es\) '([^']*)'", prompt)
+        rows = []
+        for image in images:
+            rng = _image_rng(image)
+            rows.append({
+                "name": _misspell(rng.choice(names), rng),
+                "class": (classes[0].split(",")[0].strip() if classes else "SS 1Q"),
+                "score": "{}/10".format(rng.randint(2, 10)),
+                "confidence": rng.choice(["High", "High", "High", "Medium", "Low"]),
+            })
+        return rows
+    if "expert OCR and data extraction AI" in prompt:
+        pages = max(1, len(images))
+        rows = []
+        for i, name in enumerate(names):
+            row = {"name": name}
+            for col in SCAN_COLUMNS:
+                row[col] = None if _rng.random() < 0.03 else _rng.randint(20, 70) if col == "Exam" else _rng.randint(3, 10)
+            per_page = (len(names) + pages - 1) // pages
+            row["_page"] = i // per_page + 1
+            row["_y"] = round(0.15 + 0.8 * (i % per_page + 0.5) / per_page, 2)
+            rows.append(row)
+        return rows
+    if '"assessment_types_found"' in prompt:
+        return {"assessment_types_found": SCAN_COLUMNS,
+                "records": [{"name": n, "scores": {c: str(_rng.randint(3, 10)) for c in SCAN_COLUMNS}} for n in names]}
+    if "JSON array of strings" in prompt:
+        return [_misspell(n, _rng) for n in names]
+    if '"edits"' in prompt:
+        return {"edits": [], "summary": "No changes (fake backend)"}
+    if '"friendly_message"' in prompt:
+        return {"friendly_message": "Something went wrong (fake backend).", "suggestion": "Try again.", "can_retry": True}
+    if '"matches"' in prompt:
+        return {"matches": []}
+    if '"response"' in prompt and '"action"' in prompt:
+        return {"response": "Done (fake backend).", "action": "none", "params": {}}
+    return {"response": "OK (fake backend)."}
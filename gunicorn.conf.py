@@ -10,3 +10,9 @@ threads = 4 # Use threads for I/O bound tasks (safe for memory, good for concurr
 # Prevent memory leaks by recycling workers periodically
 max_requests = 50 # Restart the worker after 50 requests to clear memory bloat
 max_requests_jitter = 10 # Add random jitter to prevent restarts at exactly the same time
+
+def post_worker_init(worker):
+    # Start the batch job worker in each web worker, so jobs a recycled worker left
+    # half-done resume straight away instead of waiting for the next job request
+    from app import ensure_batch_job_worker
+    ensure_batch_job_worker()
@@ -0,0 +1,200 @@
+"""
+Offline load test: runs the OCR -> roster matching -> export pipeline against the
+local Gemini stand-in (fake_gemini.py), so no quota is spent and no network is needed.
+
+    python load_test.py --images 200
+    python load_test.py --images 300 --latency 2 --sigma 1.0 --storm-every 30 --truncate 0.05
+    python load_test.py --scenario scan --pages 3
+    python load_test.py --scenario matching --students 1000
+
+Uses a throwaway SQLite database unless DATABASE_URL is already set.
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+parser = argparse.ArgumentParser(description="Benchmark SmartGrader against the fake Gemini backend.")
+parser.add_argument("--scenario", default="all", choices=["all", "batch", "scan", "assistant", "matching"])
+parser.add_argument("--images", type=int, default=100, help="script photos in the batch scenario")
+parser.add_argument("--pages", type=int, default=2, help="sheet photos in the scan scenario")
+parser.add_argument("--class-name", default="SS 1Q")
+parser.add_argument("--students", type=int, default=1000, help="roster size in the matching scenario")
+parser.add_argument("--keys", type=int, default=3, help="fake API keys")
+parser.add_argument("--rpm", type=int, default=60, help="per-key requests/minute (app scheduler and fake quota)")
+parser.add_argument("--latency", type=float, default=1.5, help="median seconds per call")
+parser.add_argument("--sigma", type=float, default=0.5, help="lognormal latency spread")
+parser.add_argument("--per-image", type=float, default=0.3, help="extra seconds per image")
+parser.add_argument("--error-rate", type=float, default=0.0)
+parser.add_argument("--timeout-rate", type=float, default=0.0)
+parser.add_argument("--truncate", type=float, default=0.0, help="fraction of replies cut off mid-JSON")
+parser.add_argument("--storm-every", type=float, default=0.0, help="429 storm every N seconds (0 = off)")
+parser.add_argument("--storm-seconds", type=float, default=5.0)
+parser.add_argument("--seed", type=int, default=None)
+args = parser.parse_args()
+
+# The app reads these at import time
+os.environ["AI_BACKEND"] = "fake"
+os.environ["GEMINI_API_KEY"] = ",".join("fake-key-{}".format(i + 1) for i in range(args.keys))
+os.environ["GEMINI_KEY_RPM"] = str(args.rpm)
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="smartgrader-load-"), "load.db"))
+
+import fake_gemini
+from app import app
+from PIL import Image, ImageDraw
+
+fake_gemini.configure(latency=args.latency, latency_sigma=args.sigma, seconds_per_image=args.per_image,
+                      rpm=args.rpm, error_rate=args.error_rate, timeout_rate=args.timeout_rate,
+                      truncate_rate=args.truncate, burst_every=args.storm_every, burst_seconds=args.storm_seconds,
+                      seed=args.seed)
+rng = random.Random(args.seed)
+client = app.test_client()
+
+
+def script_photo(width=1200, height=1600):
+    """A distinct, photo-sized JPEG (random scribbles, so no two hash alike)."""
+    img = Image.new("RGB", (width, height), (235, 232, 220))
+    draw = ImageDraw.Draw(img)
+    for _ in range(120):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.line((x, y, x + rng.randrange(-200, 200), y + rng.randrange(-40, 40)),
+                  fill=(rng.randrange(120), rng.randrange(120), rng.randrange(200)), width=rng.randrange(1, 6))
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=80)
+    return out.getvalue()
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def run_batch():
+    print("Batch: {} images, class {}".format(args.images, args.class_name))
+    photos = [script_photo() for _ in range(args.images)]
+    started = time.monotonic()
+    response = client.post("/upload-batch", content_type="multipart/form-data", buffered=False, data={
+        "images": [(io.BytesIO(p), "script{}.jpg".format(i)) for i, p in enumerate(photos)],
+        "targetClass": args.class_name,
+    })
+    rows, errors, report, first_row, row_times = [], [], None, None, []
+    for line in response.response:
+        line = line.decode() if isinstance(line, bytes) else line
+        for event in line.split("\n\n"):
+            if not event.startswith("data: ") or event == "data: [DONE]":
+                continue
+            payload = json.loads(event[6:])
+            if "index" in payload:
+                row_times.append(time.monotonic() - started)
+                first_row = first_row or row_times[-1]
+                rows.append(payload)
+            elif "error" in payload:
+                errors.append(payload["error"])
+            elif "report" in payload:
+                report = payload["report"]
+    wall = time.monotonic() - started
+    print("  rows {}/{}  errors {}  wall {:.1f}s  first row {:.1f}s  p50 row {:.1f}s  p95 row {:.1f}s  {:.0f} images/min".format(
+        len(rows), args.images, len(errors), wall, first_row or 0, percentile(row_times, 50), percentile(row_times, 95),
+        args.images / wall * 60 if wall else 0))
+    flagged = sum(1 for r in rows if r["result"].get("needs_resolution"))
+    print("  names needing resolution: {}".format(flagged))
+    if report:
+        print("  report: {}".format(report))
+
+    started = time.monotonic()
+    export = client.post("/export-excel", json={
+        "results": [r["result"] for r in rows],
+        "assessmentType": "1st CA", "subjectType": "Mathematics", "term": "1st Term",
+        "subjectMode": "general", "classList": [args.class_name], "existingRecords": None,
+    })
+    print("  export {} in {:.2f}s".format(export.status_code, time.monotonic() - started))
+
+
+def run_scan():
+    print("Scan to Excel: {} page(s), class {}".format(args.pages, args.class_name))
+    import base64
+    started = time.monotonic()
+    response = client.post("/api/assistant-scan-to-excel", json={
+        "instruction": "extract all columns", "class_name": args.class_name,
+        "subject_name": "Mathematics", "assessment_type": "1st Term",
+        "images_base64": [{"data": base64.b64encode(script_photo()).decode(), "mime_type": "image/jpeg"} for _ in range(args.pages)],
+    })
+    body = response.get_json() or {}
+    print("  status {}  rows {}  wall {:.1f}s  {}".format(response.status_code, body.get("row_count"),
+                                                         time.monotonic() - started, body.get("error", "")))
+
+
+def run_assistant(turns=10):
+    print("Smart assistant: {} turns".format(turns))
+    latencies = []
+    for message in ["How is {} doing?".format(args.class_name), "Who is failing?", "Compare SS 1Q and SS 1S"] * (turns // 3 + 1):
+        started = time.monotonic()
+        client.post("/api/smart-assistant", json={"message": message, "history": [{"role": "user", "text": message}]})
+        latencies.append(time.monotonic() - started)
+        if len(latencies) >= turns:
+            break
+    print("  p50 {:.2f}s  p95 {:.2f}s".format(percentile(latencies, 50), percentile(latencies, 95)))
+
+
+def run_matching():
+    """Roster matching throughput: thefuzz extractOne per name vs one NameMatcher matrix vs NameIndex lookups."""
+    from thefuzz import process, fuzz
+    from app import NameMatcher
+    parts = ["Adebayo", "Tunde", "Chioma", "Okafor", "Aishat", "Musa", "Ibrahim", "Bello", "Ngozi", "Eze", "Femi",
+             "Ogunleye", "Hauwa", "Emeka", "Kemi", "Zainab", "Oluwapelumi", "Opeyemi", "Alare", "Ifeoma", "Yusuf"]
+    roster = [" ".join(rng.sample(parts, rng.choice([2, 3]))) for _ in range(args.students)]
+    names = []
+    for _ in range(args.students):
+        name = rng.choice(roster)
+        i = rng.randrange(1, len(name) - 1)
+        names.append(name[:i] + name[i + 1:])  # One dropped letter, like a misread
+    print("Matching: {} OCR names x {} roster names".format(len(names), len(roster)))
+    sample = names[:max(1, min(len(names), 200))]
+    started = time.monotonic()
+    expected = [process.extractOne(n, roster, scorer=fuzz.token_set_ratio) for n in sample]
+    per_name = (time.monotonic() - started) / len(sample)
+    started = time.monotonic()
+    matcher = NameMatcher(names, roster)
+    got = [matcher.best(n) for n in names]
+    matrix = time.monotonic() - started
+    agree = sum(1 for e, g in zip(expected, got) if e[1] == g[1])
+    print("  thefuzz extractOne: {:.1f} ms/name, ~{:.1f}s for all {}".format(per_name * 1000, per_name * len(names), len(names)))
+    print("  NameMatcher:        {:.2f}s for all {} ({:.0f} names/s, {:.1f}x)  same scores {}/{}".format(
+        matrix, len(names), len(names) / matrix if matrix else 0, per_name * len(names) / matrix if matrix else 0, agree, len(sample)))
+    from app import NameIndex
+    started = time.monotonic()
+    index = NameIndex(roster)
+    built = time.monotonic() - started
+    started = time.monotonic()
+    indexed = [index.best(n) for n in names]
+    lookups = time.monotonic() - started
+    recall = sum(1 for e, g in zip(expected, indexed) if g and e[1] == g[1])
+    print("  NameIndex:          built in {:.0f} ms, {:.2f} ms/lookup  same scores {}/{}".format(
+        built * 1000, lookups / len(names) * 1000, recall, len(sample)))
+    class_size = min(80, len(roster))
+    started = time.monotonic()
+    assignment = NameMatcher(names[:class_size], roster[:class_size]).assign(75)
+    print("  one-to-one assign:  {:.1f} ms for {}x{}  paired {}  ambiguous {}".format(
+        (time.monotonic() - started) * 1000, class_size, class_size, len(assignment["pairs"]), len(assignment["ambiguous"])))
+
+
+if __name__ == "__main__":
+    if args.scenario in ("all", "batch"):
+        run_batch()
+    if args.scenario in ("all", "scan"):
+        run_scan()
+    if args.scenario in ("all", "assistant"):
+        run_assistant()
+    if args.scenario in ("all", "matching"):
+        run_matching()
+    print("Fake backend: {}".format(json.dumps(fake_gemini.stats())))
+    health = client.get("/health").get_json() or {}
+    print("Key scheduler: {}".format(json.dumps(health.get("key_scheduler"))))
+    print("Assistant fast path: {}".format(json.dumps(health.get("assistant_fast_path"))))
+    sys.exit(0)
@@ -850,7 +850,8 @@ async function sendAssistantMessage(message) {
         const data = await response.json();
 
         // Track assistant response in history
-        assistantHistory.push({ role: 'assistant', text: data.response || '', action: data.action || 'none' });
+        assistantHistory.push({ role: 'assistant', text: data.response || '', action: data.action || 'none', params: data.params || {},
+            needs_confirmation: !!data.needs_confirmation });
 
         // ──────────────────────────────────────────────────
         //  PENDING INTERACTION: Track if the next action opens a widget
@@ -878,7 +879,8 @@ async function sendAssistantMessage(message) {
             'scan_image_to_excel'
         ];
         if (data.action && data.action !== 'none') {
-            if (autoExecActions.includes(data.action)) {
+            // A proposed action ("Want me to download it?") waits for the teacher's yes or a tap
+            if (autoExecActions.includes(data.action) && !data.needs_confirmation) {
                 // Auto-execute after a small delay so the response text renders first
                 setTimeout(() => {
                     executeAssistantAction(data.action, data.params || {});
@@ -1006,6 +1008,9 @@ function _handlePendingInteraction(message, chatEl) {
 }
 
 async function executeAssistantAction(action, params) {
+    // Running the proposed action settles it: a later "ok" is just an acknowledgement
+    const lastTurn = assistantHistory[assistantHistory.length - 1];
+    if (lastTurn && lastTurn.needs_confirmation && lastTurn.action === action) lastTurn.needs_confirmation = false;
     const modal = document.getElementById('smart-assistant-modal');
     const fab = document.getElementById('smart-assistant-fab');
     const hideModal = () => {
@@ -2106,6 +2111,9 @@ async function buildExcelFromPreview() {
             chatEl.innerHTML += `<div class="flex justify-start mb-3"><div class="bg-emerald-500/10 border border-emerald-500/20 rounded-2xl rounded-bl-md px-4 py-3 max-w-[90%]">
                 <p class="text-sm text-emerald-400 font-bold mb-1"><i class="fa-solid fa-check-circle mr-1.5"></i>${result.message}</p>
                 <a href="${result.download_url}" class="inline-flex mt-2 items-center gap-2 px-4 py-2 bg-gradient-to-r from-emerald-500/20 to-primary/20 hover:from-emerald-500/30 hover:to-primary/30 border border-emerald-500/30 rounded-xl text-emerald-400 text-xs font-bold transition-all"><i class="fa-solid fa-file-arrow-down"></i> Download Excel</a>
+                ${(result.ambiguous_names || []).length ? `<p class="text-[11px] text-amber-400 mt-2"><i class="fa-solid fa-triangle-exclamation mr-1"></i>Check these name matches: ${result.ambiguous_names.slice(0, 5).map(a => a.match
+                    ? `${escapeHtml(a.name)} → ${escapeHtml(a.match)} (or ${escapeHtml(a.rival)}?)`
+                    : `${escapeHtml(a.name)} (dropped, ${escapeHtml(a.rival)} taken)`).join('; ')}</p>` : ''}
                 <p class="text-[10px] text-white/40 mt-2">You can upload this file using "I Have My Excel" to import it into the system.</p>
             </div></div>`;
             chatEl.scrollTop = chatEl.scrollHeight;
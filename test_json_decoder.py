@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import json
+from app import JsonArrayDecoder, _salvage_json_array
+
+rows = [{"name": "Aishat Musa", "score": "8"}, {"name": "Bola Ahmed", "score": "6"}]
+reply = "Results [see below]:\n" + json.dumps(rows)
+
+# Bracketed prose before the array is not the array
+items, complete = _salvage_json_array(reply)
+assert items == rows and complete, (items, complete)
+
+# Same reply streamed a few characters at a time
+decoder = JsonArrayDecoder()
+streamed = []
+for i in range(0, len(reply), 3):
+    streamed.extend(decoder.feed(reply[i:i + 3]))
+assert streamed == rows and decoder.complete, (streamed, decoder.complete)
+
+# Truncated after the first row: one item, reported incomplete (so the tail is re-requested)
+items, complete = _salvage_json_array(reply[:reply.index("}") + 1] + ', {"name": "Bo')
+assert items == rows[:1] and not complete, (items, complete)
+
+# Fenced and empty replies
+assert _salvage_json_array("```json\n" + json.dumps(rows) + "\n```") == (rows, True)
+assert _salvage_json_array("No scripts found: []") == ([], True)
+
+print("JSON array decoder cases passed.")